@@ -7,16 +7,62 @@
 
 """
 import chunk
+import collections
+import contextlib
 import filecmp
 import hashlib
+import math
+import mmap
+import multiprocessing
 import os
+import struct
 import subprocess
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
 
 try:
     import mutagenwrapper
 except ImportError:
     mutagenwrapper = None
 
+try:
+    import mutagen.mp3
+except ImportError:
+    mutagen = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import soundfile
+except (ImportError, OSError):
+    # soundfile raises OSError if libsndfile is not found
+    soundfile = None
+
+from .cache import ChecksumCache
+from .scheduler import DecoderScheduler
+
 
 __version__ = '0.3.0'
 
@@ -27,28 +73,396 @@ AUDIO_FORMATS = ['wav', 'flac', 'm4a', 'mp3']
 #: Default FFmpeg path
 FFMPEG_BIN = 'ffmpeg'
 
+#: Available decoders. ``'ffmpeg'`` always runs FFmpeg. ``'soundfile'`` uses
+#: the soundfile library, if installed, for :data:`SOUNDFILE_FORMATS`.
+#: ``'auto'`` also reads integer PCM WAV files directly. All of them produce
+#: the same checksums.
+DECODERS = ['auto', 'ffmpeg', 'soundfile']
+
+#: Default decoder
+DECODER = 'auto'
+
+#: Formats (extensions) decoded by the soundfile library when available
+SOUNDFILE_FORMATS = ['wav', 'flac']
+
+#: PCM formats (FFmpeg's names of raw sample formats) that audio streams can
+#: be decoded into to compute their checksums
+PCM_FORMATS = ['s16le', 's24le', 's32le', 'f32le']
+
+#: Default PCM format, used unless another one is chosen by
+#: :func:`negotiate_format`
+PCM_FORMAT = 's24le'
+
+#: Formats (extensions) that may be lossy, which :func:`negotiate_format`
+#: decodes into floating point samples
+LOSSY_FORMATS = ['mp3', 'm4a']
+
+#: Algorithms that :func:`checksum` can hash audio streams with. ``'sha1'``,
+#: ``'md5'`` and ``'crc32'`` are always available. ``'blake2b'`` requires
+#: pyblake2 unless hashlib has it, and ``'xxh64'``, ``'xxh3_64'`` and
+#: ``'xxh128'`` require xxhash.
+HASH_ALGORITHMS = ['sha1', 'md5', 'crc32', 'blake2b', 'xxh64', 'xxh3_64',
+                   'xxh128']
+
+#: Default hash algorithm
+HASH_ALGORITHM = 'sha1'
+
+#: Maximum time in seconds to decode a file, or ``None`` for no limit
+DECODE_TIMEOUT = None
 
-def equal(name1, name2, ffmpeg_bin=None):
+#: Number of lines of FFmpeg's stderr output kept for error messages
+STDERR_LINES = 20
+
+#: Maximum length of a line of FFmpeg's stderr output kept for error messages
+STDERR_LINE_LENGTH = 1024
+
+#: Number of bytes of PCM data read and hashed at a time by :func:`checksum`,
+#: into a buffer that is reused
+HASH_BUFFER_SIZE = 262144
+
+#: Size in bytes requested for the pipe FFmpeg writes PCM data to, on Linux.
+#: Larger pipes let FFmpeg run ahead of the hasher for longer. Requests larger
+#: than ``/proc/sys/fs/pipe-max-size`` are ignored.
+PIPE_SIZE = 1048576
+
+#: Number of bytes of PCM data hashed by :func:`partial_checksum` (about four
+#: seconds of 44.1 kHz stereo audio)
+PARTIAL_CHECKSUM_SIZE = 1048576
+
+#: Formats (extensions) whose segments can be decoded exactly as they appear in
+#: the whole stream, used by :func:`sampled_checksum`
+SAMPLED_FORMATS = ['wav', 'flac']
+
+#: Number of segments hashed by :func:`sampled_checksum`
+SAMPLED_SEGMENTS = 3
+
+#: Length in seconds of each segment hashed by :func:`sampled_checksum`
+SAMPLED_SEGMENT_LENGTH = 1
+
+#: Number of sample frames compared at a time by :func:`diff_audio`
+FRAMES_PER_CHUNK = 65536
+
+#: Number of sample frames at the beginning of audio streams cross-correlated
+#: by :func:`find_offset`
+ALIGNMENT_WINDOW = 131072
+
+#: Largest offset in sample frames searched by :func:`find_offset`
+MAX_ALIGNMENT_OFFSET = 8192
+
+#: Maximum number of audio files decoded at the same time by all threads, or
+#: ``0`` for no limit. ``None`` means the number of CPUs. See
+#: :func:`max_decoders`.
+MAX_DECODERS = None
+
+#: Default path to the checksum cache database
+CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'),
+    'audiodiff', 'checksums.sqlite3')
+
+#: Maximum number of entries kept in the checksum cache
+CACHE_SIZE = 1000000
+
+
+def equal(name1, name2, ffmpeg_bin=None, **kwargs):
     """Compares two files and returns ``True`` if they are considered equal.
     For audio files, they are equal if their uncompressed audio streams and
     tags (as reported by mutagenwrapper, except for ``encodedby`` which is
     ignored) are equal. For non-audio files, they must have the same content to
-    be equal.
+    be equal. Other keyword arguments are passed to :func:`audio_equal`.
 
     """
     if is_supported_format(name1) and is_supported_format(name2):
-        return audio_equal(name1, name2, ffmpeg_bin) and tags_equal(name1,
-                                                                    name2)
+        with memoize_info():
+            return (audio_equal(name1, name2, ffmpeg_bin, **kwargs) and
+                    tags_equal(name1, name2))
     else:
-        return filecmp.cmp(name1, name2, False)
+        return _contents_equal(name1, name2)
+
+
+def _contents_equal(name1, name2):
+    """Compares the contents of two files with :func:`filecmp.cmp`, counting
+    the bytes it reads in :data:`stats`.
+
+    """
+    with stats.timer('filecmp'):
+        size1 = os.path.getsize(name1)
+        size2 = os.path.getsize(name2)
+        rv = filecmp.cmp(name1, name2, False)
+    if size1 == size2:
+        # Files of different sizes are not read
+        stats.incr('filecmp_bytes', size1 + size2)
+    return rv
+
+
+def compare_many(pairs, jobs=None, **kwargs):
+    """Compares each pair of files in *pairs* with :func:`equal` and returns
+    a list of the results, in the same order as *pairs*. The pairs are
+    compared in a pool of *jobs* worker threads, which defaults to the number
+    of CPUs. Other keyword arguments are passed to :func:`equal`. Each file
+    is parsed once per pair (see :func:`memoize_info`).
+
+    """
+    pairs = list(pairs)
+    if jobs is None:
+        jobs = _cpu_count()
+    if jobs <= 1 or len(pairs) <= 1:
+        return [equal(name1, name2, **kwargs) for name1, name2 in pairs]
+    pool = ThreadPool(min(jobs, len(pairs)))
+    try:
+        return pool.map(lambda pair: equal(pair[0], pair[1], **kwargs),
+                        pairs)
+    finally:
+        pool.terminate()
+
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
 
 
-def audio_equal(name1, name2, ffmpeg_bin=None):
+def audio_equal(name1, name2, ffmpeg_bin=None, cache=None, streaming=False,
+                timeout=None, decoder=None, flac_md5=False, prefilter=True,
+                partial=False, max_difference=None, min_snr=None,
+                align=False, algorithm=None):
     """Compares two audio files and returns ``True`` if they have the same
-    audio streams.
+    audio streams. Unless *prefilter* is ``False``, the files are first
+    compared by their headers (see :func:`stream_mismatch`), and ``False`` is
+    returned without decoding them if they differ. The two files are decoded
+    concurrently, into the PCM format returned by :func:`negotiate_format`.
+    If *streaming* is
+    ``True``, the streams are compared while they are decoded and decoding
+    stops as soon as they differ (see :func:`first_difference`). If *flac_md5*
+    is ``True``, FLAC files are compared without decoding them if possible
+    (see :func:`flac_md5_equal`). If *partial* is ``True``, parts of the
+    streams are compared before decoding them fully (see
+    :func:`partial_mismatch`). See :func:`checksum` for the other arguments.
+    Checksums are compared with :func:`compare_digests`.
+
+    If *max_difference* or *min_snr* is given, the streams only need to be
+    approximately equal, which is useful for lossy formats whose decoded
+    samples differ slightly across platforms. If *align* is ``True``, the
+    streams are aligned before comparing them, so that encoder delay and
+    padding are ignored, and the headers are not compared. In either case the
+    samples are compared by :func:`approx_audio_equal`, and *cache*,
+    *streaming*, *flac_md5* and *partial* are ignored.
+
+    """
+    if prefilter and not align and stream_mismatch(name1, name2) is not None:
+        return False
+    if max_difference is not None or min_snr is not None or align:
+        return approx_audio_equal(name1, name2, max_difference, min_snr,
+                                  ffmpeg_bin, timeout, decoder, align)
+    if flac_md5:
+        rv = flac_md5_equal(name1, name2)
+        if rv is not None:
+            return rv
+    pcm_format = negotiate_format(name1, name2)
+    if partial and partial_mismatch(name1, name2, ffmpeg_bin, cache, timeout,
+                                    decoder, pcm_format,
+                                    algorithm) is not None:
+        return False
+    if streaming:
+        return first_difference(name1, name2, ffmpeg_bin, cache,
+                                timeout, decoder, pcm_format,
+                                algorithm) is None
+    args = (ffmpeg_bin, cache, timeout, decoder, pcm_format, algorithm)
+    checksum1, checksum2 = _parallel(checksum,
+                                     [(name1,) + args, (name2,) + args])
+    return compare_digests(checksum1, checksum2)
+
+
+def flac_md5_equal(name1, name2):
+    """Compares the MD5 signatures of the unencoded audio data stored in the
+    STREAMINFO blocks of two FLAC files, which is much faster than decoding
+    them. Returns ``None`` if the signatures cannot be compared, that is, if
+    either file is not a FLAC file or has no signature, or if the files have
+    different bit depths.
+
+    """
+    if get_extension(name1) != 'flac' or get_extension(name2) != 'flac':
+        return None
+    info1 = audio_file_info(name1)
+    info2 = audio_file_info(name2)
+    if (info1.md5_signature is None or info2.md5_signature is None or
+            info1.bits_per_sample != info2.bits_per_sample):
+        return None
+    return info1.md5_signature == info2.md5_signature
+
+
+#: Properties of an audio stream. Each of them may be ``None`` if unknown.
+#: *samples* is the number of samples per channel.
+StreamInfo = collections.namedtuple('StreamInfo',
+                                    ['sample_rate', 'channels', 'samples'])
+
+
+def stream_info(name):
+    """Returns a :data:`StreamInfo` of the audio file, read from its headers
+    without decoding the file. Only the properties that are exactly the same
+    as those of the stream produced by the decoder are reported: the number of
+    samples is known only for WAV and FLAC files, and nothing is known about
+    M4A files, since the headers of HE-AAC streams do not describe the decoded
+    stream.
 
     """
-    return checksum(name1, ffmpeg_bin) == checksum(name2, ffmpeg_bin)
+    return audio_file_info(name).stream
+
+
+def stream_mismatch(name1, name2):
+    """Compares the :func:`stream_info` of two audio files and returns a
+    description of the first property that differs, like ``'sample rate
+    (44100 and 48000)'``, or ``None`` if no known property differs. If it
+    returns a description, the audio streams are not equal.
+
+    """
+    info1 = stream_info(name1)
+    info2 = stream_info(name2)
+    fields = [
+        ('sample_rate', 'sample rate'),
+        ('channels', 'number of channels'),
+        ('samples', 'number of samples'),
+    ]
+    for field, description in fields:
+        value1 = getattr(info1, field)
+        value2 = getattr(info2, field)
+        if value1 is not None and value2 is not None and value1 != value2:
+            stats.incr('prefilter_mismatches')
+            return '{0} ({1} and {2})'.format(description, value1, value2)
+    return None
+
+
+def partial_mismatch(name1, name2, ffmpeg_bin=None, cache=None, timeout=None,
+                     decoder=None, pcm_format=None, algorithm=None):
+    """Compares parts of the audio streams of two audio files, which is much
+    faster than decoding them fully for long files, and returns a description
+    of the first part that differs, like ``'first 1048576 bytes'``, or
+    ``None`` if no part differs or the checksums of both files are in *cache*.
+    The parts are the beginnings (see :func:`partial_checksum`) and, if the
+    files have the same known stream properties, a few short segments (see
+    :func:`sampled_checksum`). If it returns a description, the audio streams
+    are not equal. See :func:`checksum` for the other arguments.
+
+    """
+    cache1, key1 = _cache_key(name1, ffmpeg_bin, cache, pcm_format,
+                              algorithm, decoder)
+    cache2, key2 = _cache_key(name2, ffmpeg_bin, cache, pcm_format,
+                              algorithm, decoder)
+    if (key1 is not None and key2 is not None and
+            cache1.get(key1) is not None and cache2.get(key2) is not None):
+        return None
+    args = (None, ffmpeg_bin, timeout, decoder, pcm_format, algorithm)
+    checksum1, checksum2 = _parallel(partial_checksum,
+                                     [(name1,) + args, (name2,) + args])
+    if checksum1 != checksum2:
+        stats.incr('partial_mismatches')
+        return 'first {0} bytes'.format(PARTIAL_CHECKSUM_SIZE)
+    info = stream_info(name1)
+    if None in info or info != stream_info(name2):
+        return None
+    args = (ffmpeg_bin, timeout, decoder, pcm_format, algorithm)
+    checksum1, checksum2 = _parallel(sampled_checksum,
+                                     [(name1,) + args, (name2,) + args])
+    if checksum1 is not None and checksum2 is not None and \
+            checksum1 != checksum2:
+        stats.incr('partial_mismatches')
+        return 'sampled segments'
+    return None
+
+
+def _parallel(func, argslist):
+    """Calls *func* with each tuple of arguments in *argslist* concurrently,
+    each in its own thread, and returns a list of the return values. If any of
+    the calls raises an exception, the readers the other calls opened with
+    :func:`_open_pcm` are aborted, and the exception is reraised after all
+    calls finish. The calls share the :func:`memoize_info` block of the
+    caller, if any.
+
+    """
+    results = [None] * len(argslist)
+    group = _ReaderGroup(getattr(_parallel_local, 'group', None))
+    memo = getattr(_info_local, 'memo', None)
+
+    def run(i):
+        previous = getattr(_parallel_local, 'group', None)
+        previous_memo = getattr(_info_local, 'memo', None)
+        _parallel_local.group = group
+        _info_local.memo = memo
+        try:
+            results[i] = func(*argslist[i])
+        except Exception:
+            group.fail(sys.exc_info())
+        finally:
+            _parallel_local.group = previous
+            _info_local.memo = previous_memo
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in xrange(1, len(argslist))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    if argslist:
+        run(0)
+    for thread in threads:
+        thread.join()
+    if group.error is not None:
+        raise group.error[0], group.error[1], group.error[2]
+    return results
+
+
+#: Per-thread state of :func:`_parallel`
+_parallel_local = threading.local()
+
+
+class _ReaderGroup(object):
+    """Readers opened by the calls of a :func:`_parallel` invocation (and of
+    the invocations nested in them, whose groups have this one as *parent*).
+    When a call fails, the readers of the other calls are aborted, so that
+    they stop decoding instead of running to the end.
+
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.error = None
+        self._lock = threading.Lock()
+        self._readers = []
+
+    def add(self, reader):
+        group = self
+        while group is not None:
+            with group._lock:
+                group._readers.append(reader)
+                failed = group.error is not None
+            if failed:
+                reader.abort()
+            group = group.parent
+
+    def remove(self, reader):
+        """Forgets *reader*, which has been closed, so that it is not aborted
+        when a call fails.
+
+        """
+        group = self
+        while group is not None:
+            with group._lock:
+                if reader in group._readers:
+                    group._readers.remove(reader)
+            group = group.parent
+
+    def fail(self, exc_info):
+        """Records the exception of a failed call, unless another call has
+        already failed, and aborts all readers.
+
+        """
+        with self._lock:
+            if self.error is not None:
+                return
+            self.error = exc_info
+            readers = list(self._readers)
+        for reader in readers:
+            reader.abort()
 
 
 def tags_equal(name1, name2):
@@ -59,56 +473,1247 @@ def tags_equal(name1, name2):
     return tags(name1) == tags(name2)
 
 
-def checksum(name, ffmpeg_bin=None):
-    """Returns an SHA1 checksum of the uncompressed PCM (signed 24-bit
-    little-endian) data stream of the audio file. Note that the checksums for
-    the same file may differ across different platforms if the file format is
-    lossy, due to floating point problems and different implementations of
-    decoders.
+def checksum(name, ffmpeg_bin=None, cache=None, timeout=None, decoder=None,
+             pcm_format=None, algorithm=None):
+    """Returns a checksum of the uncompressed PCM data stream of the audio
+    file, as a :class:`Digest`. The stream is decoded into *pcm_format*, one
+    of :data:`PCM_FORMATS`, which defaults to :data:`PCM_FORMAT` (signed
+    24-bit little-endian), and hashed with *algorithm*, one of
+    :data:`HASH_ALGORITHMS`, which defaults to :data:`HASH_ALGORITHM`
+    (SHA1); only checksums in the same format and made with the same
+    algorithm can be compared (see :func:`compare_digests`). Note that the
+    checksums for the same file may differ across different platforms if the
+    file format is lossy, due to floating point problems and different
+    implementations of decoders.
+
+    Checksums are looked up in and saved to *cache*, a
+    :class:`~audiodiff.cache.ChecksumCache`. If it is ``None``, the cache
+    returned by :func:`default_cache` is used; if it is ``False``, no cache is
+    used.
+
+    FFmpeg is killed and :exc:`ExternalLibraryError` is raised if decoding
+    takes longer than *timeout* seconds, which defaults to
+    :data:`DECODE_TIMEOUT`.
+
+    The file is decoded by *decoder*, one of :data:`DECODERS`, which defaults
+    to :data:`DECODER`. It waits for its turn if :func:`max_decoders` files
+    are already being decoded (see :func:`default_scheduler`).
+
+    """
+    if ffmpeg_bin is None:
+        ffmpeg_bin = ffmpeg_path()
+    if pcm_format is None:
+        pcm_format = PCM_FORMAT
+    if algorithm is None:
+        algorithm = HASH_ALGORITHM
+    # Fail early if the algorithm is not available
+    _new_hasher(algorithm)
+    _check_readable(name)
+    cache, key = _cache_key(name, ffmpeg_bin, cache, pcm_format, algorithm,
+                            decoder)
+    if key is not None:
+        digest = cache.get(key)
+        if digest is not None:
+            stats.incr('cache_hits')
+            return Digest(digest, pcm_format, algorithm)
+        stats.incr('cache_misses')
+    with default_scheduler().slots([name]):
+        digest = _read_checksum(_open_pcm(name, ffmpeg_bin, timeout,
+                                          decoder, None, pcm_format),
+                                algorithm)
+    if key is not None:
+        cache.set(key, digest)
+    return Digest(digest, pcm_format, algorithm)
+
+
+class Digest(str):
+    """A checksum returned by :func:`checksum`: a hexadecimal string, which
+    also records the PCM format (one of :data:`PCM_FORMATS`) the audio stream
+    was decoded into as :attr:`pcm_format`, and the hash algorithm (one of
+    :data:`HASH_ALGORITHMS`) as :attr:`algorithm`.
+
+    """
+
+    def __new__(cls, value, pcm_format, algorithm):
+        self = str.__new__(cls, value)
+        self.pcm_format = pcm_format
+        self.algorithm = algorithm
+        return self
+
+    def __getnewargs__(self):
+        return str(self), self.pcm_format, self.algorithm
+
+
+def compare_digests(digest1, digest2):
+    """Returns ``True`` if two checksums returned by :func:`checksum` are
+    equal. Raises :exc:`ValueError` if they are :class:`Digest` objects made
+    with different algorithms or from different PCM formats, which are
+    different even for the same audio stream.
+
+    """
+    for attr, description in [('algorithm', 'hash algorithms'),
+                              ('pcm_format', 'PCM formats')]:
+        value1 = getattr(digest1, attr, None)
+        value2 = getattr(digest2, attr, None)
+        if value1 is not None and value2 is not None and value1 != value2:
+            raise ValueError(
+                'cannot compare checksums made with different {0} '
+                '({1} and {2})'.format(description, value1, value2))
+    return digest1 == digest2
+
+
+def _new_hasher(algorithm=None):
+    """Returns a new hash object with the interface of those in hashlib for
+    *algorithm*, one of :data:`HASH_ALGORITHMS` (:data:`HASH_ALGORITHM` if
+    ``None``). Raises :exc:`ValueError` if the algorithm is unknown, and
+    :exc:`ImportError` if the library implementing it is not installed.
+
+    """
+    if algorithm is None:
+        algorithm = HASH_ALGORITHM
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError('unknown hash algorithm: {0}'.format(
+            repr(algorithm)))
+    if algorithm == 'crc32':
+        return _CRC32()
+    elif algorithm == 'blake2b' and not hasattr(hashlib, 'blake2b'):
+        if pyblake2 is None:
+            raise ImportError('pyblake2 is required to use blake2b')
+        return pyblake2.blake2b()
+    elif algorithm.startswith('xxh'):
+        if xxhash is None:
+            raise ImportError('xxhash is required to use ' + algorithm)
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+class _CRC32(object):
+    """A hash object that computes CRC-32 checksums with zlib."""
+
+    name = 'crc32'
+    digest_size = 4
+    block_size = 64
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def hexdigest(self):
+        return '{0:08x}'.format(self._crc & 0xffffffff)
+
+
+def negotiate_format(*names):
+    """Returns the PCM format, one of :data:`PCM_FORMATS`, into which the
+    audio files are decoded to compare their checksums. If all of them have
+    the same bit depth of 16, 24 or 32 bits in their headers (see
+    :attr:`AudioFileInfo.bits_per_sample`), it is the integer format of that
+    depth, so that 16-bit files are decoded into a third less data than in
+    :data:`PCM_FORMAT`. If any of them is in one of :data:`LOSSY_FORMATS`, it
+    is ``'f32le'``, which is what their decoders produce and represents
+    integer samples of up to 24 bits exactly. Otherwise it is
+    :data:`PCM_FORMAT`.
+
+    """
+    depths = set()
+    for name in names:
+        if get_extension(name) in LOSSY_FORMATS:
+            return 'f32le'
+        depths.add(audio_file_info(name).bits_per_sample)
+    if len(depths) == 1:
+        return _NATIVE_FORMATS.get(depths.pop(), PCM_FORMAT)
+    return PCM_FORMAT
+
+
+#: Integer PCM formats by bit depth
+_NATIVE_FORMATS = {16: 's16le', 24: 's24le', 32: 's32le'}
+
+#: Sample sizes in bytes of the integer PCM formats, which in-process readers
+#: can produce
+_PCM_WIDTHS = {'s16le': 2, 's24le': 3, 's32le': 4}
+
+#: Sample sizes in bytes of all PCM formats
+_PCM_SIZES = dict(_PCM_WIDTHS, f32le=4)
+
+#: Bit depths of integer samples represented exactly by each PCM format
+_PCM_BITS = {'s16le': 16, 's24le': 24, 's32le': 32, 'f32le': 24}
+
+
+def _exact_format(name, pcm_format):
+    """Returns ``False`` if samples of the audio file are truncated when
+    decoded into *pcm_format*, that is, if its headers tell that it has more
+    bits per sample than the format represents exactly.
+
+    """
+    bits = audio_file_info(name).bits_per_sample
+    return bits is None or bits <= _PCM_BITS[pcm_format]
+
+
+def _read_checksum(reader, algorithm=None):
+    """Returns a checksum of all PCM data read from *reader*, made with
+    *algorithm* (see :func:`_new_hasher`), and closes it.
+
+    """
+    try:
+        with stats.timer('decode'):
+            digest = _compute_digest(reader, algorithm)
+            reader.finish(empty=digest is None)
+    finally:
+        reader.close()
+    return digest
+
+
+def partial_checksum(name, size=None, ffmpeg_bin=None, timeout=None,
+                     decoder=None, pcm_format=None, algorithm=None):
+    """Returns a checksum of the first *size* bytes (defaults to
+    :data:`PARTIAL_CHECKSUM_SIZE`) of the uncompressed PCM data stream of the
+    audio file, in the same format as :func:`checksum`, or of the whole stream
+    if it is shorter. Decoding stops as soon as enough data is read, so it is
+    much faster than :func:`checksum` for long files. Files with different
+    partial checksums have different checksums. Other arguments are the same
+    as :func:`checksum`.
+
+    """
+    if size is None:
+        size = PARTIAL_CHECKSUM_SIZE
+    if ffmpeg_bin is None:
+        ffmpeg_bin = ffmpeg_path()
+    hasher = _new_hasher(algorithm)
+    _check_readable(name)
+    with default_scheduler().slots([name]):
+        reader = _open_pcm(name, ffmpeg_bin, timeout, decoder, None,
+                           pcm_format)
+        try:
+            data = reader.read(size)
+            if len(data) < size:
+                reader.finish(empty=not data)
+        finally:
+            reader.close()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def sampled_checksum(name, ffmpeg_bin=None, timeout=None, decoder=None,
+                     pcm_format=None, algorithm=None):
+    """Returns a checksum of :data:`SAMPLED_SEGMENTS` segments of
+    :data:`SAMPLED_SEGMENT_LENGTH` seconds, evenly spaced in the uncompressed
+    PCM data stream of the audio file, in the same format as :func:`checksum`.
+    Only the segments are decoded. Returns ``None`` if the file is not in one
+    of :data:`SAMPLED_FORMATS` or the length of its stream is unknown. Files
+    with the same stream properties (see :func:`stream_info`) but different
+    sampled checksums have different checksums. Other arguments are the same
+    as :func:`checksum`.
+
+    """
+    info = stream_info(name)
+    if (get_extension(name) not in SAMPLED_FORMATS or
+            info.sample_rate is None or info.samples is None):
+        return None
+    if ffmpeg_bin is None:
+        ffmpeg_bin = ffmpeg_path()
+    _check_readable(name)
+    # Segments start at whole seconds, which are exact sample positions
+    seconds = info.samples // info.sample_rate
+    hasher = _new_hasher(algorithm)
+    with default_scheduler().slots([name]):
+        for i in xrange(1, SAMPLED_SEGMENTS + 1):
+            start = seconds * i // (SAMPLED_SEGMENTS + 1)
+            reader = _open_pcm(name, ffmpeg_bin, timeout, decoder,
+                               (start, SAMPLED_SEGMENT_LENGTH), pcm_format)
+            try:
+                while True:
+                    data = reader.read(hasher.block_size * 128)
+                    if not data:
+                        break
+                    hasher.update(data)
+                reader.finish()
+            finally:
+                reader.close()
+    return hasher.hexdigest()
+
+
+def first_difference(name1, name2, ffmpeg_bin=None, cache=None,
+                     timeout=None, decoder=None, pcm_format=None,
+                     algorithm=None):
+    """Compares the uncompressed PCM data streams of two audio files while
+    decoding them, and returns the offset in bytes of the first difference, or
+    ``None`` if they are equal. The streams are decoded into *pcm_format*
+    (see :func:`checksum`); in the default signed 24-bit little-endian, the
+    offset divided by 3 is the index of the first differing sample (counting
+    the samples of all channels). If one stream is a prefix of the other, the
+    offset is the length of the shorter one.
+
+    Both decoders are killed as soon as a difference is found, so this is much
+    faster than comparing checksums when the files differ early. If the streams
+    are equal, their checksums are saved to *cache*. The two files take two of
+    the :func:`max_decoders` slots at once. See :func:`checksum` for *cache*,
+    *timeout*, *decoder* and *algorithm*.
+
+    """
+    if ffmpeg_bin is None:
+        ffmpeg_bin = ffmpeg_path()
+    _check_readable(name1)
+    _check_readable(name2)
+    cache1, key1 = _cache_key(name1, ffmpeg_bin, cache, pcm_format,
+                              algorithm, decoder)
+    cache2, key2 = _cache_key(name2, ffmpeg_bin, cache, pcm_format,
+                              algorithm, decoder)
+    if key1 is not None and key2 is not None:
+        checksum1 = cache1.get(key1)
+        if checksum1 is not None and checksum1 == cache2.get(key2):
+            return None
+    readers = []
+    with default_scheduler().slots([name1, name2]):
+        try:
+            for name in (name1, name2):
+                readers.append(_open_pcm(name, ffmpeg_bin, timeout, decoder,
+                                         None, pcm_format))
+            hashers = [_new_hasher(algorithm), _new_hasher(algorithm)]
+            block_size = hashers[0].block_size * 128
+            offset = 0
+            while True:
+                chunks = [reader.read(block_size) for reader in readers]
+                for reader, data in zip(readers, chunks):
+                    if len(data) < block_size:
+                        # The stream ended; make sure it did not end early
+                        # because of an error
+                        reader.finish(empty=not offset and not data)
+                if chunks[0] != chunks[1]:
+                    return offset + _common_prefix_length(*chunks)
+                if not chunks[0]:
+                    break
+                hashers[0].update(chunks[0])
+                hashers[1].update(chunks[1])
+                offset += len(chunks[0])
+        finally:
+            for reader in readers:
+                reader.close()
+    if key1 is not None:
+        cache1.set(key1, hashers[0].hexdigest())
+    if key2 is not None:
+        cache2.set(key2, hashers[1].hexdigest())
+    return None
+
+
+def _common_prefix_length(data1, data2):
+    lo = 0
+    hi = min(len(data1), len(data2))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if data1[lo:mid] == data2[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+#: Differences between the samples of one channel of two audio streams, in
+#: units of the least significant bit of signed 24-bit samples. *first* and
+#: *last* are the indexes of the first and last differing samples, or ``None``
+#: if no sample differs. *count* is the number of differing samples, *peak* is
+#: the largest absolute difference and *rms* is the root mean square of the
+#: differences.
+ChannelDifference = collections.namedtuple('ChannelDifference', [
+    'first', 'last', 'count', 'peak', 'rms'])
+
+
+class AudioDifference(collections.namedtuple('AudioDifference', [
+        'channels', 'samples1', 'samples2', 'first', 'last', 'count', 'peak',
+        'rms', 'per_channel', 'offset'])):
+    """Differences between two audio streams, returned by
+    :func:`diff_audio`. *samples1* and *samples2* are the numbers of samples
+    per channel of the streams, and the other fields are the same as those of
+    :data:`ChannelDifference`, but for all channels, except that *count*
+    counts the samples of all channels. Only the samples both streams have
+    are compared. *per_channel* is a list of :data:`ChannelDifference` for
+    each channel. *offset* is the offset of the second stream from the first
+    one, in sample frames, at which they were compared (see
+    :func:`find_offset`); sample indexes are those of the first stream.
 
     """
+
+    __slots__ = ()
+
+    @property
+    def equal(self):
+        """``True`` if the streams are equal."""
+        return not self.count and self.samples1 == self.samples2
+
+
+def diff_audio(name1, name2, ffmpeg_bin=None, timeout=None, decoder=None,
+               align=False):
+    """Compares the samples of the uncompressed audio streams of two audio
+    files while decoding them, and returns an :class:`AudioDifference`
+    describing where and by how much they differ. The streams are compared
+    :data:`FRAMES_PER_CHUNK` sample frames at a time, so memory usage does not
+    depend on their lengths. If *align* is ``True``, the streams are aligned
+    first (see :func:`find_offset`), so that encoder delays and padding do not
+    make all samples differ. Requires numpy. Raises :exc:`ValueError` if the
+    streams have different numbers of channels. See :func:`checksum` for the
+    other arguments.
+
+    """
+    if numpy is None:
+        raise ImportError('numpy is required to compare samples')
     if ffmpeg_bin is None:
         ffmpeg_bin = ffmpeg_path()
+    channels = _common_channels(name1, name2, ffmpeg_bin)
+    offset = 0
+    if align:
+        offset = find_offset(name1, name2, ffmpeg_bin, timeout, decoder)
+    skip = (max(0, -offset), max(0, offset))
+    first = [None] * channels
+    last = [None] * channels
+    count = numpy.zeros(channels, numpy.int64)
+    peak = numpy.zeros(channels, numpy.int64)
+    sumsq = numpy.zeros(channels, numpy.float64)
+    compared = 0
+    with _FramePairs(name1, name2, channels, ffmpeg_bin, timeout, decoder,
+                     skip) as pairs:
+        for frames1, frames2 in pairs:
+            n = min(len(frames1), len(frames2))
+            if not n:
+                # Only the rest of the longer stream is being read
+                continue
+            diff = frames1[:n].astype(numpy.int64) - frames2[:n]
+            differs = diff != 0
+            count += differs.sum(axis=0)
+            peak = numpy.maximum(peak, numpy.abs(diff).max(axis=0))
+            sumsq += (diff.astype(numpy.float64) ** 2).sum(axis=0)
+            for c in xrange(channels):
+                indexes = numpy.flatnonzero(differs[:, c])
+                if len(indexes):
+                    if first[c] is None:
+                        first[c] = skip[0] + compared + int(indexes[0])
+                    last[c] = skip[0] + compared + int(indexes[-1])
+            compared += n
+        lengths = [reader.frames for reader in pairs.readers]
+    per_channel = []
+    for c in xrange(channels):
+        rms = (sumsq[c] / compared) ** 0.5 if compared else 0.0
+        per_channel.append(ChannelDifference(first[c], last[c],
+                                             int(count[c]), int(peak[c]),
+                                             rms))
+    firsts = [f for f in first if f is not None]
+    rms = (sumsq.sum() / (compared * channels)) ** 0.5 if compared else 0.0
+    return AudioDifference(channels, lengths[0], lengths[1],
+                           min(firsts) if firsts else None,
+                           max(last) if firsts else None, int(count.sum()),
+                           int(peak.max()), rms, per_channel, offset)
+
+
+def approx_audio_equal(name1, name2, max_difference=None, min_snr=None,
+                       ffmpeg_bin=None, timeout=None, decoder=None,
+                       align=False):
+    """Compares the samples of the uncompressed audio streams of two audio
+    files while decoding them, and returns ``True`` if the streams have the
+    same number of channels and samples, and no sample differs by more than
+    *max_difference* (in units of the least significant bit of signed 24-bit
+    samples) and the signal-to-noise ratio in dB, taking the first stream as
+    the signal and the differences as the noise, is at least *min_snr*.
+    Either limit can be ``None``; if both are, no sample may differ. The
+    streams are compared :data:`FRAMES_PER_CHUNK` sample frames at a time and
+    decoding stops as soon as a sample differs by more than *max_difference*.
+
+    If *align* is ``True``, the streams are aligned first (see
+    :func:`find_offset`) and only the samples both of them have from there on
+    are compared, so they may have different numbers of samples, as when one
+    of them has encoder delay or padding.
+
+    Requires numpy. See :func:`checksum` for the other arguments.
+
+    """
+    if numpy is None:
+        raise ImportError('numpy is required to compare samples')
+    if ffmpeg_bin is None:
+        ffmpeg_bin = ffmpeg_path()
+    if max_difference is None and min_snr is None:
+        max_difference = 0
+    try:
+        channels = _common_channels(name1, name2, ffmpeg_bin)
+    except ValueError:
+        return False
+    offset = 0
+    if align:
+        offset = find_offset(name1, name2, ffmpeg_bin, timeout, decoder)
+    skip = (max(0, -offset), max(0, offset))
+    signal = 0.0
+    noise = 0.0
+    with _FramePairs(name1, name2, channels, ffmpeg_bin, timeout, decoder,
+                     skip) as pairs:
+        for frames1, frames2 in pairs:
+            n = min(len(frames1), len(frames2))
+            if len(frames1) != len(frames2) and not align:
+                return False
+            if not n:
+                break
+            diff = frames1[:n].astype(numpy.int64) - frames2[:n]
+            if (max_difference is not None and
+                    numpy.abs(diff).max() > max_difference):
+                return False
+            if min_snr is not None:
+                signal += numpy.square(
+                    frames1[:n].astype(numpy.float64)).sum()
+                noise += numpy.square(diff.astype(numpy.float64)).sum()
+    if min_snr is not None and noise:
+        return bool(signal) and 10 * math.log10(signal / noise) >= min_snr
+    return True
+
+
+def find_offset(name1, name2, ffmpeg_bin=None, timeout=None, decoder=None,
+                max_offset=None):
+    """Estimates the offset in sample frames of the audio stream of the
+    second file from that of the first one, by cross-correlating the first
+    :data:`ALIGNMENT_WINDOW` frames of the streams (mixed down to mono) with
+    FFT. A positive offset *n* means that the second stream has *n* more
+    frames at the beginning, such as the priming samples of MP3 and AAC
+    encoders, so that its frame *i* + *n* matches frame *i* of the first
+    stream; a negative offset means the opposite. Offsets up to *max_offset*
+    frames (defaults to :data:`MAX_ALIGNMENT_OFFSET`) in either direction are
+    searched. Returns ``0`` if the beginnings are silent. Requires numpy.
+    Raises :exc:`ValueError` if the streams have different numbers of
+    channels. See :func:`checksum` for the other arguments.
+
+    """
+    if numpy is None:
+        raise ImportError('numpy is required to compare samples')
+    if ffmpeg_bin is None:
+        ffmpeg_bin = ffmpeg_path()
+    if max_offset is None:
+        max_offset = MAX_ALIGNMENT_OFFSET
+    channels = _common_channels(name1, name2, ffmpeg_bin)
+    windows = []
+    with _FramePairs(name1, name2, channels, ffmpeg_bin, timeout,
+                     decoder) as pairs:
+        for reader in pairs.readers:
+            window = reader.read(ALIGNMENT_WINDOW)
+            windows.append(window.sum(axis=1, dtype=numpy.float64))
+    size = 1
+    while size < len(windows[0]) + len(windows[1]):
+        size *= 2
+    # correlation[k] is the sum of window1[i] * window2[i + k] over i, with
+    # negative k wrapped around to the end
+    correlation = numpy.fft.irfft(numpy.fft.rfft(windows[0], size).conj() *
+                                  numpy.fft.rfft(windows[1], size), size)
+    max_offset = min(max_offset, size // 2 - 1)
+    lags = numpy.concatenate((numpy.arange(0, max_offset + 1),
+                              numpy.arange(-max_offset, 0)))
+    candidates = numpy.concatenate((correlation[:max_offset + 1],
+                                    correlation[size - max_offset:]))
+    if not numpy.any(candidates):
+        return 0
+    return int(lags[numpy.argmax(candidates)])
+
+
+def _common_channels(name1, name2, ffmpeg_bin):
+    """Returns the number of channels of the decoded streams of two audio
+    files, or raises :exc:`ValueError` if they differ.
+
+    """
+    _check_readable(name1)
+    _check_readable(name2)
+    channels1 = _decoded_channels(name1, ffmpeg_bin)
+    channels2 = _decoded_channels(name2, ffmpeg_bin)
+    if channels1 != channels2:
+        raise ValueError('different numbers of channels ({0} and {1})'.format(
+            channels1, channels2))
+    return channels1
+
+
+class _FramePairs(object):
+    """Decodes two audio files with *channels* channels when used as a
+    context manager, and iterates over tuples (*frames1*, *frames2*) of numpy
+    arrays of the next :data:`FRAMES_PER_CHUNK` sample frames of each stream
+    (see :class:`_FrameReader`) until both streams end. The first *skip[0]*
+    and *skip[1]* frames of the streams are skipped. :attr:`readers` are the
+    two :class:`_FrameReader` objects.
+
+    """
+
+    def __init__(self, name1, name2, channels, ffmpeg_bin, timeout, decoder,
+                 skip=(0, 0)):
+        self.names = [name1, name2]
+        self.channels = channels
+        self.ffmpeg_bin = ffmpeg_bin
+        self.timeout = timeout
+        self.decoder = decoder
+        self.skip = skip
+        self.readers = []
+        self._slots = None
+
+    def __enter__(self):
+        self._slots = default_scheduler().slots(self.names)
+        self._slots.__enter__()
+        try:
+            for name, frames in zip(self.names, self.skip):
+                reader = _FrameReader(_open_pcm(name, self.ffmpeg_bin,
+                                                self.timeout, self.decoder),
+                                      self.channels)
+                self.readers.append(reader)
+                reader.skip(frames)
+        except Exception:
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for reader in self.readers:
+            reader.close()
+        self._slots.__exit__(exc_type, exc_value, traceback)
+
+    def __iter__(self):
+        while True:
+            frames1 = self.readers[0].read(FRAMES_PER_CHUNK)
+            frames2 = self.readers[1].read(FRAMES_PER_CHUNK)
+            if not len(frames1) and not len(frames2):
+                break
+            yield frames1, frames2
+
+
+class _FrameReader(object):
+    """Reads the PCM data from *reader* (see :func:`_open_pcm`) as numpy
+    arrays of signed 24-bit samples, with a row for each sample frame of
+    *channels* samples. :attr:`frames` is the number of frames read so far.
+
+    """
+
+    def __init__(self, reader, channels):
+        self.reader = reader
+        self.channels = channels
+        self.frames = 0
+        self._ended = False
+
+    def read(self, frames):
+        """Returns an array of up to *frames* frames, which is shorter only
+        at the end of the stream. A partial frame at the end is dropped.
+
+        """
+        if self._ended:
+            return numpy.zeros((0, self.channels), numpy.int32)
+        size = frames * self.channels * 3
+        data = self.reader.read(size)
+        if len(data) < size:
+            # The stream ended; make sure it did not end early because of an
+            # error
+            self.reader.finish(empty=not self.frames and not data)
+            self._ended = True
+        n = len(data) // (self.channels * 3)
+        self.frames += n
+        samples = numpy.frombuffer(data, numpy.uint8,
+                                   n * self.channels * 3).reshape(-1, 3)
+        values = (samples[:, 0].astype(numpy.int32) |
+                  samples[:, 1].astype(numpy.int32) << 8 |
+                  samples[:, 2].view(numpy.int8).astype(numpy.int32) << 16)
+        return values.reshape(n, self.channels)
+
+    def skip(self, frames):
+        """Reads and discards *frames* frames."""
+        while frames > 0 and not self._ended:
+            frames -= len(self.read(min(frames, FRAMES_PER_CHUNK)))
+
+    def close(self):
+        self.reader.close()
+
+
+def _decoded_channels(name, ffmpeg_bin):
+    """Returns the number of channels of the stream the audio file is
+    decoded into. If it is not known from the headers (see
+    :func:`stream_info`), FFmpeg decodes the beginning of the file into a WAV
+    file, whose header tells it.
+
+    """
+    channels = stream_info(name).channels
+    if channels is not None:
+        return channels
     args = [
         ffmpeg_bin,
+        '-nostdin',
+        '-nostats',
+        '-loglevel', 'error',
         '-i', name,
         '-vn',
-        '-f', 's24le',
+        '-t', '0.1',
+        '-f', 'wav',
         '-',
     ]
+    with stats.timer('ffmpeg_spawn'):
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if (proc.returncode != 0 or len(out) < 24 or out[:4] != 'RIFF' or
+            out[12:16] != 'fmt '):
+        raise ExternalLibraryError('failed to decode {0}: {1}'.format(
+            repr(name), err.strip() or 'no output'), err)
+    return struct.unpack('<H', out[22:24])[0]
 
+
+def _check_readable(name):
     # Check if the file is readable and raise an appropriate exception if not
     with open(name) as f:
         f.read(1)
 
-    with open(os.devnull, 'wb') as fnull:
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        sha1sum = _compute_sha1(proc.stdout)
-        proc.wait()
+
+def _cache_key(name, ffmpeg_bin, cache, pcm_format=None, algorithm=None,
+               decoder=None):
+    """Returns a tuple (*cache*, *key*) for looking up the checksum of the
+    file in *pcm_format* (:data:`PCM_FORMAT` if ``None``) made with
+    *algorithm* (:data:`HASH_ALGORITHM` if ``None``) and *decoder* in the
+    cache, or ``(None, None)`` if no cache should be used.
+
+    """
+    if cache is None:
+        cache = default_cache()
+    if not cache:
+        return None, None
+    pcm_format = pcm_format or PCM_FORMAT
+    version = _ffmpeg_version(ffmpeg_bin)
+    if version is None:
+        return None, None
+    if decoder is None:
+        decoder = DECODER
+    # libsndfile may decode the file instead of FFmpeg, which is still run
+    # for the files it rejects
+    if (decoder in ('auto', 'soundfile') and soundfile is not None and
+            get_extension(name) in SOUNDFILE_FORMATS and
+            pcm_format in _PCM_WIDTHS):
+        version = '{0}; libsndfile {1}'.format(
+            version, soundfile.__libsndfile_version__)
+    return cache, cache.key(name, version, pcm_format,
+                            algorithm or HASH_ALGORITHM)
+
+
+def _ffmpeg_args(name, ffmpeg_bin, segment=None, pcm_format=None):
+    """Returns the arguments to run FFmpeg to decode the audio file into PCM
+    data written to stdout. See :class:`_FFmpegProcess` for *segment* and
+    *pcm_format*.
+
+    """
+    args = [
+        ffmpeg_bin,
+        '-nostdin',
+        '-nostats',
+        '-loglevel', 'error',
+    ]
+    if segment is not None:
+        args += ['-ss', str(segment[0])]
+    args += ['-i', name, '-vn']
+    if segment is not None:
+        args += ['-t', str(segment[1])]
+    args += ['-f', pcm_format or PCM_FORMAT, '-']
+    return args
+
+
+class _FFmpegProcess(object):
+    """Runs FFmpeg to decode the audio file *name* into PCM data, which can be
+    read from :attr:`stdout`. Messages written to stderr are read in a
+    background thread, so FFmpeg never blocks on a full pipe, and only the
+    last :data:`STDERR_LINES` lines are kept. The process is killed if it is
+    still running after *timeout* seconds (:data:`DECODE_TIMEOUT` if
+    ``None``). If *segment* is given, it is a tuple (*start*, *duration*) in
+    seconds and only that part of the stream is decoded. The PCM data is in
+    *pcm_format* (:data:`PCM_FORMAT` if ``None``).
+
+    """
+
+    #: The :class:`_ReaderGroup` the reader is in, if any
+    group = None
+
+    def __init__(self, name, ffmpeg_bin, timeout=None, segment=None,
+                 pcm_format=None):
+        if timeout is None:
+            timeout = DECODE_TIMEOUT
+        args = _ffmpeg_args(name, ffmpeg_bin, segment, pcm_format)
+        self.name = name
+        self.timeout = timeout
+        self.timed_out = False
+        self.aborted = False
+        # Serializes killing and reaping FFmpeg
+        self._lock = threading.Lock()
+        with stats.timer('ffmpeg_spawn'):
+            self.proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self.stdout = self.proc.stdout
+        _set_pipe_size(self.stdout.fileno(), PIPE_SIZE)
+        self._stderr = collections.deque(maxlen=STDERR_LINES)
+        self._stderr_thread = threading.Thread(target=self._read_stderr)
+        self._stderr_thread.daemon = True
+        self._stderr_thread.start()
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def read(self, size):
+        data = self.stdout.read(size)
+        if self.aborted:
+            raise _aborted_error(self.name)
+        stats.incr('decoded_bytes', len(data))
+        return data
+
+    def readinto(self, buffer):
+        """Reads up to ``len(buffer)`` bytes into *buffer*, which can be a
+        :class:`bytearray`, and returns the number of bytes read, which is
+        ``0`` at the end of the stream.
+
+        """
+        size = self.stdout.readinto(buffer)
+        if self.aborted:
+            raise _aborted_error(self.name)
+        stats.incr('decoded_bytes', size)
+        return size
+
+    @property
+    def stderr(self):
+        """The last lines FFmpeg wrote to stderr."""
+        return ''.join(self._stderr)
+
+    def _read_stderr(self):
+        while True:
+            line = self.proc.stderr.readline(STDERR_LINE_LENGTH)
+            if not line:
+                break
+            self._stderr.append(line)
+
+    def abort(self):
+        """Kills FFmpeg, making :meth:`read` raise
+        :exc:`ExternalLibraryError`. Can be called from any thread.
+
+        """
+        self.aborted = True
+        self._kill()
+
+    def _expire(self):
+        # The timer may fire after FFmpeg has exited but before finish()
+        # cancels it, in which case the decoding is complete
+        if self.proc.poll() is None:
+            self.timed_out = True
+            self._kill()
+
+    def _kill(self):
+        with self._lock:
+            # Once FFmpeg has been reaped, its pid may belong to another
+            # process; Python 2 does not check this before sending signals
+            if self.proc.returncode is not None:
+                return
+            try:
+                self.proc.kill()
+            except OSError:
+                # Already exited
+                pass
+
+    def finish(self, empty=False):
+        """Waits for FFmpeg to exit and raises :exc:`ExternalLibraryError` if
+        it was killed because of the timeout or if *empty* is ``True``, which
+        means it produced no output.
+
+        """
+        self.proc.wait()
+        if self._timer is not None:
+            self._timer.cancel()
+        self._stderr_thread.join()
+        if self.aborted:
+            raise _aborted_error(self.name)
+        if self.timed_out:
+            raise ExternalLibraryError(
+                'decoding {0} timed out after {1} seconds'.format(
+                    repr(self.name), self.timeout), self.stderr)
+        if empty:
+            raise ExternalLibraryError(
+                'failed to decode {0}: {1}'.format(
+                    repr(self.name), self.stderr.strip() or 'no output'),
+                self.stderr)
+
+    def close(self):
+        """Kills FFmpeg if it is still running and releases resources."""
+        if self.group is not None:
+            self.group.remove(self)
+        self._kill()
+        with self._lock:
+            # FFmpeg has exited or been killed, so this does not block
+            self.proc.wait()
+        if self._timer is not None:
+            self._timer.cancel()
+        self._stderr_thread.join()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+
+
+class _BlockReader(object):
+    """Base class of in-process PCM readers, which produce one of the integer
+    formats in :data:`PCM_FORMATS`. Subclasses implement :meth:`_read_block`,
+    which returns the next block of PCM data converted to *pcm_format*
+    (:data:`PCM_FORMAT` if ``None``), or an empty string at the end of the
+    stream. Raises :exc:`ValueError` if the format is not an integer one.
+
+    """
+
+    #: The :class:`_ReaderGroup` the reader is in, if any
+    group = None
+
+    def __init__(self, name, pcm_format=None):
+        if pcm_format is None:
+            pcm_format = PCM_FORMAT
+        if pcm_format not in _PCM_WIDTHS:
+            raise ValueError('unsupported PCM format: ' + pcm_format)
+        self.name = name
+        self.aborted = False
+        self._out_width = _PCM_WIDTHS[pcm_format]
+        self._buffer = ''
+        self._buffer_pos = 0
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            if self.aborted:
+                raise _aborted_error(self.name)
+            if self._buffer_pos == len(self._buffer):
+                self._buffer = self._read_block()
+                self._buffer_pos = 0
+                if not self._buffer:
+                    break
+                stats.incr('decoded_bytes', len(self._buffer))
+            data = self._buffer[self._buffer_pos:self._buffer_pos + size]
+            self._buffer_pos += len(data)
+            size -= len(data)
+            chunks.append(data)
+        return ''.join(chunks)
+
+    def readinto(self, buffer):
+        # The data is converted in blocks anyway, so it is copied
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def finish(self, empty=False):
+        if self.aborted:
+            raise _aborted_error(self.name)
+        if empty:
+            raise ExternalLibraryError(
+                'failed to decode {0}: no audio data'.format(repr(self.name)))
+
+    def abort(self):
+        """Makes :meth:`read` raise :exc:`ExternalLibraryError`. Can be called
+        from any thread.
+
+        """
+        self.aborted = True
+
+    def close(self):
+        """Releases resources. Subclasses extend it."""
+        if self.group is not None:
+            self.group.remove(self)
+
+
+def _aborted_error(name):
+    return ExternalLibraryError('decoding {0} was aborted'.format(repr(name)))
+
+
+class _WaveReader(_BlockReader):
+    """Reads the PCM data in a WAV file *name* and converts it to *pcm_format*
+    in the same way FFmpeg does, without spawning FFmpeg. The ``data`` chunk
+    is memory-mapped. Raises :exc:`ValueError` if the file is not an integer
+    PCM WAV file that can be read this way. See :class:`_FFmpegProcess` for
+    *segment*.
+
+    """
+
+    #: Number of sample frames converted at a time
+    FRAMES_PER_BLOCK = 65536
+
+    def __init__(self, name, segment=None, pcm_format=None):
+        _BlockReader.__init__(self, name, pcm_format)
+        self._file = open(name, 'rb')
         try:
-            if sha1sum is None:
-                raise ExternalLibraryError(proc.stderr.read())
-            return sha1sum
-        finally:
-            proc.stdout.close()
-            proc.stderr.close()
+            header = self._parse()
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        block_align = header.block_align
+        size = header.data_size
+        self._width = header.bits // 8
+        self._pos = header.data_offset
+        self._end = self._pos + size - size % block_align
+        if segment is not None:
+            second = header.sample_rate * block_align
+            self._pos = min(self._pos + segment[0] * second, self._end)
+            self._end = min(self._pos + segment[1] * second, self._end)
+        self._block_size = block_align * self.FRAMES_PER_BLOCK
+
+    def _parse(self):
+        header = _parse_wave_header(self._file)
+        if header.data_size is None:
+            raise ValueError('unknown data size')
+        width = header.bits // 8
+        if (header.tag != 1 or header.bits not in (8, 16, 24, 32) or
+                header.channels == 0 or
+                header.block_align != header.channels * width):
+            raise ValueError('unsupported WAV format')
+        return header
+
+    def _read_block(self):
+        end = min(self._pos + self._block_size, self._end)
+        data = self._map[self._pos:end]
+        self._pos = end
+        return _convert_pcm(data, self._width, self._out_width)
+
+    def close(self):
+        _BlockReader.close(self)
+        self._map.close()
+        self._file.close()
+
+
+class _SoundFileReader(_BlockReader):
+    """Decodes the audio file *name* in-process with the soundfile library and
+    converts the samples to *pcm_format*, producing the same data as FFmpeg.
+    Raises :exc:`ValueError` if the file is not encoded with integer PCM
+    samples, in which case the conversion may not be exact, and
+    :exc:`ExternalLibraryError` if libsndfile fails to decode it later. See
+    :class:`_FFmpegProcess` for *segment*.
+
+    """
+
+    #: Number of sample frames decoded at a time
+    FRAMES_PER_BLOCK = 65536
+
+    #: Subtypes of lossless integer PCM encodings
+    SUBTYPES = ['PCM_S8', 'PCM_U8', 'PCM_16', 'PCM_24', 'PCM_32']
+
+    def __init__(self, name, segment=None, pcm_format=None):
+        _BlockReader.__init__(self, name, pcm_format)
+        try:
+            self._file = soundfile.SoundFile(name)
+        except RuntimeError as e:
+            raise ValueError(str(e))
+        if self._file.subtype not in self.SUBTYPES:
+            self._file.close()
+            raise ValueError('unsupported subtype: ' + self._file.subtype)
+        self._frames = None
+        if segment is not None:
+            rate = self._file.samplerate
+            self._file.seek(min(segment[0] * rate, self._file.frames))
+            self._frames = segment[1] * rate
+
+    def _read_block(self):
+        frames = self.FRAMES_PER_BLOCK
+        if self._frames is not None:
+            frames = min(frames, self._frames)
+            self._frames -= frames
+        if not frames:
+            return ''
+        # libsndfile scales integer samples to the full 32-bit range
+        try:
+            data = self._file.buffer_read(frames, dtype='int32')
+        except RuntimeError as e:
+            raise self._error(e)
+        return _convert_pcm(data[:], 4, self._out_width)
+
+    def close(self):
+        _BlockReader.close(self)
+        try:
+            self._file.close()
+        except RuntimeError as e:
+            raise self._error(e)
+
+    def _error(self, e):
+        return ExternalLibraryError('failed to decode {0}: {1}'.format(
+            repr(self.name), e), str(e))
+
+
+_WaveHeader = collections.namedtuple('_WaveHeader', [
+    'tag', 'channels', 'sample_rate', 'bits', 'block_align', 'data_offset',
+    'data_size'])
+
+
+def _parse_wave_header(f):
+    """Parses the RIFF chunks of a WAV file up to the ``data`` chunk and
+    returns a :class:`_WaveHeader`. The format tag is taken from the subformat
+    if the file uses ``WAVE_FORMAT_EXTENSIBLE``. *data_size* is ``None`` if it
+    is zero or the ``data`` chunk extends past the end of the file, in which
+    cases FFmpeg reads to the end of the file. Raises :exc:`ValueError` if the
+    file is not a valid WAV file.
+
+    """
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != 'RIFF' or header[8:] != 'WAVE':
+        raise ValueError('not a RIFF WAVE file')
+    fmt = None
+    while True:
+        try:
+            c = chunk.Chunk(f, bigendian=False)
+        except EOFError:
+            raise ValueError('no data chunk')
+        if c.getname() == 'fmt ':
+            fmt = c.read()
+        elif c.getname() == 'data':
+            break
+        c.skip()
+    if fmt is None or len(fmt) < 16:
+        raise ValueError('no valid fmt chunk before data chunk')
+    tag, channels, sample_rate, _, block_align, bits = struct.unpack(
+        '<HHIIHH', fmt[:16])
+    if tag == 0xfffe and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE; the format tag is in the subformat GUID
+        tag = struct.unpack('<H', fmt[24:26])[0]
+    data_size = c.getsize()
+    if data_size == 0 or c.offset + data_size > os.fstat(f.fileno()).st_size:
+        data_size = None
+    return _WaveHeader(tag, channels, sample_rate, bits, block_align,
+                       c.offset, data_size)
+
+
+def _convert_pcm(data, width, out_width=3):
+    """Converts little-endian PCM samples, *width* bytes each (unsigned if 1
+    byte, signed otherwise), to signed little-endian samples of *out_width*
+    bytes. Narrower samples are padded with zero bits and wider ones are
+    truncated like FFmpeg does.
+
+    """
+    if width == out_width:
+        return data
+    if width == 1:
+        data = data.translate(_FLIP_SIGN_BIT)
+    n = len(data) // width
+    out = bytearray(n * out_width)
+    # The most significant bytes of the samples line up
+    for i in xrange(max(0, width - out_width), width):
+        j = i + out_width - width
+        out[j::out_width] = data[i::width]
+    return str(out)
+
+
+_FLIP_SIGN_BIT = ''.join(chr(i ^ 0x80) for i in xrange(256))
+
+
+def _open_pcm(name, ffmpeg_bin, timeout, decoder=None, segment=None,
+              pcm_format=None):
+    """Returns a reader of the PCM data of the audio file, converted to
+    *pcm_format* (:data:`PCM_FORMAT` if ``None``), using *decoder* (see
+    :data:`DECODERS`). WAV and FLAC files are decoded in-process if possible
+    and the format is an integer one; otherwise they are decoded by FFmpeg. If
+    *segment* is given, it is a tuple (*start*, *duration*) in whole seconds
+    and only that part of the stream is read.
+
+    """
+    reader = _in_process_reader(name, decoder, segment, pcm_format)
+    if reader is None:
+        reader = _FFmpegProcess(name, ffmpeg_bin, timeout, segment,
+                                pcm_format)
+    group = getattr(_parallel_local, 'group', None)
+    if group is not None:
+        reader.group = group
+        group.add(reader)
+    return reader
 
 
-def _compute_sha1(f):
-    hasher = hashlib.sha1()
+def _in_process_reader(name, decoder=None, segment=None, pcm_format=None):
+    """Returns a reader that decodes the audio file in-process, or ``None``
+    if :func:`_open_pcm` would run FFmpeg to decode it.
+
+    """
+    if decoder is None:
+        decoder = DECODER
+    if decoder not in DECODERS:
+        raise ValueError('unknown decoder: {0}'.format(repr(decoder)))
+    if pcm_format is None:
+        pcm_format = PCM_FORMAT
+    if pcm_format not in PCM_FORMATS:
+        raise ValueError('unknown PCM format: {0}'.format(repr(pcm_format)))
+    if pcm_format not in _PCM_WIDTHS:
+        return None
+    extension = get_extension(name)
+    if decoder == 'auto' and extension == 'wav':
+        try:
+            return _WaveReader(name, segment, pcm_format)
+        except ValueError:
+            pass
+    if (decoder in ('auto', 'soundfile') and soundfile is not None and
+            extension in SOUNDFILE_FORMATS):
+        try:
+            return _SoundFileReader(name, segment, pcm_format)
+        except ValueError:
+            pass
+    return None
+
+
+#: FFmpeg versions by binary path, filled by :func:`_ffmpeg_version`
+_ffmpeg_versions = {}
+
+
+def _ffmpeg_version(ffmpeg_bin):
+    """Returns a string identifying the FFmpeg binary and its version, or
+    ``None`` if it cannot be run.
+
+    """
+    try:
+        return _ffmpeg_versions[ffmpeg_bin]
+    except KeyError:
+        pass
+    try:
+        proc = subprocess.Popen([ffmpeg_bin, '-version'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out = proc.communicate()[0]
+    except OSError:
+        version = None
+    else:
+        lines = out.splitlines()
+        if proc.returncode == 0 and lines:
+            version = '{0}: {1}'.format(ffmpeg_bin, lines[0])
+        else:
+            version = None
+    _ffmpeg_versions[ffmpeg_bin] = version
+    return version
+
+
+def _compute_digest(f, algorithm=None, buffer_size=None):
+    """Returns a checksum made with *algorithm* of all data read from *f*, or
+    ``None`` if there is none. The data is read into a single buffer of
+    *buffer_size* bytes (:data:`HASH_BUFFER_SIZE` if ``None``), which is
+    hashed in place. The time spent hashing is added to the ``hash`` timer
+    of :data:`stats`.
+
+    """
+    hasher = _new_hasher(algorithm)
+    data = bytearray(buffer_size or HASH_BUFFER_SIZE)
     empty = True
+    seconds = 0.0
     while True:
-        data = f.read(hasher.block_size * 128)
-        if not data:
+        size = f.readinto(data)
+        if not size:
             break
         empty = False
-        hasher.update(data)
+        start = time.time()
+        # A read-only buffer, unlike a memoryview, is accepted by zlib too
+        hasher.update(buffer(data, 0, size))
+        seconds += time.time() - start
+    stats.add_time('hash', seconds)
     if empty:
         return None
     return hasher.hexdigest()
 
 
+#: ``fcntl`` command to resize a pipe (Linux 2.6.35 and later)
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def _set_pipe_size(fd, size):
+    """Asks the kernel to resize the pipe *fd* to *size* bytes on Linux.
+    Errors are ignored, since the default size only makes reading slower.
+
+    """
+    if fcntl is None or not sys.platform.startswith('linux') or not size:
+        return
+    try:
+        fcntl.fcntl(fd, _F_SETPIPE_SZ, size)
+    except (IOError, OSError):
+        # Larger than pipe-max-size, or an old kernel
+        pass
+
+
 def tags(name):
     """Returns tags in the audio file as a :class:`dict`. Its return value is
     the same as ``mutagenwrapper.read_tags``, except that single valued items
@@ -121,11 +1726,156 @@ def tags(name):
         raise ImportError('mutagenwrapper is required to read tags')
     if not is_supported_format(name):
         raise UnsupportedFileError(name + ' is not a supported audio file')
-    if get_extension(name) == 'wav':
-        return {}
-    return dict((key, _unwrap(value))
-                for key, value in mutagenwrapper.read_tags(name).iteritems()
-                if key != 'encodedby')
+    return dict(audio_file_info(name).tags)
+
+
+class AudioFileInfo(object):
+    """Tags and stream properties of the audio file *name*, read with a single
+    parse of the file. :attr:`tags` is the same as the return value of
+    :func:`tags`; accessing it raises the exception raised while reading the
+    tags, if any. :attr:`stream` is a :data:`StreamInfo` (see
+    :func:`stream_info`). :attr:`bits_per_sample` and :attr:`md5_signature`
+    are set for FLAC files, the latter only if the file has one.
+
+    Use :func:`audio_file_info` to get a memoized instance.
+
+    """
+
+    __slots__ = ['name', 'stream', 'bits_per_sample', 'md5_signature',
+                 '_tags', '_error']
+
+    def __init__(self, name):
+        self.name = name
+        self.stream = StreamInfo(None, None, None)
+        self.bits_per_sample = None
+        self.md5_signature = None
+        self._tags = None
+        self._error = None
+        with stats.timer('parse'):
+            if get_extension(name) == 'wav':
+                self._tags = {}
+                try:
+                    self._load_wave()
+                except EnvironmentError:
+                    self._error = sys.exc_info()
+            else:
+                try:
+                    self._load()
+                except Exception:
+                    self._error = sys.exc_info()
+
+    @property
+    def tags(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._tags
+
+    def _load_wave(self):
+        with open(self.name, 'rb') as f:
+            try:
+                header = _parse_wave_header(f)
+            except ValueError:
+                return
+        samples = None
+        if header.block_align and header.data_size is not None:
+            samples = header.data_size // header.block_align
+        self.stream = StreamInfo(header.sample_rate, header.channels, samples)
+        self.bits_per_sample = header.bits
+
+    def _load(self):
+        if mutagenwrapper is None:
+            raise ImportError('mutagenwrapper is required to read tags')
+        wrapper = mutagenwrapper.read_tags(self.name)
+        self._tags = dict((key, _unwrap(value))
+                          for key, value in wrapper.iteritems()
+                          if key != 'encodedby')
+        try:
+            self._load_stream(wrapper.raw_tags)
+        except Exception:
+            # Let the decoder report errors in broken files
+            pass
+
+    def _load_stream(self, raw):
+        extension = get_extension(self.name)
+        if extension == 'flac':
+            info = raw.info
+            self.stream = StreamInfo(info.sample_rate, info.channels,
+                                     info.total_samples or None)
+            self.bits_per_sample = info.bits_per_sample
+            self.md5_signature = info.md5_signature or None
+        elif extension == 'mp3':
+            # mutagenwrapper reads only the ID3 tag; the MPEG frames follow it
+            with open(self.name, 'rb') as f:
+                info = mutagen.mp3.MPEGInfo(f, raw.size)
+            channels = 1 if info.mode == mutagen.mp3.MONO else 2
+            self.stream = StreamInfo(info.sample_rate, channels, None)
+
+
+class _MemoEntry(object):
+
+    __slots__ = ['lock', 'value']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+
+
+#: Per-thread state of :func:`memoize_info`
+_info_local = threading.local()
+_info_memo_lock = threading.Lock()
+
+
+def audio_file_info(name):
+    """Returns an :class:`AudioFileInfo` of the audio file. Inside a
+    :func:`memoize_info` block, the file is read only once and the same object
+    is returned afterwards.
+
+    """
+    memo = getattr(_info_local, 'memo', None)
+    if memo is None:
+        return AudioFileInfo(name)
+    with _info_memo_lock:
+        entry = memo.get(name)
+        if entry is None:
+            entry = memo[name] = _MemoEntry()
+    with entry.lock:
+        if entry.value is None:
+            entry.value = AudioFileInfo(name)
+    return entry.value
+
+
+@contextlib.contextmanager
+def memoize_info():
+    """Returns a context manager in which :func:`audio_file_info`, and thus
+    :func:`tags`, :func:`stream_info` and :func:`flac_md5_equal`, read each
+    file only once. Files must not be modified inside the block. Nested blocks
+    share the memo of the outermost one. The memo is local to the thread (and
+    the threads :func:`audio_equal` starts), and is discarded at the end of
+    the outermost block.
+
+    """
+    if getattr(_info_local, 'memo', None) is not None:
+        yield
+        return
+    _info_local.memo = {}
+    try:
+        yield
+    finally:
+        _info_local.memo = None
+
+
+def _call_with_memo(memo, func, *args):
+    """Calls *func* with *args* as if inside a :func:`memoize_info` block
+    whose memo is *memo*, a :class:`dict` that can be shared with calls in
+    other threads, and returns its return value.
+
+    """
+    previous = getattr(_info_local, 'memo', None)
+    _info_local.memo = memo
+    try:
+        return func(*args)
+    finally:
+        _info_local.memo = previous
 
 
 def _unwrap(x):
@@ -164,11 +1914,179 @@ def is_supported_format(path):
     return get_extension(path) in AUDIO_FORMATS
 
 
+class Statistics(object):
+    """Counters of events that happen while comparing files, such as the
+    number of pairs rejected by :func:`stream_mismatch`, and timers of the
+    phases of comparisons, such as decoding. It can be shared between
+    threads, and timers add up the time spent in all threads, so they may
+    exceed the elapsed time.
+
+    :data:`stats` collects the following counters:
+
+    - ``prefilter_mismatches``: pairs rejected by :func:`stream_mismatch`
+    - ``partial_mismatches``: pairs rejected by :func:`partial_mismatch`
+    - ``cache_hits`` and ``cache_misses``: checksums found and not found in
+      the checksum cache
+    - ``decoded_bytes``: PCM data read from decoders
+    - ``filecmp_bytes``: contents of non-audio files compared by
+      :func:`equal`
+
+    and the following timers:
+
+    - ``ffmpeg_spawn``: starting FFmpeg
+    - ``decode``: decoding and hashing audio streams into checksums
+    - ``hash``: hashing PCM data
+    - ``parse``: reading tags and stream properties with mutagen (see
+      :class:`AudioFileInfo`)
+    - ``filecmp``: comparing non-audio files
+    - ``listdir``: listing directories in the commandline tool
+
+    Other code can record its own counters and timers with :meth:`incr` and
+    :meth:`timer`.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+
+    def incr(self, name, value=1):
+        """Adds *value* to the counter *name*."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        """Adds *seconds* to the timer *name*, and one to the number of times
+        it was run.
+
+        """
+        with self._lock:
+            count, total = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (count + 1, total + seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Returns a context manager that adds the time spent in the block to
+        the timer *name*.
+
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def reset(self):
+        """Resets all counters and timers."""
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+
+    def as_dict(self):
+        """Returns the counters and timers as a :class:`dict` that can be
+        serialized as JSON, with the items ``counters``, a :class:`dict` of
+        values, and ``timers``, a :class:`dict` of :class:`dict`\ s with the
+        items ``count`` and ``seconds``.
+
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': dict((name, {'count': count, 'seconds': seconds})
+                               for name, (count, seconds)
+                               in self.timers.iteritems()),
+            }
+
+    def format(self):
+        """Returns the counters and timers as human-readable lines, sorted by
+        name.
+
+        """
+        with self._lock:
+            lines = ['{0:<24} {1:>12}'.format(name, value)
+                     for name, value in sorted(self.counters.iteritems())]
+            lines.extend('{0:<24} {1:>12.3f} s ({2} times)'.format(
+                name, seconds, count)
+                for name, (count, seconds) in sorted(self.timers.iteritems()))
+        return '\n'.join(lines)
+
+
+#: :class:`Statistics` collected by the functions in this module
+stats = Statistics()
+
+
 def ffmpeg_path():
     """Returns the path to FFmpeg binary."""
     return os.environ.get('FFMPEG_BIN', FFMPEG_BIN)
 
 
+def max_decoders():
+    """Returns the maximum number of audio files decoded at the same time,
+    which is :data:`MAX_DECODERS` (or the number of CPUs if it is ``None``)
+    unless overridden by the ``AUDIODIFF_MAX_DECODERS`` environment variable.
+    ``0`` means no limit.
+
+    """
+    value = os.environ.get('AUDIODIFF_MAX_DECODERS')
+    if value:
+        return int(value)
+    if MAX_DECODERS is None:
+        return _cpu_count()
+    return MAX_DECODERS
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def default_scheduler():
+    """Returns the :class:`~audiodiff.scheduler.DecoderScheduler` shared by
+    all callers, which lets :func:`max_decoders` files be decoded at the same
+    time. :func:`checksum`, :func:`partial_checksum`,
+    :func:`sampled_checksum` and :func:`first_difference` decode files through
+    it.
+
+    """
+    limit = max_decoders()
+    with _schedulers_lock:
+        if limit not in _schedulers:
+            _schedulers[limit] = DecoderScheduler(limit)
+        return _schedulers[limit]
+
+
+def cache_path():
+    """Returns the path to the checksum cache database, which is
+    :data:`CACHE_PATH` unless overridden by the ``AUDIODIFF_CACHE``
+    environment variable. An empty string means caching is disabled.
+
+    """
+    return os.environ.get('AUDIODIFF_CACHE', CACHE_PATH)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def default_cache():
+    """Returns the :class:`~audiodiff.cache.ChecksumCache` at
+    :func:`cache_path`, shared by all callers, or ``None`` if caching is
+    disabled or the cache cannot be opened.
+
+    """
+    path = cache_path()
+    if not path:
+        return None
+    with _caches_lock:
+        if path not in _caches:
+            try:
+                _caches[path] = ChecksumCache(path, CACHE_SIZE)
+            except Exception:
+                # Caching is an optimization; never fail because of it
+                _caches[path] = None
+        return _caches[path]
+
+
 class AudiodiffException(Exception):
     """The root class of all audiodiff-related exceptions."""
 
@@ -181,4 +2099,12 @@ class UnsupportedFileError(AudiodiffException):
 
 
 class ExternalLibraryError(AudiodiffException):
-    """Raised when there is an error during running FFmpeg."""
+    """Raised when FFmpeg or libsndfile fails to decode a file. The last lines
+    FFmpeg wrote to stderr, or the error of libsndfile, are available as
+    :attr:`stderr`.
+
+    """
+
+    def __init__(self, message, stderr=''):
+        AudiodiffException.__init__(self, message)
+        self.stderr = stderr
@@ -0,0 +1,308 @@
+"""
+   audiodiff.aio
+   ~~~~~~~~~~~~~
+
+   This module contains coroutine versions of the comparison functions, for
+   comparing many files from an event loop. It requires trollius, the port of
+   asyncio to Python 2, and the coroutines run in trollius event loops.
+
+   FFmpeg is run with the :meth:`subprocess_exec` method of the event loop
+   and its output is hashed as it arrives. Files decoded in-process, tags and
+   the checksum cache are read in the default executor of the event loop,
+   and each file is parsed once per comparison (see
+   :func:`audiodiff.memoize_info`).
+   Files are decoded through :func:`audiodiff.default_scheduler`, so they count
+   towards the same limit as those decoded in threads. On Unix, the child
+   watcher must be attached to the event loop to be notified when FFmpeg
+   exits, which :func:`trollius.set_event_loop` does.
+
+"""
+import collections
+import functools
+import time
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+import audiodiff
+from . import (STDERR_LINES, STDERR_LINE_LENGTH, PCM_FORMAT, HASH_ALGORITHM,
+               Digest, ExternalLibraryError, is_supported_format, ffmpeg_path,
+               stream_mismatch, flac_md5_equal, negotiate_format,
+               compare_digests, tags_equal, default_scheduler, stats,
+               _call_with_memo, _check_readable, _cache_key, _contents_equal,
+               _cpu_count, _ffmpeg_args, _in_process_reader, _new_hasher,
+               _read_checksum, _set_pipe_size)
+
+
+def _coroutine(func):
+    if asyncio is None:
+        @functools.wraps(func)
+        def unavailable(*args, **kwargs):
+            raise ImportError('trollius is required to use audiodiff.aio')
+        return unavailable
+    return asyncio.coroutine(func)
+
+
+@_coroutine
+def checksum(name, ffmpeg_bin=None, cache=None, timeout=None, decoder=None,
+             loop=None, pcm_format=None, algorithm=None):
+    """Coroutine version of :func:`audiodiff.checksum`."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if ffmpeg_bin is None:
+        ffmpeg_bin = ffmpeg_path()
+    if pcm_format is None:
+        pcm_format = PCM_FORMAT
+    if algorithm is None:
+        algorithm = HASH_ALGORITHM
+    # Fail early if the algorithm is not available
+    _new_hasher(algorithm)
+    yield From(loop.run_in_executor(None, _check_readable, name))
+    cache, key = yield From(loop.run_in_executor(None, _cache_key, name,
+                                                 ffmpeg_bin, cache,
+                                                 pcm_format, algorithm,
+                                                 decoder))
+    if key is not None:
+        digest = yield From(loop.run_in_executor(None, cache.get, key))
+        if digest is not None:
+            stats.incr('cache_hits')
+            raise Return(Digest(digest, pcm_format, algorithm))
+        stats.incr('cache_misses')
+    scheduler = default_scheduler()
+    started = asyncio.Future(loop=loop)
+    token = scheduler.request([name], functools.partial(
+        loop.call_soon_threadsafe, _set_started, started))
+    try:
+        yield From(started)
+        reader = yield From(loop.run_in_executor(None, _in_process_reader,
+                                                 name, decoder, None,
+                                                 pcm_format))
+        if reader is not None:
+            try:
+                digest = yield From(loop.run_in_executor(None, _read_checksum,
+                                                         reader, algorithm))
+            except asyncio.CancelledError:
+                # Stop the executor job, which closes the reader
+                reader.abort()
+                raise
+        else:
+            with stats.timer('decode'):
+                digest = yield From(_ffmpeg_checksum(name, ffmpeg_bin,
+                                                     timeout, loop,
+                                                     pcm_format, algorithm))
+    finally:
+        scheduler.release(token)
+    if key is not None:
+        yield From(loop.run_in_executor(None, cache.set, key, digest))
+    raise Return(Digest(digest, pcm_format, algorithm))
+
+
+def _set_started(future):
+    # The future is cancelled if the coroutine was cancelled while waiting
+    if not future.done():
+        future.set_result(None)
+
+
+@_coroutine
+def _ffmpeg_checksum(name, ffmpeg_bin, timeout, loop, pcm_format, algorithm):
+    """Decodes the audio file with FFmpeg into *pcm_format* and returns a
+    checksum of the PCM data made with *algorithm*. Raises
+    :exc:`~audiodiff.ExternalLibraryError` in the same cases as
+    :func:`audiodiff.checksum`.
+
+    """
+    if timeout is None:
+        timeout = audiodiff.DECODE_TIMEOUT
+    finished = asyncio.Future(loop=loop)
+    with stats.timer('ffmpeg_spawn'):
+        transport, protocol = yield From(loop.subprocess_exec(
+            lambda: _DecoderProtocol(finished, algorithm),
+            *_ffmpeg_args(name, ffmpeg_bin, None, pcm_format), stdin=None))
+    try:
+        fd = transport.get_pipe_transport(1).get_extra_info('pipe').fileno()
+    except (AttributeError, ValueError):
+        # FFmpeg has already exited and the pipe is closed
+        pass
+    else:
+        _set_pipe_size(fd, audiodiff.PIPE_SIZE)
+    try:
+        yield From(asyncio.wait([finished], timeout=timeout, loop=loop))
+        timed_out = not finished.done()
+    finally:
+        if not finished.done():
+            try:
+                transport.kill()
+            except OSError:
+                # Already exited
+                pass
+            yield From(asyncio.wait([finished], loop=loop))
+        transport.close()
+        stats.incr('decoded_bytes', protocol.size)
+        stats.add_time('hash', protocol.hash_time)
+    if timed_out:
+        raise ExternalLibraryError(
+            'decoding {0} timed out after {1} seconds'.format(
+                repr(name), timeout), protocol.stderr)
+    if not protocol.size:
+        raise ExternalLibraryError(
+            'failed to decode {0}: {1}'.format(
+                repr(name), protocol.stderr.strip() or 'no output'),
+            protocol.stderr)
+    raise Return(protocol.hasher.hexdigest())
+
+
+class _DecoderProtocol(asyncio.SubprocessProtocol if asyncio else object):
+    """Hashes the PCM data FFmpeg writes to stdout with *algorithm* as it
+    arrives, and keeps the last :data:`~audiodiff.STDERR_LINES` lines it
+    writes to stderr, like :class:`audiodiff._FFmpegProcess`. *finished* is
+    set when the process has exited and both pipes are closed. :attr:`size`
+    is the number of bytes hashed and :attr:`hash_time` the time spent
+    hashing them.
+
+    """
+
+    def __init__(self, finished, algorithm=None):
+        self.finished = finished
+        self.hasher = _new_hasher(algorithm)
+        self.size = 0
+        self.hash_time = 0.0
+        self._stderr = collections.deque(maxlen=STDERR_LINES)
+        self._line = ''
+
+    @property
+    def stderr(self):
+        """The last lines FFmpeg wrote to stderr."""
+        return ''.join(self._stderr) + self._line
+
+    def pipe_data_received(self, fd, data):
+        if fd == 1:
+            start = time.time()
+            self.hasher.update(data)
+            self.hash_time += time.time() - start
+            self.size += len(data)
+            return
+        lines = (self._line + data).split('\n')
+        for line in lines[:-1]:
+            self._append_line(line + '\n')
+        self._line = lines[-1]
+        while len(self._line) >= STDERR_LINE_LENGTH:
+            self._stderr.append(self._line[:STDERR_LINE_LENGTH])
+            self._line = self._line[STDERR_LINE_LENGTH:]
+
+    def _append_line(self, line):
+        # Split long lines as readline(STDERR_LINE_LENGTH) does
+        for i in xrange(0, len(line), STDERR_LINE_LENGTH):
+            self._stderr.append(line[i:i + STDERR_LINE_LENGTH])
+
+    def connection_lost(self, exc):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+
+@_coroutine
+def audio_equal(name1, name2, ffmpeg_bin=None, cache=None, timeout=None,
+                decoder=None, flac_md5=False, prefilter=True, loop=None,
+                algorithm=None):
+    """Coroutine version of :func:`audiodiff.audio_equal`. The two files are
+    decoded concurrently, and if decoding one of them fails, decoding the
+    other one is cancelled. Streaming comparison and partial checksums are
+    not supported.
+
+    """
+    rv = yield From(_audio_equal({}, name1, name2, ffmpeg_bin, cache,
+                                 timeout, decoder, flac_md5, prefilter, loop,
+                                 algorithm))
+    raise Return(rv)
+
+
+@_coroutine
+def _audio_equal(memo, name1, name2, ffmpeg_bin=None, cache=None,
+                 timeout=None, decoder=None, flac_md5=False, prefilter=True,
+                 loop=None, algorithm=None):
+    """Implements :func:`audio_equal`, parsing files in the executor with
+    *memo* (see :func:`audiodiff._call_with_memo`).
+
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if prefilter:
+        mismatch = yield From(loop.run_in_executor(
+            None, _call_with_memo, memo, stream_mismatch, name1, name2))
+        if mismatch is not None:
+            raise Return(False)
+    if flac_md5:
+        rv = yield From(loop.run_in_executor(
+            None, _call_with_memo, memo, flac_md5_equal, name1, name2))
+        if rv is not None:
+            raise Return(rv)
+    pcm_format = yield From(loop.run_in_executor(
+        None, _call_with_memo, memo, negotiate_format, name1, name2))
+    tasks = [asyncio.ensure_future(checksum(name, ffmpeg_bin, cache, timeout,
+                                            decoder, loop, pcm_format,
+                                            algorithm), loop=loop)
+             for name in (name1, name2)]
+    try:
+        yield From(asyncio.wait(tasks, loop=loop,
+                                return_when=asyncio.FIRST_EXCEPTION))
+    finally:
+        # Cancelling a checksum kills its decoder; wait until it is dead
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            yield From(asyncio.wait(pending, loop=loop))
+    # Reraise the error of the checksum that failed, not the cancellation
+    failed = [task for task in tasks
+              if not task.cancelled() and task.exception() is not None]
+    if failed:
+        failed[0].result()
+    checksum1, checksum2 = [task.result() for task in tasks]
+    raise Return(compare_digests(checksum1, checksum2))
+
+
+@_coroutine
+def equal(name1, name2, ffmpeg_bin=None, loop=None, **kwargs):
+    """Coroutine version of :func:`audiodiff.equal`. Other keyword arguments
+    are passed to :func:`audio_equal`.
+
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if is_supported_format(name1) and is_supported_format(name2):
+        # Each file is parsed once, as in a memoize_info() block
+        memo = {}
+        rv = yield From(_audio_equal(memo, name1, name2, ffmpeg_bin,
+                                     loop=loop, **kwargs))
+        if rv:
+            rv = yield From(loop.run_in_executor(
+                None, _call_with_memo, memo, tags_equal, name1, name2))
+    else:
+        rv = yield From(loop.run_in_executor(None, _contents_equal, name1,
+                                             name2))
+    raise Return(rv)
+
+
+@_coroutine
+def compare_many(pairs, limit=None, loop=None, **kwargs):
+    """Coroutine version of :func:`audiodiff.compare_many`. At most *limit*
+    pairs, which defaults to the number of CPUs, are compared at a time. Other
+    keyword arguments are passed to :func:`equal`.
+
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if limit is None:
+        limit = _cpu_count()
+    semaphore = asyncio.Semaphore(max(1, limit), loop=loop)
+
+    @asyncio.coroutine
+    def compare(name1, name2):
+        with (yield From(semaphore)):
+            rv = yield From(equal(name1, name2, loop=loop, **kwargs))
+        raise Return(rv)
+    results = yield From(asyncio.gather(
+        *[compare(name1, name2) for name1, name2 in pairs], loop=loop))
+    raise Return(results)
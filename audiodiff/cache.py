@@ -0,0 +1,147 @@
+"""
+   audiodiff.cache
+   ~~~~~~~~~~~~~~~
+
+   This module contains a persistent cache for audio stream checksums.
+
+"""
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+class ChecksumCache(object):
+    """A persistent cache of checksums stored in an SQLite database at *path*.
+    Checksums are keyed by the identity of the file (real path, inode, size
+    and modification time), the decoder that produced the PCM data, the PCM
+    format and the hash algorithm, so an entry is never used once the file or
+    the decoder has changed. If *max_entries* is given, least recently used
+    entries are removed when the cache grows larger than that.
+
+    An instance can be shared between threads.
+
+    """
+
+    #: Number of insertions between two automatic calls to :meth:`prune`
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, path, max_entries=None):
+        if sqlite3 is None:
+            raise ImportError('sqlite3 is required to cache checksums')
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._conn = sqlite3.connect(path, timeout=30,
+                                     check_same_thread=False)
+        self._conn.text_factory = str
+        with self._conn:
+            columns = [row[1] for row in self._conn.execute(
+                'PRAGMA table_info(checksums)')]
+            if columns and 'algorithm' not in columns:
+                # Written by a version that only used SHA1
+                self._conn.execute('DROP TABLE checksums')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS checksums (
+                    path TEXT NOT NULL,
+                    inode INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    decoder TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    atime REAL NOT NULL,
+                    PRIMARY KEY (path, inode, size, mtime, decoder, format,
+                                 algorithm)
+                )""")
+            self._conn.execute("""
+                CREATE INDEX IF NOT EXISTS checksums_atime
+                ON checksums (atime)""")
+
+    def key(self, name, decoder, format, algorithm='sha1'):
+        """Returns a key for the file *name* decoded by *decoder* (a string
+        identifying the decoder and its version) into *format* and hashed with
+        *algorithm*. The key should be made before the file is decoded, so
+        that changes made to the file while decoding it invalidate the entry.
+
+        """
+        st = os.stat(name)
+        mtime = getattr(st, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 1000000000)
+        return (os.path.realpath(name), st.st_ino, st.st_size, mtime,
+                decoder, format, algorithm)
+
+    def get(self, key):
+        """Returns the checksum stored for *key*, or ``None`` if there is
+        none.
+
+        """
+        with self._lock:
+            with self._conn:
+                row = self._conn.execute("""
+                    SELECT digest FROM checksums
+                    WHERE path = ? AND inode = ? AND size = ? AND mtime = ?
+                      AND decoder = ? AND format = ? AND algorithm = ?""",
+                    key).fetchone()
+                if row is None:
+                    return None
+                self._conn.execute("""
+                    UPDATE checksums SET atime = ?
+                    WHERE path = ? AND inode = ? AND size = ? AND mtime = ?
+                      AND decoder = ? AND format = ? AND algorithm = ?""",
+                    (time.time(),) + key)
+        return row[0]
+
+    def set(self, key, digest):
+        """Stores *digest* for *key*."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("""
+                    INSERT OR REPLACE INTO checksums
+                    (path, inode, size, mtime, decoder, format, algorithm,
+                     digest, atime)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    key + (digest, time.time()))
+            self._inserts += 1
+            if self._inserts % self.PRUNE_INTERVAL == 0:
+                self._prune()
+
+    def prune(self):
+        """Removes least recently used entries until there are at most
+        :attr:`max_entries` entries.
+
+        """
+        with self._lock:
+            self._prune()
+
+    def _prune(self):
+        if self.max_entries is None:
+            return
+        with self._conn:
+            self._conn.execute("""
+                DELETE FROM checksums WHERE rowid IN (
+                    SELECT rowid FROM checksums
+                    ORDER BY atime DESC LIMIT -1 OFFSET ?)""",
+                (self.max_entries,))
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM checksums')
+
+    def close(self):
+        """Prunes the cache and closes the database."""
+        self.prune()
+        with self._lock:
+            self._conn.close()
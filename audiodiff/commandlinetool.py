@@ -6,19 +6,34 @@
 
 """
 import argparse
+import functools
 import itertools
+import json
 import locale
+import math
 import operator
 import os
 import sys
+import threading
+import time
 import traceback
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 try:
     import termcolor
 except ImportError:
     termcolor = None
 
-from . import __version__, is_supported_format, equal, audio_equal, tags
+from . import (__version__, CACHE_SIZE, DECODERS, HASH_ALGORITHMS,
+               HASH_ALGORITHM, is_supported_format, equal, audio_equal,
+               first_difference, diff_audio, flac_md5_equal, stream_mismatch,
+               partial_mismatch, checksum, compare_digests, negotiate_format,
+               tags, default_cache, memoize_info, stats, _exact_format,
+               _PCM_SIZES)
+from .dupes import find_duplicates
+from .manifest import (Manifest, update_manifest, is_manifest, file_checksum,
+                       normalize_tags)
 
 
 if sys.stdout.isatty() and termcolor is not None:
@@ -38,6 +53,60 @@ FALLBACK_ENCODING = 'UTF-8'
 LOCALE_ENCODING = locale.getdefaultlocale()[1]
 
 
+#: Formats of the statistics printed with ``--stats``
+STATS_FORMATS = ['text', 'json']
+
+
+def _add_decoding_arguments(parser):
+    """Adds arguments that control how audio files are decoded to
+    *parser*.
+
+    """
+    parser.add_argument(
+        '--ffmpeg_bin',
+        metavar='path',
+        help='specify ffmpeg binary path')
+    parser.add_argument(
+        '--decoder',
+        choices=DECODERS,
+        help='specify how to decode audio files; '
+             'all decoders produce the same results (default: auto)')
+    parser.add_argument(
+        '--hash',
+        choices=HASH_ALGORITHMS,
+        dest='algorithm',
+        help='specify the algorithm to hash audio streams with; some require '
+             'optional libraries (default: {0})'.format(HASH_ALGORITHM))
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        metavar='seconds',
+        help='give up decoding an audio file after the specified time')
+    parser.add_argument(
+        '--no-cache',
+        action='store_false',
+        dest='use_cache',
+        help='do not read or write the checksum cache')
+    parser.add_argument(
+        '--clear-cache',
+        action='store_true',
+        help='remove all entries in the checksum cache before comparing')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        metavar='N',
+        help='keep at most N checksums in the cache '
+             '(default: {0})'.format(CACHE_SIZE))
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='text',
+        choices=STATS_FORMATS,
+        help='print counters and the time spent in each phase, such as '
+             'starting FFmpeg, decoding, hashing and reading tags, to stderr '
+             'at exit, as text or JSON (default: text)')
+
+
 #: An :class:`argparse.ArgumentParser`
 parser = argparse.ArgumentParser(
     prog='audiodiff',
@@ -48,7 +117,8 @@ For example, `audiodiff x y` would compare `x/a.flac` and `y/a.m4a`. Audio
 files are considered equal if they have the same uncompressed audio streams and
 normalized tags (except for `encodedby` tag) reported by mutagenwrapper;
 non-audio files as well as unsupported audio files are equal if they are
-exactly equal, bit by bit.
+exactly equal, bit by bit. Either side can also be a manifest written by
+`audiodiff index`, in which case the files recorded in it are not read again.
 """.format(__version__),
     epilog='version {0}'.format(__version__))
 parser.add_argument(
@@ -65,6 +135,22 @@ parser.add_argument(
     action='store_true',
     help='compare only tags; '
          'useful since comparing audio streams could be slow')
+parser.add_argument(
+    '-e', '--early-exit',
+    action='store_true',
+    help='compare audio streams while decoding them and stop at the first '
+         'difference, reporting its offset')
+parser.add_argument(
+    '--audio-report',
+    action='store_true',
+    help='when audio streams differ, report the first and last differing '
+         'samples, how many samples differ and by how much, for each channel '
+         'as well (requires numpy)')
+parser.add_argument(
+    '--align',
+    action='store_true',
+    help='with --audio-report, align audio streams to ignore encoder delay '
+         'and padding before comparing samples, and report the offset')
 parser.add_argument(
     '-q', '--brief',
     action='store_true',
@@ -75,23 +161,225 @@ parser.add_argument(
     dest='verbose',
     help='report when two files are the same')
 parser.add_argument(
-    '--ffmpeg_bin',
+    '-j', '--jobs',
+    type=int,
+    default=1,
+    metavar='N',
+    help='compare up to N pairs of files in parallel when comparing '
+         'directories (default: 1)')
+parser.add_argument(
+    '--no-prefilter',
+    action='store_false',
+    dest='prefilter',
+    help='do not compare sample rates, numbers of channels and numbers of '
+         'samples in headers before decoding audio files')
+parser.add_argument(
+    '--partial',
+    action='store_true',
+    help='compare the beginnings and a few short segments of audio streams '
+         'before decoding them fully, to find differences quickly')
+parser.add_argument(
+    '--flac-md5',
+    action='store_true',
+    help='compare MD5 signatures stored in FLAC files instead of decoding '
+         'them when possible')
+_add_decoding_arguments(parser)
+
+
+#: An :class:`argparse.ArgumentParser` for ``audiodiff index``
+index_parser = argparse.ArgumentParser(
+    prog='audiodiff index',
+    description="""
+Record checksums of audio streams, tags and checksums of other files in a
+directory to a manifest, which can be compared with another directory later
+with `audiodiff manifest dir` or `audiodiff dir manifest`.
+""",
+    epilog='version {0}'.format(__version__))
+index_parser.add_argument(
+    'dir',
+    help='directory to index')
+index_parser.add_argument(
+    'manifest',
+    help='file to write the manifest to')
+index_parser.add_argument(
+    '-j', '--jobs',
+    type=int,
+    default=1,
+    metavar='N',
+    help='decode up to N audio files in parallel (default: 1)')
+index_parser.add_argument(
+    '-u', '--update',
+    action='store_true',
+    help='if the manifest exists, read only new files and files whose sizes '
+         'or modification times have changed, and report how many files '
+         'were read')
+_add_decoding_arguments(index_parser)
+
+
+#: An :class:`argparse.ArgumentParser` for ``audiodiff dupes``
+dupes_parser = argparse.ArgumentParser(
+    prog='audiodiff dupes',
+    description="""
+Find audio files with identical audio streams in files and directories,
+whatever their names and formats, and print each group of duplicates followed
+by a blank line. Files are compared by stream properties in headers first, then
+by checksums of the first seconds of audio, and only then fully decoded.
+""",
+    epilog='version {0}'.format(__version__))
+dupes_parser.add_argument(
+    'paths',
     metavar='path',
-    help='specify ffmpeg binary path')
+    nargs='+',
+    help='files or directories to search')
+dupes_parser.add_argument(
+    '-j', '--jobs',
+    type=int,
+    default=1,
+    metavar='N',
+    help='decode up to N audio files in parallel (default: 1)')
+_add_decoding_arguments(dupes_parser)
 
 
 def main_func(args=None):
     """The entry point for the ``audiodiff`` command line tool. Parses the
-    command arguments and calls :func:`diff_checked`.
+    command arguments and calls :func:`diff_checked`, or :func:`index_main`
+    or :func:`dupes_main` if the first argument is ``index`` or ``dupes``.
 
     """
+    if args is None:
+        args = sys.argv[1:]
     try:
+        if args and args[0] == 'index':
+            return index_main(args[1:])
+        elif args and args[0] == 'dupes':
+            return dupes_main(args[1:])
         options = parser.parse_args(args)
-        return diff_checked(options.files[0], options.files[1], options)
+        if options.align and not options.audio_report:
+            parser.error('--align requires --audio-report')
+        start = _start_stats()
+        options.cache = _checksum_cache(options)
+        options.manifests = {}
+        try:
+            return diff_checked(options.files[0], options.files[1], options)
+        finally:
+            if options.cache:
+                options.cache.prune()
+            _print_stats(options, start)
     except KeyboardInterrupt:
         return 130
 
 
+def index_main(args):
+    """Parses the arguments of ``audiodiff index``, and writes a manifest of
+    the directory.
+
+    """
+    options = index_parser.parse_args(args)
+    if not os.path.isdir(options.dir):
+        _print_error('Not a directory: {0}'.format(repr(options.dir)))
+        return 2
+    start = _start_stats()
+    options.cache = _checksum_cache(options)
+    try:
+        if options.update and os.path.exists(options.manifest):
+            manifest = Manifest.read(options.manifest)
+        else:
+            manifest = Manifest()
+        manifest, rehashed, reused = update_manifest(
+            manifest, options.dir, options.jobs,
+            ffmpeg_bin=options.ffmpeg_bin, cache=options.cache,
+            timeout=options.timeout, decoder=options.decoder,
+            algorithm=options.algorithm)
+        manifest.write(options.manifest)
+        if options.update:
+            _print(u'Read {0} files, reused {1} files'.format(rehashed,
+                                                            reused))
+    except IOError as e:
+        _print_error('{0}: {1}'.format(e.strerror, repr(e.filename)))
+        return 2
+    except Exception as e:
+        _print_error('an error occurred while indexing {0}'.format(
+            repr(options.dir)))
+        _output(sys.stderr, traceback.format_exc().rstrip('\n'))
+        return 2
+    finally:
+        if options.cache:
+            options.cache.prune()
+        _print_stats(options, start)
+    return 0
+
+
+def dupes_main(args):
+    """Parses the arguments of ``audiodiff dupes``, and prints groups of
+    duplicate audio files. Paths that do not exist and files that cannot be
+    decoded are reported and skipped, and the exit status is 2.
+
+    """
+    options = dupes_parser.parse_args(args)
+    start = _start_stats()
+    options.cache = _checksum_cache(options)
+    errors = []
+
+    def onerror(name, exc_info):
+        errors.append(name)
+        _print_error('failed to read {0}: {1}'.format(repr(name),
+                                                      exc_info[1]))
+    try:
+        try:
+            groups = find_duplicates(options.paths, options.jobs,
+                                     options.ffmpeg_bin, options.cache,
+                                     options.timeout, options.decoder,
+                                     onerror, options.algorithm)
+        finally:
+            if options.cache:
+                options.cache.prune()
+        for group in groups:
+            for name in group:
+                _print(_decode_path(name))
+            _print(u'')
+    finally:
+        _print_stats(options, start)
+    return 2 if errors else 0
+
+
+def _start_stats():
+    """Resets :data:`audiodiff.stats` and returns the current time."""
+    stats.reset()
+    return time.time()
+
+
+def _print_stats(options, start):
+    """Prints :data:`audiodiff.stats` and the time elapsed since *start* to
+    stderr if ``--stats`` is given.
+
+    """
+    if not options.stats:
+        return
+    elapsed = time.time() - start
+    if options.stats == 'json':
+        summary = stats.as_dict()
+        summary['elapsed'] = elapsed
+        _output(sys.stderr, json.dumps(summary, sort_keys=True))
+        return
+    _output(sys.stderr, '{0:<24} {1:>12.3f} s'.format('elapsed', elapsed))
+    lines = stats.format()
+    if lines:
+        _output(sys.stderr, lines)
+
+
+def _checksum_cache(options):
+    if not options.use_cache:
+        return False
+    cache = default_cache()
+    if cache is None:
+        return False
+    if options.cache_size is not None:
+        cache.max_entries = options.cache_size
+    if options.clear_cache:
+        cache.clear()
+    return cache
+
+
 def diff_checked(path1, path2, options):
     """Calls :func:`diff_recurse` and handles exceptions if raised."""
     try:
@@ -102,14 +390,24 @@ def diff_checked(path1, path2, options):
     except Exception as e:
         _print_error('an error occurred while processing {0} and {1}'.format(
             repr(path1), repr(path2)))
-        traceback.print_exc()
+        _output(sys.stderr, traceback.format_exc().rstrip('\n'))
         return 2
 
 
 def diff_recurse(path1, path2, options):
-    """Recursively compares files in the specified paths."""
-    type1 = _get_type(path1)
-    type2 = _get_type(path2)
+    """Recursively compares files in the specified paths. A manifest given
+    in place of a directory is loaded into ``options.manifests`` and compared
+    as if it were the directory it was made from.
+
+    """
+    type1 = _get_type(path1, options)
+    type2 = _get_type(path2, options)
+    if type1 == 'file' and type2 == 'dir' and is_manifest(path1):
+        options.manifests[path1] = Manifest.read(path1)
+        type1 = 'dir'
+    elif type1 == 'dir' and type2 == 'file' and is_manifest(path2):
+        options.manifests[path2] = Manifest.read(path2)
+        type2 = 'dir'
     if type1 == 'file' and type2 == 'file':
         return diff_files(path1, path2, options)
     elif type1 == 'dir' and type2 == 'dir':
@@ -131,7 +429,14 @@ def diff_recurse(path1, path2, options):
     return 2
 
 
-def _get_type(name):
+def _get_type(name, options=None):
+    manifest, relname = _manifest_path(name, options)
+    if manifest is not None:
+        if relname in manifest.entries:
+            return 'file'
+        elif manifest.isdir(relname):
+            return 'dir'
+        return 'nonexistent'
     if os.path.isfile(name):
         return 'file'
     elif os.path.isdir(name):
@@ -140,51 +445,324 @@ def _get_type(name):
         return 'nonexistent'
 
 
+def _manifest_path(name, options):
+    """Returns a tuple (*manifest*, *relname*) if *name* is inside one of
+    the manifests in ``options.manifests``, or ``(None, None)`` otherwise.
+
+    """
+    for path, manifest in getattr(options, 'manifests', {}).iteritems():
+        if name == path:
+            return manifest, ''
+        elif name.startswith(path + os.sep):
+            return manifest, name[len(path) + 1:].replace(os.sep, '/')
+    return None, None
+
+
+def _manifest_entry(name, options):
+    manifest, relname = _manifest_path(name, options)
+    if manifest is None:
+        return None
+    return manifest.entries[relname]
+
+
 def diff_files(path1, path2, options):
     """Compares the two files and prints the results."""
+    with memoize_info():
+        return _diff_files(path1, path2, options)
+
+
+def _diff_files(path1, path2, options):
+    entry1 = _manifest_entry(path1, options)
+    entry2 = _manifest_entry(path2, options)
+    if entry1 is not None or entry2 is not None:
+        return diff_indexed(path1, path2, entry1, entry2, options)
     if is_supported_format(path1) and is_supported_format(path2):
-        if options.streams:
-            return diff_streams(path1, path2, options.verbose,
-                                options.ffmpeg_bin)
-        elif options.tags:
-            return diff_tags(path1, path2, options.verbose, options.brief)
-        else:
-            return max(diff_streams(path1, path2, options.verbose,
-                                    options.ffmpeg_bin),
-                       diff_tags(path1, path2, options.verbose, options.brief))
+        ret = 0
+        if options.streams or not options.tags:
+            ret = diff_streams(path1, path2, options.verbose,
+                               options.ffmpeg_bin, options.cache,
+                               options.early_exit, options.timeout,
+                               options.decoder, options.flac_md5,
+                               options.prefilter, options.partial,
+                               options.audio_report, options.align,
+                               options.algorithm)
+        if not options.streams:
+            ret = max(ret, diff_tags(path1, path2, options.verbose,
+                                     options.brief))
+        return ret
     else:
         return diff_binary(path1, path2, options.verbose)
 
 
+def diff_indexed(path1, path2, entry1, entry2, options):
+    """Compares the two files, either of which is recorded in a manifest as
+    *entry1* or *entry2* (the other being ``None``), and prints the results.
+    Checksums and tags are taken from the manifest instead of the file, and
+    the other file is decoded into the PCM format and hashed with the
+    algorithm recorded in the manifest. If the two files would be compared in
+    another PCM format (see :func:`~audiodiff.negotiate_format`), the indexed
+    file is decoded too, if it is still in the indexed directory.
+
+    """
+    if is_supported_format(path1) and is_supported_format(path2):
+        ret = 0
+        if options.streams or not options.tags:
+            if entry1 is not None:
+                checksums = _indexed_checksums(path1, entry1, path2, options)
+            else:
+                checksums = _indexed_checksums(path2, entry2, path1, options)
+            if checksums is None:
+                _print_error(
+                    'cannot compare audio streams in {0} and {1}: the '
+                    'manifest records a {2} checksum and the indexed file is '
+                    'not available'.format(
+                        repr(path1), repr(path2),
+                        (entry1 or entry2).pcm_format))
+                ret = 2
+            else:
+                ret = _report_streams(path1, path2,
+                                      compare_digests(*checksums),
+                                      options.verbose)
+        if not options.streams:
+            tags1, tags2 = [
+                entry.tags if entry is not None else normalize_tags(tags(path))
+                for path, entry in [(path1, entry1), (path2, entry2)]]
+            ret = max(ret, _report_tags(path1, path2, tags1, tags2,
+                                        options.verbose, options.brief))
+        return ret
+    else:
+        checksum1, checksum2 = [
+            entry.checksum if entry is not None else file_checksum(path)
+            for path, entry in [(path1, entry1), (path2, entry2)]]
+        return _report_binary(path1, path2, checksum1 == checksum2,
+                              options.verbose)
+
+
+def _indexed_checksums(indexed_path, entry, path, options):
+    """Returns a tuple of the checksums of the file *indexed_path*, recorded
+    in a manifest as *entry*, and of the file *path*, in the same PCM format
+    and made with the algorithm of the entry, or ``None`` if they cannot be
+    made.
+
+    """
+    source = _indexed_source(indexed_path, entry, options)
+    if source is not None:
+        pcm_format = negotiate_format(source, path)
+    elif _exact_format(path, entry.pcm_format):
+        pcm_format = entry.pcm_format
+    else:
+        # The file has more bits per sample than the stream recorded in the
+        # manifest, so they cannot be compared by checksum
+        return None
+    if pcm_format == entry.pcm_format:
+        indexed = entry.digest
+    else:
+        indexed = checksum(source, options.ffmpeg_bin, options.cache,
+                           options.timeout, options.decoder, pcm_format,
+                           entry.algorithm)
+    return indexed, checksum(path, options.ffmpeg_bin, options.cache,
+                             options.timeout, options.decoder, pcm_format,
+                             entry.algorithm)
+
+
+def _indexed_source(path, entry, options):
+    """Returns the name of the file recorded as *entry* at *path* in a
+    manifest, if it is still in the indexed directory, unchanged.
+
+    """
+    manifest, relname = _manifest_path(path, options)
+    if manifest.root is None:
+        return None
+    name = os.path.join(manifest.root, *relname.split('/'))
+    try:
+        st = os.stat(name)
+    except OSError:
+        return None
+    if st.st_size != entry.size or st.st_mtime != entry.mtime:
+        return None
+    return name
+
+
 def diff_dirs(path1, path2, options):
-    """Compares the two directories and prints the results."""
+    """Compares the two directories and prints the results. If
+    ``options.jobs`` is greater than 1, pairs of files are compared in a pool
+    of that many worker threads, but the results are still printed in the
+    same order as they would be without it.
+
+    """
+    tasks = _dir_tasks(path1, path2, options)
     ret = 0
-    cnames1 = _cnames(path1)
-    cnames2 = _cnames(path2)
+    if options.jobs > 1:
+        tasks = list(tasks)
+        pool = ThreadPool(options.jobs)
+        try:
+            for rv, lines in _interruptible(pool.imap(_run_captured, tasks)):
+                for file, line in lines:
+                    _output(file, line)
+                ret = max(ret, rv)
+        finally:
+            pool.terminate()
+    else:
+        for task in tasks:
+            ret = max(ret, task())
+    return ret
+
+
+def _interruptible(results):
+    """Yields the results of :meth:`ThreadPool.imap`. Waiting for a result
+    without a timeout cannot be interrupted by Ctrl-C in Python 2, so this
+    waits for a second at a time instead.
+
+    """
+    while True:
+        try:
+            yield results.next(1)
+        except TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+
+def _dir_tasks(path1, path2, options):
+    """Yields callables that compare the files in the two directories (and
+    their subdirectories) and print the results, in the order they should be
+    printed. Each callable returns an exit code.
+
+    """
+    cnames1 = _cnames(path1, options)
+    cnames2 = _cnames(path2, options)
     for cname in sorted(set(cnames1.iterkeys()) | set(cnames2.iterkeys())):
         names1 = cnames1.get(cname)
         names2 = cnames2.get(cname)
         if not names1:
             for name in names2:
-                _print(u'Only in {0}: {1}'.format(_decode_path(path2),
-                                                  _decode_path(name)))
-                ret = max(ret, 1)
+                yield functools.partial(_print_only_in, path2, name)
         elif not names2:
             for name in names1:
-                _print(u'Only in {0}: {1}'.format(_decode_path(path1),
-                                                  _decode_path(name)))
-                ret = max(ret, 1)
+                yield functools.partial(_print_only_in, path1, name)
+        elif _can_diff_group(path1, names1, path2, names2, options):
+            yield functools.partial(diff_group, path1, names1, path2, names2,
+                                    options)
         else:
             for name1, name2 in itertools.product(names1, names2):
                 np1 = os.path.join(path1, name1)
                 np2 = os.path.join(path2, name2)
-                ret = max(ret, diff_checked(np1, np2, options))
+                if (_get_type(np1, options) == 'dir' and
+                        _get_type(np2, options) == 'dir'):
+                    try:
+                        subtasks = list(_dir_tasks(np1, np2, options))
+                    except Exception:
+                        # Let diff_checked() fail again and report the error
+                        subtasks = [functools.partial(diff_checked, np1, np2,
+                                                      options)]
+                    for task in subtasks:
+                        yield task
+                else:
+                    yield functools.partial(diff_checked, np1, np2, options)
+
+
+def _can_diff_group(path1, names1, path2, names2, options):
+    if (len(names1) * len(names2) < 2 or options.early_exit or
+            options.audio_report):
+        return False
+    if options.tags and not options.streams:
+        return False
+    for path, names in [(path1, names1), (path2, names2)]:
+        for name in names:
+            np = os.path.join(path, name)
+            if (not is_supported_format(name) or
+                    _manifest_path(np, options)[0] is not None or
+                    _get_type(np) != 'file'):
+                return False
+    return True
+
+
+def diff_group(path1, names1, path2, names2, options):
+    """Compares each audio file *names1* in *path1* with each audio file
+    *names2* in *path2* (e.g. ``a.flac`` and ``a.m4a`` with ``a.flac``,
+    ``a.m4a`` and ``a.mp3``) and prints the results for each pair as
+    :func:`diff_files` does. Instead of decoding two files for each pair, each
+    file is decoded at most once and pairs are compared by checksum.
+
+    """
+    pairs = [(os.path.join(path1, name1), os.path.join(path2, name2))
+             for name1, name2 in itertools.product(names1, names2)]
+    with memoize_info():
+        return _diff_group(pairs, options)
+
+
+def _diff_group(pairs, options):
+    try:
+        results = _group_results(pairs, options)
+    except Exception:
+        # Compare pair by pair to report errors as diff_checked() does
+        return max(diff_checked(np1, np2, options) for np1, np2 in pairs)
+    ret = 0
+    for pair in pairs:
+        identical, mismatch = results[pair]
+        if mismatch is not None:
+            ret = max(ret, _report_mismatch(pair[0], pair[1], mismatch))
+        else:
+            ret = max(ret, _report_streams(pair[0], pair[1], identical,
+                                           options.verbose))
+        if not options.streams:
+            ret = max(ret, diff_tags(pair[0], pair[1], options.verbose,
+                                     options.brief))
     return ret
 
 
-def _cnames(d):
-    names = os.listdir(d)
-    names.sort()
+def _group_results(pairs, options):
+    """Returns a dictionary that maps each pair of files to a tuple
+    (*identical*, *mismatch*) for :func:`diff_group`.
+
+    """
+    results = {}
+    undecided = []
+    for pair in pairs:
+        mismatch = stream_mismatch(*pair) if options.prefilter else None
+        identical = None
+        if mismatch is None and options.flac_md5:
+            identical = flac_md5_equal(*pair)
+        # Partial checksums are not compared here, since every file in the
+        # group is decoded at most once anyway
+        if mismatch is None and identical is None:
+            undecided.append(pair)
+        results[pair] = identical, mismatch
+    # Files are decoded one at a time, since with -j the group is already
+    # compared in one of the worker threads of diff_dirs()
+    names = sorted(set(itertools.chain.from_iterable(undecided)))
+    pcm_format = negotiate_format(*names)
+    digests = {}
+    for name in names:
+        digests[name] = checksum(name, options.ffmpeg_bin, options.cache,
+                                 options.timeout, options.decoder, pcm_format,
+                                 options.algorithm)
+    for np1, np2 in undecided:
+        results[np1, np2] = compare_digests(digests[np1], digests[np2]), None
+    return results
+
+
+def _print_only_in(path, name):
+    _print(u'Only in {0}: {1}'.format(_decode_path(path), _decode_path(name)))
+    return 1
+
+
+def _run_captured(task):
+    _captured.lines = []
+    try:
+        return task(), _captured.lines
+    finally:
+        _captured.lines = None
+
+
+def _cnames(d, options=None):
+    manifest, relname = _manifest_path(d, options)
+    if manifest is not None:
+        names = manifest.listdir(relname)
+    else:
+        with stats.timer('listdir'):
+            names = os.listdir(d)
+        names.sort()
     cnames = {}
     for name in names:
         if is_supported_format(name):
@@ -195,11 +773,81 @@ def _cnames(d):
     return cnames
 
 
-def diff_streams(path1, path2, verbose=False, ffmpeg_bin=None):
-    """Prints whether the two audio files' streams differ or are identical."""
-    if not audio_equal(path1, path2, ffmpeg_bin):
-        _print(u'Audio streams in {0} and {1} differ'.format(
-            _decode_path(path1), _decode_path(path2)))
+def diff_streams(path1, path2, verbose=False, ffmpeg_bin=None, cache=None,
+                 early_exit=False, timeout=None, decoder=None,
+                 flac_md5=False, prefilter=True, partial=False,
+                 audio_report=False, align=False, algorithm=None):
+    """Prints whether the two audio files' streams differ or are identical.
+    If *early_exit* is ``True``, the streams are compared with
+    :func:`~audiodiff.first_difference` and the offset of the first difference
+    is printed as well. If *flac_md5* is ``True``, MD5 signatures of FLAC files
+    are compared first (see :func:`~audiodiff.flac_md5_equal`). If *prefilter*
+    is ``True``, headers are compared before anything else (see
+    :func:`~audiodiff.stream_mismatch`). If *partial* is ``True``, parts of
+    the streams are compared before decoding them fully (see
+    :func:`~audiodiff.partial_mismatch`). If *audio_report* is ``True`` and
+    the streams differ, the differences between their samples are printed as
+    well (see :func:`~audiodiff.diff_audio`), after aligning the streams if
+    *align* is ``True``. Audio streams are hashed with *algorithm* (see
+    :func:`~audiodiff.checksum`).
+
+    """
+    ret = _diff_streams(path1, path2, verbose, ffmpeg_bin, cache, early_exit,
+                        timeout, decoder, flac_md5, prefilter, partial,
+                        algorithm)
+    if ret and audio_report:
+        _report_audio(path1, path2, ffmpeg_bin, timeout, decoder, align)
+    return ret
+
+
+def _diff_streams(path1, path2, verbose, ffmpeg_bin, cache, early_exit,
+                  timeout, decoder, flac_md5, prefilter, partial, algorithm):
+    if prefilter:
+        mismatch = stream_mismatch(path1, path2)
+        if mismatch is not None:
+            return _report_mismatch(path1, path2, mismatch)
+    identical = None
+    offset = None
+    # Same format as audio_equal(), so that cached checksums are found and
+    # the first difference agrees with the verdict
+    pcm_format = negotiate_format(path1, path2)
+    if flac_md5:
+        identical = flac_md5_equal(path1, path2)
+    if identical is None and partial:
+        mismatch = partial_mismatch(path1, path2, ffmpeg_bin, cache, timeout,
+                                    decoder, pcm_format, algorithm)
+        if mismatch is not None:
+            return _report_mismatch(path1, path2, mismatch)
+    if identical is None and early_exit:
+        offset = first_difference(path1, path2, ffmpeg_bin, cache, timeout,
+                                  decoder, pcm_format, algorithm)
+        identical = offset is None
+    elif identical is None:
+        identical = audio_equal(path1, path2, ffmpeg_bin, cache,
+                                timeout=timeout, decoder=decoder,
+                                prefilter=False, algorithm=algorithm)
+    return _report_streams(path1, path2, identical, verbose, offset,
+                           pcm_format)
+
+
+def _report_mismatch(path1, path2, mismatch):
+    _print(u'Audio streams in {0} and {1} differ in {2}'.format(
+        _decode_path(path1), _decode_path(path2), mismatch))
+    return 1
+
+
+def _report_streams(path1, path2, identical, verbose, offset=None,
+                    pcm_format=None):
+    if not identical:
+        if offset is not None:
+            _print(u'Audio streams in {0} and {1} differ at byte {2} '
+                   u'(sample {3})'.format(_decode_path(path1),
+                                          _decode_path(path2),
+                                          offset,
+                                          offset // _PCM_SIZES[pcm_format]))
+        else:
+            _print(u'Audio streams in {0} and {1} differ'.format(
+                _decode_path(path1), _decode_path(path2)))
         return 1
     elif verbose:
         _print(u'Audio streams in {0} and {1} are identical'.format(
@@ -207,10 +855,57 @@ def diff_streams(path1, path2, verbose=False, ffmpeg_bin=None):
     return 0
 
 
+def _report_audio(path1, path2, ffmpeg_bin, timeout, decoder, align=False):
+    try:
+        diff = diff_audio(path1, path2, ffmpeg_bin, timeout, decoder, align)
+    except ValueError as e:
+        _print(u'  Samples cannot be compared: {0}'.format(e))
+        return
+    if diff.samples1 != diff.samples2:
+        _print(u'  Lengths: {0} and {1} samples per channel'.format(
+            diff.samples1, diff.samples2))
+    start = max(0, -diff.offset)
+    compared = min(diff.samples1 - start,
+                   diff.samples2 - max(0, diff.offset))
+    if align:
+        _print(u'  Aligned at offset {0} (sample {1} of {2} matches sample '
+               u'{3} of {4})'.format(diff.offset, start, _decode_path(path1),
+                                     start + diff.offset,
+                                     _decode_path(path2)))
+    if not diff.count:
+        _print(u'  No sample differs in {0} samples per channel compared'
+               u''.format(compared))
+        return
+    _print(u'  {0} of {1} samples differ, from sample {2} to {3}'.format(
+        diff.count, compared * diff.channels, diff.first, diff.last))
+    _print(u'  Peak difference: {0}, RMS difference: {1}'.format(
+        _format_level(diff.peak), _format_level(diff.rms)))
+    for i, channel in enumerate(diff.per_channel):
+        if not channel.count:
+            _print(u'  Channel {0}: identical'.format(i + 1))
+            continue
+        _print(u'  Channel {0}: {1} samples differ, from sample {2} to {3}; '
+               u'peak {4}, RMS {5}'.format(
+                   i + 1, channel.count, channel.first, channel.last,
+                   _format_level(channel.peak), _format_level(channel.rms)))
+
+
+def _format_level(value):
+    # Values are in units of the LSB of 24-bit samples
+    if isinstance(value, float):
+        text = u'{0:.1f}'.format(value)
+    else:
+        text = unicode(value)
+    return u'{0} ({1:.1f} dBFS)'.format(
+        text, 20 * math.log10(value / float(1 << 23)))
+
+
 def diff_tags(path1, path2, verbose=False, brief=False):
     """Prints whether the two audio files' tags differ or are identical."""
-    tags1 = tags(path1)
-    tags2 = tags(path2)
+    return _report_tags(path1, path2, tags(path1), tags(path2), verbose, brief)
+
+
+def _report_tags(path1, path2, tags1, tags2, verbose, brief):
     if tags1 == tags2:
         if verbose:
             _print(u'Tags in {0} and {1} are identical'.format(
@@ -268,7 +963,11 @@ def _compare_dicts(dict1, dict2):
 
 def diff_binary(path1, path2, verbose=False):
     """Prints whether the two non-audio files differ or are identical."""
-    if not equal(path1, path2):
+    return _report_binary(path1, path2, equal(path1, path2), verbose)
+
+
+def _report_binary(path1, path2, identical, verbose):
+    if not identical:
         _print(u'Files {0} and {1} differ'.format(_decode_path(path1),
                                                   _decode_path(path2)))
         return 1
@@ -281,12 +980,24 @@ def diff_binary(path1, path2, verbose=False):
 # Due to a bug in Sphinx, we cannot use from __future__ import print_function
 # https://bitbucket.org/birkenfeld/sphinx/issue/1385/sphinxpycodemoduleanalyzer-fails-with
 def _print(message):
-    print message.encode(_encoding_for(sys.stdout), 'replace')
+    _output(sys.stdout, message.encode(_encoding_for(sys.stdout), 'replace'))
 
 
 def _print_error(message):
-    print >>sys.stderr, '{0}: {1}'.format(
-        parser.prog, message.encode(_encoding_for(sys.stderr), 'replace'))
+    _output(sys.stderr, '{0}: {1}'.format(
+        parser.prog, message.encode(_encoding_for(sys.stderr), 'replace')))
+
+
+#: Per-thread output buffer used while comparing files in worker threads
+_captured = threading.local()
+
+
+def _output(file, line):
+    lines = getattr(_captured, 'lines', None)
+    if lines is not None:
+        lines.append((file, line))
+    else:
+        print >>file, line
 
 
 def _encoding_for(file):
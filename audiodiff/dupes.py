@@ -0,0 +1,215 @@
+"""
+   audiodiff.dupes
+   ~~~~~~~~~~~~~~~
+
+   This module contains functions for finding audio files with identical
+   audio streams, whatever their names and formats.
+
+"""
+import os
+import stat
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from . import (is_supported_format, stream_info, negotiate_format,
+               partial_checksum, checksum, memoize_info, _cpu_count)
+
+
+def find_duplicates(paths, jobs=None, ffmpeg_bin=None, cache=None,
+                    timeout=None, decoder=None, onerror=None, algorithm=None):
+    """Finds audio files with identical audio streams in *paths*, which can be
+    files or directories (searched recursively). Returns a sorted list of
+    sorted lists of names, each of which is a group of two or more duplicates.
+
+    Candidates are narrowed down in stages so that only files that may have
+    duplicates are fully decoded:
+
+    1. Files are grouped by their stream properties in headers (see
+       :func:`~audiodiff.stream_info`), and files whose properties differ
+       from those of all other files are dropped.
+    2. Files are grouped by :func:`~audiodiff.partial_checksum`.
+    3. Files in groups of two or more are grouped by
+       :func:`~audiodiff.checksum`.
+
+    The files of each group of the first stage are decoded into the PCM
+    format that :func:`~audiodiff.negotiate_format` returns for the group.
+    Files whose properties are all known are grouped by them, so they are
+    decoded into their native bit depth. Files whose properties are not all
+    known, such as lossy files, form other groups with the files compatible
+    with them, which are decoded again if the format differs, but only to be
+    compared with the former. Groups of duplicates sharing files are merged.
+
+    Files are decoded in a pool of *jobs* worker threads, which defaults to
+    the number of CPUs. Other arguments are passed to
+    :func:`~audiodiff.checksum`. If *onerror* is given, it is called (possibly
+    from a worker thread) with the name and the exception info (see
+    :func:`sys.exc_info`) of each path that does not exist and of each file
+    that cannot be read or decoded, and the path is skipped; otherwise the
+    exception is raised.
+
+    """
+    with memoize_info():
+        groups = [(negotiate_format(*names), names, required)
+                  for names, required in _candidates(
+                      sorted(set(audio_files(paths, onerror))), onerror)]
+    if jobs is None:
+        jobs = _cpu_count()
+    pool = ThreadPool(max(1, jobs))
+    try:
+        groups = _split(groups, pool, onerror,
+                        lambda name, pcm_format: partial_checksum(
+                            name, None, ffmpeg_bin, timeout, decoder,
+                            pcm_format, algorithm))
+        groups = _split(groups, pool, onerror,
+                        lambda name, pcm_format: checksum(
+                            name, ffmpeg_bin, cache, timeout, decoder,
+                            pcm_format, algorithm))
+    finally:
+        pool.terminate()
+    return sorted(sorted(group) for group in _merge(
+        [names for _, names, _ in groups]))
+
+
+def audio_files(paths, onerror=None):
+    """Yields the names of supported audio files in *paths*, which can be
+    files or directories (searched recursively). Paths that do not exist and
+    directories that cannot be listed are handled as in
+    :func:`find_duplicates`.
+
+    """
+    for path in paths:
+        try:
+            isdir = stat.S_ISDIR(os.stat(path).st_mode)
+        except OSError:
+            _handle_error(path, onerror)
+            continue
+        if not isdir:
+            if is_supported_format(path):
+                yield path
+            continue
+
+        def walk_error(e):
+            if onerror is None:
+                raise e
+            onerror(e.filename, (type(e), e, None))
+        for dirpath, dirnames, filenames in os.walk(path, onerror=walk_error):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if is_supported_format(filename):
+                    yield os.path.join(dirpath, filename)
+
+
+def _candidates(names, onerror=None):
+    """Groups the files whose stream properties are compatible, and returns
+    a list of tuples (*names*, *required*), each of which is a group of two
+    or more files that may be duplicates. Properties are compatible unless
+    they are both known and different. Files whose properties are all known
+    are grouped by them, and *required* is ``None``. Files whose properties
+    are not all known are grouped with the files transitively compatible
+    with them, so a file with known properties can be in several groups, and
+    *required* is the set of the former; duplicates found in such a group
+    must include one of them, since the others are compared in their own
+    group.
+
+    """
+    complete = {}
+    incomplete = []
+    for name in names:
+        try:
+            info = stream_info(name)
+        except Exception:
+            _handle_error(name, onerror)
+            continue
+        if None in info:
+            incomplete.append((info, [name]))
+        else:
+            complete.setdefault(info, []).append(name)
+    candidates = [(group, None) for group in complete.itervalues()
+                  if len(group) > 1]
+    while incomplete:
+        info, group = incomplete.pop()
+        infos = [info]
+        found = True
+        while found:
+            found = False
+            for other in list(incomplete):
+                if any(_compatible(other[0], i) for i in infos):
+                    incomplete.remove(other)
+                    infos.append(other[0])
+                    group.extend(other[1])
+                    found = True
+        required = frozenset(group)
+        for other, names in complete.iteritems():
+            if any(_compatible(other, i) for i in infos):
+                group.extend(names)
+        if len(group) > 1:
+            candidates.append((sorted(group), required))
+    return sorted(candidates)
+
+
+def _compatible(info1, info2):
+    for value1, value2 in zip(info1, info2):
+        if value1 is not None and value2 is not None and value1 != value2:
+            return False
+    return True
+
+
+def _split(groups, pool, onerror, key):
+    """Splits each group in *groups*, a list of tuples (*PCM format*,
+    *names*, *required*) (see :func:`_candidates`), by the return values of
+    *key* called with each name and the format, and returns the groups of two
+    or more names in the same form. Errors are reported once for each name.
+
+    """
+    items = sorted(set((name, pcm_format) for pcm_format, group, _ in groups
+                       for name in group))
+    reported = set()
+    lock = threading.Lock()
+
+    def safe_key(item):
+        try:
+            return key(*item)
+        except Exception:
+            with lock:
+                report = item[0] not in reported
+                reported.add(item[0])
+            if report:
+                _handle_error(item[0], onerror)
+            return None
+    keys = dict(zip(items, pool.map(safe_key, items)))
+    result = []
+    for pcm_format, group, required in groups:
+        buckets = {}
+        for name in group:
+            value = keys[name, pcm_format]
+            if value is not None:
+                buckets.setdefault(value, []).append(name)
+        result.extend((pcm_format, bucket, required)
+                      for bucket in buckets.itervalues()
+                      if len(bucket) > 1 and
+                      (required is None or required.intersection(bucket)))
+    return result
+
+
+def _merge(groups):
+    """Merges the groups of names that share names."""
+    merged = []
+    for group in groups:
+        group = set(group)
+        for other in list(merged):
+            if other & group:
+                merged.remove(other)
+                group |= other
+        merged.append(group)
+    return merged
+
+
+def _handle_error(name, onerror):
+    """Reraises the exception being handled if *onerror* is ``None``, or
+    passes it to *onerror*.
+
+    """
+    if onerror is None:
+        raise
+    onerror(name, sys.exc_info())
@@ -0,0 +1,279 @@
+"""
+   audiodiff.manifest
+   ~~~~~~~~~~~~~~~~~~
+
+   This module contains functions for building and reading manifests, which
+   record checksums and tags of all files in a directory so that it can be
+   compared without decoding its files again.
+
+"""
+import hashlib
+import json
+import os
+import pickle
+from multiprocessing.pool import ThreadPool
+
+from . import (__version__, PCM_FORMAT, HASH_ALGORITHM, Digest,
+               is_supported_format, negotiate_format, checksum, tags,
+               _cpu_count)
+
+
+#: Version of the manifest file format
+MANIFEST_VERSION = 1
+
+#: Key in the first line that identifies a manifest file
+MANIFEST_MAGIC = 'audiodiff_manifest'
+
+
+class ManifestEntry(object):
+    """A file recorded in a :class:`Manifest`. *name* is the path relative to
+    the root directory, with ``/`` as the separator. For audio files,
+    *checksum* is the return value of :func:`~audiodiff.checksum` for the PCM
+    format *pcm_format* and the hash algorithm *algorithm*, and *tags* are the
+    tags normalized by :func:`normalize_tags`; for other files, *checksum* is
+    an SHA1 checksum of the content and *tags*, *pcm_format* and *algorithm*
+    are ``None``.
+
+    """
+
+    __slots__ = ['name', 'checksum', 'tags', 'size', 'mtime', 'pcm_format',
+                 'algorithm']
+
+    def __init__(self, name, checksum, tags=None, size=None, mtime=None,
+                 pcm_format=None, algorithm=None):
+        self.name = name
+        self.checksum = checksum
+        self.tags = tags
+        self.size = size
+        self.mtime = mtime
+        self.pcm_format = pcm_format
+        self.algorithm = algorithm
+
+    def to_json(self):
+        obj = {
+            'name': self.name,
+            'checksum': self.checksum,
+            'size': self.size,
+            'mtime': self.mtime,
+        }
+        if self.tags is not None:
+            obj['tags'] = self.tags
+        if self.pcm_format is not None:
+            obj['pcm_format'] = self.pcm_format
+        if self.algorithm is not None:
+            obj['algorithm'] = self.algorithm
+        return obj
+
+    @classmethod
+    def from_json(cls, obj):
+        # Checksums of audio files were in the default format and made with
+        # the default algorithm before they were recorded
+        audio = 'tags' in obj
+        return cls(obj['name'].encode('utf-8'), obj['checksum'],
+                   obj.get('tags'), obj.get('size'), obj.get('mtime'),
+                   obj.get('pcm_format', PCM_FORMAT if audio else None),
+                   obj.get('algorithm', HASH_ALGORITHM if audio else None))
+
+    @property
+    def digest(self):
+        """The checksum as a :class:`~audiodiff.Digest` for audio files, or
+        ``None`` for other files.
+
+        """
+        if self.pcm_format is None:
+            return None
+        return Digest(self.checksum, self.pcm_format, self.algorithm)
+
+
+class Manifest(object):
+    """Checksums and tags of the files in a directory tree, keyed by their
+    relative paths. *root* is the absolute path of the directory, if known,
+    so that the files can be read again when their checksums cannot be
+    compared.
+
+    """
+
+    def __init__(self, entries=(), root=None):
+        self.entries = {}
+        self.root = root
+        self._dirs = set([''])
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        """Adds or replaces a :class:`ManifestEntry`."""
+        self.entries[entry.name] = entry
+        parts = entry.name.split('/')
+        for i in xrange(1, len(parts)):
+            self._dirs.add('/'.join(parts[:i]))
+
+    def isdir(self, name):
+        """Returns ``True`` if *name* is a directory in the manifest. The root
+        directory is ``''``.
+
+        """
+        return name in self._dirs
+
+    def listdir(self, name):
+        """Returns the sorted names of the files and directories directly
+        under the directory *name*.
+
+        """
+        prefix = name + '/' if name else ''
+        children = set()
+        for path in self.entries.keys() + list(self._dirs):
+            if path.startswith(prefix) and path != name:
+                children.add(path[len(prefix):].split('/', 1)[0])
+        return sorted(children)
+
+    @classmethod
+    def read(cls, path):
+        """Reads a manifest from the file *path*. Raises :exc:`ValueError` if
+        the file is not a manifest.
+
+        """
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline() or 'null')
+            if not isinstance(header, dict) or MANIFEST_MAGIC not in header:
+                raise ValueError('{0} is not a manifest'.format(repr(path)))
+            if header[MANIFEST_MAGIC] > MANIFEST_VERSION:
+                raise ValueError('unsupported manifest version: {0}'.format(
+                    header[MANIFEST_MAGIC]))
+            root = header.get('root')
+            return cls((ManifestEntry.from_json(json.loads(line))
+                        for line in f if line.strip()),
+                       root.encode('utf-8') if root is not None else None)
+
+    def write(self, path):
+        """Writes the manifest to the file *path* in JSON Lines format. The
+        first line is a header and each of the others is an entry.
+
+        """
+        with open(path, 'wb') as f:
+            header = {MANIFEST_MAGIC: MANIFEST_VERSION, 'version': __version__}
+            if self.root is not None:
+                header['root'] = self.root
+            f.write(json.dumps(header) + '\n')
+            for name in sorted(self.entries):
+                f.write(json.dumps(self.entries[name].to_json(),
+                                   sort_keys=True) + '\n')
+
+
+def is_manifest(path):
+    """Returns ``True`` if the file *path* looks like a manifest."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MANIFEST_MAGIC) + 2) == '{"' + MANIFEST_MAGIC
+    except IOError:
+        return False
+
+
+def build_manifest(root, jobs=None, **kwargs):
+    """Walks the directory *root* and returns a :class:`Manifest` of all files
+    in it. Audio files are decoded in a pool of *jobs* worker threads, which
+    defaults to the number of CPUs. Other keyword arguments are passed to
+    :func:`~audiodiff.checksum`.
+
+    """
+    return update_manifest(Manifest(), root, jobs, **kwargs)[0]
+
+
+def update_manifest(manifest, root, jobs=None, **kwargs):
+    """Like :func:`build_manifest`, but reuses the entries in *manifest* for
+    files whose sizes and modification times are unchanged. Entries of deleted
+    files are dropped. Returns a tuple (*manifest*, *rehashed*, *reused*) of
+    the new manifest and the numbers of files that were read and that were
+    reused. Entries of audio files hashed with another algorithm than the
+    *algorithm* keyword argument are not reused.
+
+    """
+    algorithm = kwargs.get('algorithm') or HASH_ALGORITHM
+    reused = []
+    names = []
+    for name, st in _walk(root):
+        entry = manifest.entries.get(name)
+        if (entry is not None and entry.size == st.st_size and
+                entry.mtime == st.st_mtime and
+                entry.algorithm in (None, algorithm)):
+            reused.append(entry)
+        else:
+            names.append(name)
+    if jobs is None:
+        jobs = _cpu_count()
+    pool = ThreadPool(max(1, jobs))
+    try:
+        entries = pool.map(lambda name: make_entry(root, name, **kwargs),
+                           names)
+    finally:
+        pool.terminate()
+    return (Manifest(reused + entries, os.path.abspath(root)), len(entries),
+            len(reused))
+
+
+def _walk(root):
+    """Yields tuples (*name*, *stat*) of files under *root*, where *name* is
+    the relative path with ``/`` as the separator.
+
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            yield (os.path.relpath(path, root).replace(os.sep, '/'),
+                   os.stat(path))
+
+
+def make_entry(root, name, **kwargs):
+    """Returns a :class:`ManifestEntry` of the file *name* relative to the
+    directory *root*. Audio files are decoded into the PCM format that
+    :func:`~audiodiff.negotiate_format` returns for them alone. Keyword
+    arguments are passed to :func:`~audiodiff.checksum`.
+
+    """
+    path = os.path.join(root, *name.split('/'))
+    # Stat before reading so that changes made while reading are detected
+    # by the next update
+    st = os.stat(path)
+    if is_supported_format(path):
+        digest = checksum(path, pcm_format=negotiate_format(path), **kwargs)
+        return ManifestEntry(name, str(digest), normalize_tags(tags(path)),
+                             st.st_size, st.st_mtime, digest.pcm_format,
+                             digest.algorithm)
+    return ManifestEntry(name, file_checksum(path), None, st.st_size,
+                         st.st_mtime)
+
+
+def file_checksum(name):
+    """Returns an SHA1 checksum of the content of the file."""
+    hasher = hashlib.sha1()
+    with open(name, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def normalize_tags(tags):
+    """Returns tags as they are stored in a manifest: converted to JSON and
+    back. Values that cannot be converted, such as pictures (which are byte
+    strings), are replaced with their SHA1 checksums.
+
+    """
+    return json.loads(json.dumps(_hash_bytes(tags), default=_tag_default,
+                                 sort_keys=True))
+
+
+def _hash_bytes(value):
+    if isinstance(value, str):
+        return {'sha1': hashlib.sha1(value).hexdigest()}
+    elif isinstance(value, dict):
+        return dict((k, _hash_bytes(v)) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return [_hash_bytes(v) for v in value]
+    return value
+
+
+def _tag_default(value):
+    return {'sha1': hashlib.sha1(pickle.dumps(value, 2)).hexdigest()}
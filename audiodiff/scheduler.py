@@ -0,0 +1,140 @@
+"""
+   audiodiff.scheduler
+   ~~~~~~~~~~~~~~~~~~~
+
+   This module contains a scheduler that limits the number of audio files
+   decoded at the same time.
+
+"""
+import contextlib
+import os
+import threading
+
+
+class DecoderScheduler(object):
+    """Lets at most *limit* audio files be decoded at the same time, or any
+    number of them if *limit* is ``0`` or ``None``. When a decoder finishes,
+    waiting requests for files on devices (see :data:`os.stat_result.st_dev`)
+    that no running decoder is reading are started first, so that parallel
+    decoders do not make a single disk seek back and forth. Otherwise requests
+    are started in the order they were made.
+
+    A request for more files than *limit* (e.g. two files compared while they
+    are decoded) is started when no other decoder is running, so it never
+    waits forever.
+
+    An instance can be shared between threads.
+
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._running = 0
+        self._devices = {}
+        self._waiting = []
+
+    @property
+    def running(self):
+        """The number of files being decoded."""
+        return self._running
+
+    def request(self, names, callback):
+        """Requests to decode the files *names*, and returns a token to be
+        passed to :meth:`release`. *callback* is called without arguments,
+        possibly from another thread, when the decoding may start.
+
+        """
+        token = _Request(len(names), _devices(names), callback)
+        with self._lock:
+            self._waiting.append(token)
+            started = self._dispatch()
+        for request in started:
+            request.callback()
+        return token
+
+    def release(self, token):
+        """Releases the files of the request *token* after decoding them, or
+        withdraws the request if it has not started yet.
+
+        """
+        with self._lock:
+            if token.started:
+                self._running -= token.count
+                for device in token.devices:
+                    self._devices[device] -= 1
+                    if not self._devices[device]:
+                        del self._devices[device]
+            elif token in self._waiting:
+                self._waiting.remove(token)
+            started = self._dispatch()
+        for request in started:
+            request.callback()
+
+    @contextlib.contextmanager
+    def slots(self, names):
+        """Returns a context manager that waits until the files *names* may be
+        decoded, and releases them at the end of the block.
+
+        """
+        event = threading.Event()
+        token = self.request(names, event.set)
+        try:
+            # Wait with a timeout so that Ctrl-C can interrupt it in Python 2
+            while not event.wait(1):
+                pass
+            yield
+        finally:
+            self.release(token)
+
+    def _dispatch(self):
+        """Starts the waiting requests that can be started, and returns
+        them.
+
+        """
+        started = []
+        while self._waiting:
+            # Requests on idle devices may overtake the first request, but
+            # only if it can be started too, so that it never starves
+            if not self._fits(self._waiting[0]):
+                break
+            request = self._waiting[0]
+            for other in self._waiting:
+                if (self._fits(other) and
+                        not any(d in self._devices for d in other.devices)):
+                    request = other
+                    break
+            self._waiting.remove(request)
+            request.started = True
+            self._running += request.count
+            for device in request.devices:
+                self._devices[device] = self._devices.get(device, 0) + 1
+            started.append(request)
+        return started
+
+    def _fits(self, request):
+        return (not self.limit or not self._running or
+                self._running + request.count <= self.limit)
+
+
+class _Request(object):
+
+    __slots__ = ['count', 'devices', 'callback', 'started']
+
+    def __init__(self, count, devices, callback):
+        self.count = count
+        self.devices = devices
+        self.callback = callback
+        self.started = False
+
+
+def _devices(names):
+    devices = []
+    for name in names:
+        try:
+            device = os.stat(name).st_dev
+        except OSError:
+            continue
+        if device not in devices:
+            devices.append(device)
+    return devices
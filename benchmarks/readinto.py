@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+"""
+   benchmarks/readinto.py
+   ~~~~~~~~~~~~~~~~~~~~~~
+
+   Measures the throughput of hashing PCM data read from a pipe, comparing
+   the loop that reads a new string for every 8 KiB (as audiodiff did before
+   0.3) with :func:`audiodiff._compute_digest`, which reads into a reusable
+   buffer from a pipe enlarged with ``F_SETPIPE_SZ``. The data is written by
+   a child process, so that decoding does not hide the cost of reading::
+
+       $ python benchmarks/readinto.py --size 1024 --algorithm crc32
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import audiodiff
+
+
+#: Child process that writes *size* MiB of data to stdout
+WRITER = """
+import sys
+block = ''.join(chr(i % 251) for i in xrange(1048576))
+for i in xrange({size}):
+    sys.stdout.write(block)
+"""
+
+
+def read_loop(f, algorithm):
+    """The loop :func:`audiodiff._compute_digest` replaced."""
+    hasher = audiodiff._new_hasher(algorithm)
+    while True:
+        data = f.read(hasher.block_size * 128)
+        if not data:
+            break
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
+def readinto_loop(f, algorithm, buffer_size):
+    return audiodiff._compute_digest(f, algorithm, buffer_size)
+
+
+def run(size, loop, pipe_size, *args):
+    """Hashes *size* MiB written by a child process with *loop* and returns
+    the tuple (*digest*, *seconds*).
+
+    """
+    proc = subprocess.Popen([sys.executable, '-c', WRITER.format(size=size)],
+                            stdout=subprocess.PIPE)
+    try:
+        audiodiff._set_pipe_size(proc.stdout.fileno(), pipe_size)
+        start = time.time()
+        digest = loop(proc.stdout, *args)
+        return digest, time.time() - start
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--size',
+        type=int,
+        default=512,
+        metavar='MiB',
+        help='amount of data to hash (default: 512)')
+    parser.add_argument(
+        '--algorithm',
+        choices=audiodiff.HASH_ALGORITHMS,
+        default=audiodiff.HASH_ALGORITHM,
+        help='hash algorithm (default: {0})'.format(audiodiff.HASH_ALGORITHM))
+    parser.add_argument(
+        '--buffer-size',
+        type=int,
+        default=audiodiff.HASH_BUFFER_SIZE,
+        metavar='bytes',
+        help='buffer size of the readinto loop (default: {0})'.format(
+            audiodiff.HASH_BUFFER_SIZE))
+    parser.add_argument(
+        '--pipe-size',
+        type=int,
+        default=audiodiff.PIPE_SIZE,
+        metavar='bytes',
+        help='pipe size of the readinto loop (default: {0})'.format(
+            audiodiff.PIPE_SIZE))
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        metavar='N',
+        help='run each loop N times and report the fastest (default: 3)')
+    options = parser.parse_args(args)
+    results = []
+    for label, loop, pipe_size, loop_args in [
+            ('read', read_loop, 0, (options.algorithm,)),
+            ('readinto', readinto_loop, options.pipe_size,
+             (options.algorithm, options.buffer_size))]:
+        digests = set()
+        best = None
+        for i in xrange(options.repeat):
+            digest, seconds = run(options.size, loop, pipe_size, *loop_args)
+            digests.add(digest)
+            best = seconds if best is None else min(best, seconds)
+        if len(digests) != 1:
+            raise AssertionError('{0} loop returned different digests'.format(
+                label))
+        results.append((label, digests.pop(), best))
+        print '{0:<10} {1:8.1f} MB/s'.format(
+            label, options.size * 1048576 / best / 1000000)
+    if results[0][1] != results[1][1]:
+        raise AssertionError('the loops returned different digests')
+    print 'speedup    {0:8.2f}x'.format(results[0][2] / results[1][2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#! /usr/bin/env python
+"""
+   benchmarks/suite.py
+   ~~~~~~~~~~~~~~~~~~~
+
+   Generates synthetic music libraries with FFmpeg and times audiodiff on
+   them: checksums of single files in each format, comparisons of pairs of
+   files, and comparisons of whole directories, with and without decoding
+   audio streams. Throughput is reported in MB/s of PCM data (in the format
+   the files are decoded into, see :func:`audiodiff.negotiate_format`) and in
+   files/s, and results can be saved as JSON and compared with those of
+   another run, e.g. of another commit::
+
+       $ python benchmarks/suite.py --output before.json
+       $ git checkout topic
+       $ python benchmarks/suite.py --output after.json --compare before.json
+
+   Libraries are generated in a temporary directory, or in ``--library`` to
+   reuse them between runs. The checksum cache is disabled.
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import audiodiff
+from audiodiff import commandlinetool
+
+
+#: Sample rate of generated files
+SAMPLE_RATE = 44100
+
+#: Number of channels of generated files
+CHANNELS = 2
+
+#: Formats of the files timed by the single file benchmarks, as tuples
+#: (*name*, *extension*, *FFmpeg arguments*)
+FORMATS = [
+    ('wav', 'wav', ['-c:a', 'pcm_s16le']),
+    ('flac', 'flac', ['-c:a', 'flac']),
+    ('alac', 'm4a', ['-c:a', 'alac']),
+    ('aac', 'm4a', ['-c:a', 'aac', '-b:a', '192k']),
+    ('mp3', 'mp3', ['-c:a', 'libmp3lame', '-b:a', '192k']),
+]
+
+#: Sample sizes in bytes of :data:`audiodiff.PCM_FORMATS`
+SAMPLE_WIDTHS = {'s16le': 2, 's24le': 3, 's32le': 4, 'f32le': 4}
+
+#: Shapes of generated directory trees: a function that returns the relative
+#: directory of the *i*-th file
+SHAPES = {
+    'flat': lambda i: '',
+    'nested': lambda i: os.path.join('artist{0}'.format(i // 20),
+                                     'album{0}'.format(i // 5)),
+}
+
+
+def pcm_size(duration, pcm_format):
+    """Returns the size of the PCM data of a generated file of *duration*
+    seconds, decoded into *pcm_format*.
+
+    """
+    return duration * SAMPLE_RATE * CHANNELS * SAMPLE_WIDTHS[pcm_format]
+
+
+def ffmpeg(ffmpeg_bin, *args):
+    subprocess.check_call([ffmpeg_bin, '-nostdin', '-loglevel', 'error',
+                           '-y'] + list(args))
+
+
+def encoders(ffmpeg_bin):
+    """Returns the names of the encoders FFmpeg supports."""
+    out = subprocess.Popen([ffmpeg_bin, '-hide_banner', '-encoders'],
+                           stdout=subprocess.PIPE).communicate()[0]
+    return set(line.split()[1] for line in out.splitlines()
+               if len(line.split()) > 1 and line.startswith(' A'))
+
+
+def generate_source(ffmpeg_bin, path, duration, seed):
+    """Generates a 16-bit WAV file of *duration* seconds of pink noise from
+    the random *seed*, which compresses about as badly as music. The files
+    timed are encoded from it by :func:`encode`, which tags them.
+
+    """
+    ffmpeg(ffmpeg_bin, '-f', 'lavfi', '-i',
+           'anoisesrc=d={0}:c=pink:r={1}:a=0.3:seed={2}'.format(
+               duration, SAMPLE_RATE, seed),
+           '-ac', str(CHANNELS), '-c:a', 'pcm_s16le', path)
+
+
+def encode(ffmpeg_bin, source, path, args, seed):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    ffmpeg(ffmpeg_bin, '-i', source, '-metadata', 'title=Track {0}'.format(
+        seed), '-metadata', 'artist=Artist {0}'.format(seed // 20),
+        '-metadata', 'album=Album {0}'.format(seed // 5), *(args + [path]))
+
+
+def generate_library(root, ffmpeg_bin, files, duration, formats):
+    """Generates the library in *root* unless it already exists, and returns
+    its description, which is saved as ``library.json`` in it.
+
+    """
+    info_path = os.path.join(root, 'library.json')
+    info = {'files': files, 'duration': duration, 'formats': formats}
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f) == info:
+                return info
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+    sources = os.path.join(root, 'sources')
+    os.makedirs(sources)
+    for i in xrange(files):
+        source = os.path.join(sources, '{0:04d}.wav'.format(i))
+        generate_source(ffmpeg_bin, source, duration, i)
+        name = 'track{0:04d}'.format(i)
+        for shape, dirname in SHAPES.iteritems():
+            # The same streams in lossless formats on both sides, so that
+            # every file is decoded
+            encode(ffmpeg_bin, source,
+                   os.path.join(root, shape, 'a', dirname(i), name + '.flac'),
+                   ['-c:a', 'flac'], i)
+            encode(ffmpeg_bin, source,
+                   os.path.join(root, shape, 'b', dirname(i), name + '.m4a'),
+                   ['-c:a', 'alac'], i)
+    for name, extension, args in FORMATS:
+        if name in formats:
+            encode(ffmpeg_bin, os.path.join(sources, '0000.wav'),
+                   os.path.join(root, 'single', name + '.' + extension), args,
+                   0)
+    with open(info_path, 'w') as f:
+        json.dump(info, f)
+    return info
+
+
+def measure(func, repeat):
+    """Calls *func* *repeat* times and returns the shortest time."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def run_cli(args):
+    """Runs the commandline tool with its output discarded."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        ret = commandlinetool.main_func(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    if ret not in (0, 1):
+        raise RuntimeError('audiodiff {0} exited with {1}'.format(
+            ' '.join(args), ret))
+
+
+def benchmarks(root, info, jobs):
+    """Yields tuples (*name*, *function*, *files*, *PCM format*) of the
+    benchmarks to run on the library in *root*, where *PCM format* is the
+    format the files are decoded into, or ``None`` if they are not decoded.
+
+    """
+    single = os.path.join(root, 'single')
+    for name, extension, args in FORMATS:
+        if name not in info['formats']:
+            continue
+        path = os.path.join(single, name + '.' + extension)
+        yield ('checksum/' + name,
+               lambda path=path: audiodiff.checksum(path, cache=False),
+               1, audiodiff.PCM_FORMAT)
+    if 'flac' in info['formats'] and 'alac' in info['formats']:
+        paths = [os.path.join(single, 'flac.flac'),
+                 os.path.join(single, 'alac.m4a')]
+        pcm_format = audiodiff.negotiate_format(*paths)
+        yield ('audio_equal/flac-alac',
+               lambda: audiodiff.audio_equal(*paths, cache=False),
+               2, pcm_format)
+        yield ('equal/flac-alac',
+               lambda: audiodiff.equal(*paths, cache=False), 2, pcm_format)
+    for shape in sorted(SHAPES):
+        a = os.path.join(root, shape, 'a')
+        b = os.path.join(root, shape, 'b')
+        files = 2 * info['files']
+        # Every pair is a FLAC and an ALAC file, like the first one
+        name = 'track0000'
+        pcm_format = audiodiff.negotiate_format(
+            os.path.join(a, SHAPES[shape](0), name + '.flac'),
+            os.path.join(b, SHAPES[shape](0), name + '.m4a'))
+        for n in sorted(set([1, jobs])):
+            yield ('dirs/{0}/j{1}'.format(shape, n),
+                   lambda n=n: run_cli([a, b, '--no-cache', '-j', str(n)]),
+                   files, pcm_format)
+        yield ('tags/' + shape, lambda: run_cli([a, b, '-t']), files, None)
+
+
+def describe_environment(ffmpeg_bin):
+    try:
+        commit = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    except OSError:
+        commit = ''
+    return {
+        'audiodiff': audiodiff.__version__,
+        'commit': commit.strip() or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ffmpeg': audiodiff._ffmpeg_version(ffmpeg_bin),
+        'cpus': audiodiff._cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def print_result(result, previous=None):
+    line = '{0:<24} {1:8.3f} s {2:8.1f} files/s'.format(
+        result['name'], result['seconds'], result['files_per_s'])
+    if result['mb_per_s'] is not None:
+        line += ' {0:8.1f} MB/s'.format(result['mb_per_s'])
+    else:
+        line += ' ' * 14
+    if previous is not None:
+        line += '  {0:+6.1f}%'.format(
+            (previous['seconds'] / result['seconds'] - 1) * 100)
+    print line
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--library',
+        metavar='dir',
+        help='generate the libraries in this directory and keep them')
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=40,
+        metavar='N',
+        help='number of files in each directory (default: 40)')
+    parser.add_argument(
+        '--duration',
+        type=int,
+        default=30,
+        metavar='seconds',
+        help='duration of each file (default: 30)')
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        metavar='N',
+        help='run each benchmark N times and report the fastest (default: 3)')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=audiodiff._cpu_count(),
+        metavar='N',
+        help='also compare directories with -j N (default: number of CPUs)')
+    parser.add_argument(
+        '-k', '--filter',
+        metavar='text',
+        help='run only the benchmarks whose names contain this text')
+    parser.add_argument(
+        '-o', '--output',
+        metavar='file',
+        help='save the results as JSON to this file')
+    parser.add_argument(
+        '--compare',
+        metavar='file',
+        help='show the change in speed from results saved by another run '
+             '(positive if faster)')
+    parser.add_argument(
+        '--ffmpeg_bin',
+        metavar='path',
+        default=audiodiff.ffmpeg_path(),
+        help='specify ffmpeg binary path')
+    options = parser.parse_args(args)
+    os.environ['AUDIODIFF_CACHE'] = ''
+    os.environ['FFMPEG_BIN'] = options.ffmpeg_bin
+    available = encoders(options.ffmpeg_bin)
+    formats = [name for name, extension, ffmpeg_args in FORMATS
+               if ffmpeg_args[1] in available]
+    previous = {}
+    if options.compare:
+        with open(options.compare) as f:
+            for result in json.load(f)['results']:
+                previous[result['name']] = result
+    root = options.library or tempfile.mkdtemp(prefix='audiodiff-bench-')
+    try:
+        info = generate_library(root, options.ffmpeg_bin, options.files,
+                                options.duration, formats)
+        results = []
+        for name, func, files, pcm_format in benchmarks(root, info,
+                                                        options.jobs):
+            if options.filter and options.filter not in name:
+                continue
+            size = 0
+            if pcm_format is not None:
+                size = files * pcm_size(info['duration'], pcm_format)
+            seconds = measure(func, options.repeat)
+            result = {
+                'name': name,
+                'seconds': seconds,
+                'files': files,
+                'pcm_format': pcm_format,
+                'pcm_bytes': size,
+                'files_per_s': files / seconds,
+                'mb_per_s': size / seconds / 1000000 if size else None,
+            }
+            print_result(result, previous.get(name))
+            results.append(result)
+    finally:
+        if not options.library:
+            shutil.rmtree(root)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'environment': describe_environment(options.ffmpeg_bin),
+                       'library': info, 'repeat': options.repeat,
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import os
+import shutil
+import signal
+import subprocess
 import sys
+import threading
+import time
+import zlib
 from unicodedata import normalize
 
 import pytest
 parametrize = pytest.mark.parametrize
 
 import audiodiff
+import audiodiff.aio
 from audiodiff import commandlinetool
 
 
@@ -16,6 +25,7 @@ def setup(request):
         os.chdir(old_cwd)
     old_cwd = os.getcwd()
     os.chdir(os.path.join(os.path.dirname(__file__), 'files'))
+    os.environ['AUDIODIFF_CACHE'] = ''
     request.addfinalizer(teardown)
 
 
@@ -44,6 +54,13 @@ def test_audio_equal(name1, name2, truth):
     assert audiodiff.audio_equal(name1, name2) == truth
 
 
+def test_audio_equal_error():
+    with pytest.raises(audiodiff.ExternalLibraryError):
+        audiodiff.audio_equal('mahler.flac', 'x/foo.txt')
+    with pytest.raises(IOError):
+        audiodiff.audio_equal('nonexistent.flac', 'mahler.flac')
+
+
 @parametrize(('name1', 'name2', 'truth'), [
     ('mahler.flac', 'mahler.wav', False),
     ('mahler.flac', 'mahler.m4a', True),
@@ -68,9 +85,228 @@ def test_checksum(name, md5):
     assert audiodiff.checksum(name) == md5
 
 
+@parametrize(('codec', 'args'), [
+    ('pcm_u8', []),
+    ('pcm_s16le', ['-ac', '1']),
+    ('pcm_s24le', []),
+    ('pcm_s32le', ['-af', 'volume=0.3']),
+    ('pcm_f32le', []),
+])
+def test_checksum_wav(codec, args, tmpdir):
+    name = str(tmpdir.join(codec + '.wav'))
+    subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-i', 'mahler.flac',
+                           '-c:a', codec] + args + [name])
+    reader = audiodiff._FFmpegProcess(name, 'ffmpeg')
+    try:
+        sha1sum = audiodiff._compute_digest(reader)
+    finally:
+        reader.close()
+    assert audiodiff.checksum(name) == sha1sum
+    reader = audiodiff._open_pcm(name, 'ffmpeg', None)
+    reader.close()
+    assert isinstance(reader, audiodiff._WaveReader) == (codec != 'pcm_f32le')
+    for pcm_format in ['s16le', 's32le']:
+        assert audiodiff.checksum(name, pcm_format=pcm_format) == \
+            audiodiff.checksum(name, decoder='ffmpeg', pcm_format=pcm_format)
+
+
+@parametrize('decoder', audiodiff.DECODERS)
+@parametrize('name', ['mahler.wav', 'mahler.flac', 'mahler.m4a'])
+def test_checksum_decoder(name, decoder):
+    assert audiodiff.checksum(name, decoder=decoder) == \
+        '9b2450efb790f0a00642b9f7d9526f08598a3d13'
+
+
+@parametrize('pcm_format', audiodiff.PCM_FORMATS)
+@parametrize('decoder', audiodiff.DECODERS)
+@parametrize('name', ['mahler.wav', 'mahler.flac'])
+def test_checksum_pcm_format(name, decoder, pcm_format):
+    sha1sum = audiodiff.checksum(name, decoder=decoder, pcm_format=pcm_format)
+    assert sha1sum == audiodiff.checksum('mahler.m4a', pcm_format=pcm_format)
+    assert sha1sum.pcm_format == pcm_format
+    assert (sha1sum == '9b2450efb790f0a00642b9f7d9526f08598a3d13') == \
+        (pcm_format == 's24le')
+    with pytest.raises(ValueError):
+        audiodiff.checksum(name, decoder=decoder, pcm_format='s24be')
+
+
+def test_negotiate_format(tmpdir):
+    s24 = _convert(tmpdir, 's24.flac', '-sample_fmt', 's32')
+    assert audiodiff.negotiate_format('mahler.wav', 'mahler.flac') == 's16le'
+    assert audiodiff.negotiate_format(s24) == 's24le'
+    assert audiodiff.negotiate_format(s24, 'mahler.flac') == 's24le'
+    assert audiodiff.negotiate_format('mahler.flac', 'mahler.mp3') == 'f32le'
+    assert audiodiff.negotiate_format('mahler.flac', 'mahler.m4a') == 'f32le'
+    assert audiodiff.audio_equal(s24, 'mahler.wav')
+    assert audiodiff._exact_format('mahler.flac', 's16le')
+    assert audiodiff._exact_format('mahler.mp3', 's16le')
+    assert not audiodiff._exact_format(s24, 's16le')
+    assert audiodiff._exact_format(s24, 'f32le')
+
+
+@parametrize('algorithm', ['md5', 'crc32'])
+def test_checksum_algorithm(algorithm):
+    reader = audiodiff._FFmpegProcess('mahler.flac', 'ffmpeg')
+    try:
+        data = reader.read(100000000)
+    finally:
+        reader.close()
+    if algorithm == 'crc32':
+        expected = '{0:08x}'.format(zlib.crc32(data) & 0xffffffff)
+    else:
+        expected = hashlib.new(algorithm, data).hexdigest()
+    for name in ['mahler.wav', 'mahler.flac', 'mahler.m4a']:
+        digest = audiodiff.checksum(name, algorithm=algorithm)
+        assert digest == expected
+        assert digest.algorithm == algorithm
+        assert digest.pcm_format == 's24le'
+    assert audiodiff.audio_equal('mahler.flac', 'mahler.m4a',
+                                 algorithm=algorithm)
+    assert audiodiff.audio_equal('mahler.flac', 'mahler.m4a', streaming=True,
+                                 algorithm=algorithm)
+    assert not audiodiff.audio_equal('mahler.flac', 'mahler.mp3',
+                                     algorithm=algorithm)
+    with pytest.raises(ValueError):
+        audiodiff.compare_digests(digest, audiodiff.checksum(name))
+    with pytest.raises(ValueError):
+        audiodiff.compare_digests(digest, audiodiff.checksum(
+            name, algorithm=algorithm, pcm_format='s16le'))
+    assert audiodiff.compare_digests(digest, str(digest))
+
+
+def test_checksum_unknown_algorithm():
+    with pytest.raises(ValueError):
+        audiodiff.checksum('mahler.flac', algorithm='foo')
+
+
+@pytest.mark.skipif('audiodiff.xxhash is not None')
+def test_checksum_algorithm_unavailable():
+    with pytest.raises(ImportError):
+        audiodiff.checksum('mahler.flac', algorithm='xxh64')
+
+
+@pytest.mark.skipif('audiodiff.soundfile is None')
+def test_soundfile_reader():
+    reader = audiodiff._open_pcm('mahler.flac', 'ffmpeg', None, 'soundfile')
+    reader.close()
+    assert isinstance(reader, audiodiff._SoundFileReader)
+
+
+@pytest.mark.skipif('audiodiff.soundfile is None')
+def test_soundfile_reader_error(tmpdir):
+    name = str(tmpdir.join('truncated.flac'))
+    with open('mahler.flac', 'rb') as f:
+        data = f.read()
+    with open(name, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    with pytest.raises(audiodiff.ExternalLibraryError) as excinfo:
+        audiodiff.checksum(name, cache=False, decoder='soundfile')
+    assert 'truncated.flac' in str(excinfo.value)
+
+
+def test_checksum_unknown_decoder():
+    with pytest.raises(ValueError):
+        audiodiff.checksum('mahler.flac', decoder='foo')
+
+
 def test_checksum_error():
-    with pytest.raises(audiodiff.ExternalLibraryError):
+    with pytest.raises(audiodiff.ExternalLibraryError) as excinfo:
         audiodiff.checksum('x/foo.txt')
+    assert 'foo.txt' in excinfo.value.stderr
+
+
+def test_checksum_timeout():
+    with pytest.raises(audiodiff.ExternalLibraryError) as excinfo:
+        audiodiff.checksum('mahler.flac', timeout=0, decoder='ffmpeg')
+    assert 'timed out' in str(excinfo.value)
+
+
+@parametrize('buffer_size', [1, 1000, None])
+@parametrize('decoder', ['auto', 'ffmpeg'])
+def test_compute_digest(decoder, buffer_size):
+    reader = audiodiff._open_pcm('mahler.wav', 'ffmpeg', None, decoder)
+    try:
+        assert audiodiff._compute_digest(reader, None, buffer_size) == \
+            '9b2450efb790f0a00642b9f7d9526f08598a3d13'
+    finally:
+        reader.close()
+
+
+@pytest.mark.skipif('not sys.platform.startswith("linux")')
+def test_pipe_size(monkeypatch):
+    import fcntl
+    monkeypatch.setattr(audiodiff, 'PIPE_SIZE', 262144)
+    reader = audiodiff._FFmpegProcess('mahler.flac', 'ffmpeg')
+    try:
+        # F_GETPIPE_SZ
+        assert fcntl.fcntl(reader.stdout.fileno(), 1032) == 262144
+    finally:
+        reader.close()
+
+
+def test_checksum_timeout_after_exit():
+    reader = audiodiff._FFmpegProcess('mahler.flac', audiodiff.ffmpeg_path())
+    try:
+        assert reader.read(10000000)
+        reader.proc.wait()
+        # The timer fires after FFmpeg exits
+        reader._expire()
+        reader.finish()
+    finally:
+        reader.close()
+    assert not reader.timed_out
+
+
+def test_checksum_cache(tmpdir):
+    cache = audiodiff.ChecksumCache(str(tmpdir.join('cache.sqlite3')))
+    name = str(tmpdir.join('mahler.flac'))
+    shutil.copy('mahler.flac', name)
+    sha1sum = audiodiff.checksum(name, cache=cache, decoder='ffmpeg')
+    key = cache.key(name, audiodiff._ffmpeg_version('ffmpeg'), 's24le')
+    assert cache.get(key) == sha1sum
+    cache.set(key, 'cached')
+    assert audiodiff.checksum(name, cache=cache, decoder='ffmpeg') == 'cached'
+    assert audiodiff.checksum(name, cache=False) == sha1sum
+    st = os.stat(name)
+    os.utime(name, (st.st_atime, st.st_mtime + 10))
+    assert audiodiff.checksum(name, cache=cache, decoder='ffmpeg') == sha1sum
+    if audiodiff.soundfile is not None:
+        # Digests made by libsndfile are stored under another key
+        key = audiodiff._cache_key(name, 'ffmpeg', cache,
+                                   decoder='ffmpeg')[1]
+        assert audiodiff._cache_key(name, 'ffmpeg', cache)[1] != key
+        assert audiodiff.checksum(name, cache=cache) == sha1sum
+    cache.clear()
+    assert cache.get(key) is None
+
+
+def test_checksum_cache_algorithm(tmpdir):
+    import sqlite3
+    path = str(tmpdir.join('cache.sqlite3'))
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE checksums (
+        path TEXT, inode INTEGER, size INTEGER, mtime INTEGER, decoder TEXT,
+        format TEXT, digest TEXT, atime REAL)""")
+    conn.close()
+    cache = audiodiff.ChecksumCache(path)
+    sha1sum = audiodiff.checksum('mahler.flac', cache=cache)
+    crc = audiodiff.checksum('mahler.flac', cache=cache, algorithm='crc32')
+    assert (sha1sum.algorithm, crc.algorithm) == ('sha1', 'crc32')
+    assert audiodiff.checksum('mahler.flac', cache=cache) == sha1sum
+    assert audiodiff.checksum('mahler.flac', cache=cache,
+                              algorithm='crc32') == crc
+
+
+def test_checksum_cache_prune(tmpdir):
+    cache = audiodiff.ChecksumCache(str(tmpdir.join('cache.sqlite3')),
+                                    max_entries=2)
+    keys = [cache.key(name, 'ffmpeg', 's24le')
+            for name in ['mahler.flac', 'mahler.m4a', 'mahler.mp3']]
+    for key in keys:
+        cache.set(key, 'x')
+    cache.get(keys[0])
+    cache.prune()
+    assert [cache.get(key) for key in keys] == ['x', None, 'x']
 
 
 tags1 = {
@@ -274,3 +510,954 @@ def test_main_func(args, return_code, out, err, capsys):
     actual = capsys.readouterr()
     assert normalize('NFC', actual[0]) == out
     assert normalize('NFC', actual[1]) == err
+
+
+@parametrize('args', [
+    ['x', 'y'],
+    ['x', 'y', '-s'],
+    ['x', 'y', '--brief'],
+    ['y', 'z', '-s'],
+    ['mahler.flac', 'mahler.m4a', '-s'],
+])
+def test_main_func_jobs(args, capsys):
+    return_code = commandlinetool.main_func(args)
+    expected = capsys.readouterr()
+    assert commandlinetool.main_func(args + ['-j', '4']) == return_code
+    assert capsys.readouterr() == expected
+
+
+def test_main_func_jobs_interrupt(monkeypatch):
+    interrupted = threading.Event()
+
+    def run_captured(task):
+        interrupted.wait(10)
+        return 0, []
+
+    def handler(signum, frame):
+        interrupted.set()
+        raise KeyboardInterrupt
+    monkeypatch.setattr(commandlinetool, '_run_captured', run_captured)
+    old_handler = signal.signal(signal.SIGALRM, handler)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, 0.5)
+        start = time.time()
+        assert commandlinetool.main_func(['x', 'y', '-j', '2']) == 130
+        assert time.time() - start < 5
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def test_compare_many():
+    pairs = [
+        ('mahler.flac', 'mahler.m4a'),
+        ('mahler.flac', 'mahler_tagsdiff.m4a'),
+        ('mahler.m4a', 'mahler.mp3'),
+        ('x/foo.txt', 'y/foo.txt'),
+    ]
+    assert audiodiff.compare_many(pairs, jobs=3) == [True, False, False, True]
+    assert audiodiff.compare_many(pairs, jobs=1) == [True, False, False, True]
+
+
+@parametrize(('name1', 'name2', 'offset'), [
+    ('mahler.flac', 'mahler.wav', None),
+    ('mahler.flac', 'mahler.m4a', None),
+    ('mahler.flac', 'mahler.mp3', 0),
+])
+def test_first_difference(name1, name2, offset):
+    assert audiodiff.first_difference(name1, name2) == offset
+    assert audiodiff.audio_equal(name1, name2, streaming=True) == \
+        (offset is None)
+
+
+def test_first_difference_modified(tmpdir):
+    with open('mahler.wav', 'rb') as f:
+        data = bytearray(f.read())
+    # Flip the low byte of the 500th 16-bit sample, which is the second byte
+    # of the 500th sample in the signed 24-bit stream
+    i = data.index('data') + 8 + 500 * 2
+    data[i] ^= 0xff
+    name = str(tmpdir.join('modified.wav'))
+    with open(name, 'wb') as f:
+        f.write(data)
+    assert audiodiff.first_difference('mahler.wav', name) == 500 * 3 + 1
+
+
+def _copy_flac_with_md5(tmpdir, name, md5):
+    with open('mahler.flac', 'rb') as f:
+        data = bytearray(f.read())
+    # The MD5 signature is the last 16 bytes of the STREAMINFO block, which
+    # follows the 4-byte marker and the 4-byte metadata block header
+    data[26:42] = md5
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_flac_md5_equal(tmpdir):
+    assert audiodiff.flac_md5_equal('mahler.flac', 'unicode.flac') is True
+    assert audiodiff.flac_md5_equal('mahler.flac', 'mahler.m4a') is None
+    assert audiodiff.flac_md5_equal('mahler.flac', 'x/foo.txt') is None
+    unset = _copy_flac_with_md5(tmpdir, 'unset.flac', '\0' * 16)
+    assert audiodiff.flac_md5_equal('mahler.flac', unset) is None
+    assert audiodiff.audio_equal('mahler.flac', unset, flac_md5=True)
+    wrong = _copy_flac_with_md5(tmpdir, 'wrong.flac', '\1' * 16)
+    assert audiodiff.flac_md5_equal('mahler.flac', wrong) is False
+    # The signature is trusted without decoding the files
+    assert not audiodiff.audio_equal('mahler.flac', wrong, flac_md5=True)
+    assert audiodiff.audio_equal('mahler.flac', wrong)
+
+
+@parametrize(('data1', 'data2', 'length'), [
+    ('', '', 0),
+    ('abc', 'abc', 3),
+    ('abc', 'abd', 2),
+    ('abc', 'ab', 2),
+    ('xbc', 'abc', 0),
+])
+def test_common_prefix_length(data1, data2, length):
+    assert audiodiff._common_prefix_length(data1, data2) == length
+
+
+def test_main_func_early_exit(capsys):
+    assert commandlinetool.main_func(['x/d.mp3', 'y/d.flac', '-a', '-e']) == 1
+    assert capsys.readouterr() == (
+        'Audio streams in x/d.mp3 and y/d.flac differ at byte 0 (sample 0)\n',
+        '')
+    assert commandlinetool.main_func(['x/c.flac', 'y/c.m4a', '-s', '-e']) == 0
+    assert capsys.readouterr()[0].startswith(
+        'Audio streams in x/c.flac and y/c.m4a are identical\n')
+
+
+def test_main_func_early_exit_format(monkeypatch, capsys):
+    formats = []
+
+    def first_difference(*args):
+        formats.append(args[6])
+        return 8
+    monkeypatch.setattr(commandlinetool, 'first_difference', first_difference)
+    assert commandlinetool.main_func(['x/d.mp3', 'y/d.flac', '-a', '-e']) == 1
+    assert formats == ['f32le']
+    assert capsys.readouterr()[0] == (
+        'Audio streams in x/d.mp3 and y/d.flac differ at byte 8 (sample 2)\n')
+
+
+@parametrize(('name', 'info'), [
+    ('mahler.wav', (44100, 2, 127742)),
+    ('mahler.flac', (44100, 2, 127742)),
+    ('mahler.m4a', (None, None, None)),
+    ('mahler.mp3', (44100, 2, None)),
+    ('x/foo.txt', (None, None, None)),
+])
+def test_stream_info(name, info):
+    assert audiodiff.stream_info(name) == info
+
+
+def _convert(tmpdir, name, *args):
+    path = str(tmpdir.join(name))
+    subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-i',
+                           'mahler.flac'] + list(args) + [path])
+    return path
+
+
+def test_stream_mismatch(tmpdir):
+    mono = _convert(tmpdir, 'mono.wav', '-ac', '1')
+    resampled = _convert(tmpdir, 'resampled.flac', '-ar', '48000')
+    trimmed = _convert(tmpdir, 'trimmed.flac', '-t', '1')
+    assert audiodiff.stream_mismatch('mahler.flac', 'mahler.wav') is None
+    assert audiodiff.stream_mismatch('mahler.flac', 'mahler.m4a') is None
+    assert audiodiff.stream_mismatch('mahler.flac', mono) == \
+        'number of channels (2 and 1)'
+    assert audiodiff.stream_mismatch('mahler.wav', resampled) == \
+        'sample rate (44100 and 48000)'
+    assert audiodiff.stream_mismatch('mahler.wav', trimmed) == \
+        'number of samples (127742 and 44100)'
+    audiodiff.stats.reset()
+    assert not audiodiff.audio_equal('mahler.flac', mono)
+    assert audiodiff.stats.counters == {'prefilter_mismatches': 1}
+
+
+def test_main_func_prefilter(tmpdir, capsys):
+    trimmed = _convert(tmpdir, 'trimmed.flac', '-t', '1')
+    assert commandlinetool.main_func(['mahler.flac', trimmed, '-a']) == 1
+    assert capsys.readouterr() == (
+        'Audio streams in mahler.flac and {0} differ in number of samples '
+        '(127742 and 44100)\n'.format(trimmed), '')
+    args = ['mahler.flac', trimmed, '-a', '--no-prefilter']
+    assert commandlinetool.main_func(args) == 1
+    assert capsys.readouterr() == (
+        'Audio streams in mahler.flac and {0} differ\n'.format(trimmed), '')
+
+
+def test_statistics():
+    stats = audiodiff.Statistics()
+    stats.incr('files')
+    stats.incr('files', 2)
+    with stats.timer('phase'):
+        pass
+    stats.add_time('phase', 1.5)
+    assert stats.counters == {'files': 3}
+    assert stats.timers['phase'][0] == 2
+    assert stats.timers['phase'][1] >= 1.5
+    summary = stats.as_dict()
+    assert summary['counters'] == {'files': 3}
+    assert summary['timers']['phase']['count'] == 2
+    assert json.loads(json.dumps(summary)) == summary
+    lines = stats.format().split('\n')
+    assert lines[0].split() == ['files', '3']
+    assert lines[1].startswith('phase ')
+    assert lines[1].endswith(' s (2 times)')
+    stats.reset()
+    assert stats.as_dict() == {'counters': {}, 'timers': {}}
+    assert stats.format() == ''
+
+
+def test_statistics_checksum(tmpdir):
+    cache = audiodiff.ChecksumCache(str(tmpdir.join('cache.sqlite3')))
+    audiodiff.stats.reset()
+    audiodiff.checksum('mahler.flac', cache=cache, decoder='ffmpeg',
+                       pcm_format='s16le')
+    audiodiff.checksum('mahler.flac', cache=cache, decoder='ffmpeg',
+                       pcm_format='s16le')
+    assert audiodiff.stats.counters == {
+        'cache_hits': 1, 'cache_misses': 1, 'decoded_bytes': 127742 * 4}
+    for name in ['ffmpeg_spawn', 'decode', 'hash']:
+        assert audiodiff.stats.timers[name][0] == 1
+    audiodiff.stats.reset()
+    assert audiodiff.equal('x/foo.txt', 'y/foo.txt')
+    assert audiodiff.stats.counters == {
+        'filecmp_bytes': 2 * os.path.getsize('x/foo.txt')}
+    assert audiodiff.stats.timers['filecmp'][0] == 1
+    audiodiff.AudioFileInfo('mahler.flac')
+    assert audiodiff.stats.timers['parse'][0] == 1
+
+
+def test_main_func_stats(capsys):
+    args = ['mahler.flac', 'mahler.m4a', '--no-cache', '--stats=json']
+    assert commandlinetool.main_func(args) == 0
+    out, err = capsys.readouterr()
+    summary = json.loads(err)
+    assert summary['counters']['decoded_bytes'] > 0
+    assert summary['timers']['decode']['count'] == 2
+    assert summary['elapsed'] > 0
+    args = ['dupes', 'mahler.flac', 'mahler.m4a', '--no-cache', '--stats']
+    assert commandlinetool.main_func(args) == 0
+    out, err = capsys.readouterr()
+    assert err.startswith('elapsed ')
+    assert '\ndecode ' in err
+    assert commandlinetool.main_func(['mahler.flac', 'mahler.m4a',
+                                      '--no-cache']) == 0
+    assert capsys.readouterr() == ('', '')
+
+
+def test_audio_file_info():
+    info = audiodiff.AudioFileInfo('mahler.flac')
+    assert info.tags == tags1
+    assert info.stream == (44100, 2, 127742)
+    assert info.bits_per_sample == 16
+    assert info.md5_signature == 291593891794875547010402814893518363944
+    assert not hasattr(info, '__dict__')
+    info = audiodiff.AudioFileInfo('x/foo.txt')
+    with pytest.raises(Exception):
+        info.tags
+    assert info.stream == (None, None, None)
+
+
+@parametrize('args', [['x', 'y'], ['x', 'y', '--flac-md5', '-j', '4']])
+def test_main_func_reads_tags_once(args, monkeypatch, capsys):
+    counts = {}
+    read_tags = audiodiff.mutagenwrapper.read_tags
+
+    def counting_read_tags(name, **kwargs):
+        counts[name] = counts.get(name, 0) + 1
+        return read_tags(name, **kwargs)
+
+    monkeypatch.setattr(audiodiff.mutagenwrapper, 'read_tags',
+                        counting_read_tags)
+    commandlinetool.main_func(args)
+    assert counts
+    assert set(counts.values()) == set([1])
+    assert getattr(audiodiff._info_local, 'memo', None) is None
+
+
+@parametrize('kwargs', [{}, {'flac_md5': True}, {'partial': True}])
+def test_equal_reads_tags_once(kwargs, monkeypatch):
+    counts = {}
+    read_tags = audiodiff.mutagenwrapper.read_tags
+
+    def counting_read_tags(name, **kwargs):
+        counts[name] = counts.get(name, 0) + 1
+        return read_tags(name, **kwargs)
+
+    monkeypatch.setattr(audiodiff.mutagenwrapper, 'read_tags',
+                        counting_read_tags)
+    assert audiodiff.equal('mahler.flac', 'mahler.m4a', **kwargs) is True
+    assert counts == {'mahler.flac': 1, 'mahler.m4a': 1}
+    counts.clear()
+    pairs = [('mahler.flac', 'mahler.m4a'), ('mahler.m4a', 'mahler.flac')]
+    assert audiodiff.compare_many(pairs, jobs=2, **kwargs) == [True, True]
+    assert counts == {'mahler.flac': 2, 'mahler.m4a': 2}
+
+
+@parametrize('args', [
+    [],
+    ['-s'],
+    ['-s', '-q'],
+    ['-a', '-s'],
+    ['-t'],
+])
+def test_main_func_manifest(args, tmpdir, capsys):
+    manifest = str(tmpdir.join('x.jsonl'))
+    assert commandlinetool.main_func(['index', 'x', manifest]) == 0
+    assert capsys.readouterr() == ('', '')
+    for expected_args, manifest_args in [
+            (['x', 'y'], [manifest, 'y']),
+            (['y', 'x'], ['y', manifest])]:
+        return_code = commandlinetool.main_func(expected_args + args)
+        expected = capsys.readouterr()
+        assert commandlinetool.main_func(manifest_args + args) == return_code
+        actual = capsys.readouterr()
+        assert actual[0].replace(manifest, 'x') == expected[0]
+        assert actual[1] == expected[1]
+
+
+def test_main_func_manifest_formats(tmpdir, capsys):
+    indexed = tmpdir.mkdir('indexed')
+    shutil.copy('mahler.flac', str(indexed.join('a.flac')))
+    other = tmpdir.mkdir('other')
+    # The same samples in 24 bits, compared as s24le, not as the s16le
+    # checksum in the manifest
+    _convert(other, 'a.flac', '-sample_fmt', 's32')
+    manifest = str(tmpdir.join('indexed.jsonl'))
+    assert commandlinetool.main_func(['index', str(indexed), manifest]) == 0
+    expected_args = [str(indexed), str(other), '-a', '-s']
+    assert commandlinetool.main_func(expected_args) == 0
+    expected = capsys.readouterr()
+    assert 'identical' in expected[0]
+    args = [manifest, str(other), '-a', '-s']
+    assert commandlinetool.main_func(args) == 0
+    actual = capsys.readouterr()
+    assert actual[0].replace(manifest, str(indexed)) == expected[0]
+    # The streams cannot be compared once the indexed file is gone
+    indexed.join('a.flac').remove()
+    assert commandlinetool.main_func(args) == 2
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert 'cannot compare audio streams' in err
+
+
+def test_manifest(tmpdir):
+    from audiodiff.manifest import Manifest, build_manifest
+    manifest = build_manifest('x', jobs=2)
+    path = str(tmpdir.join('x.jsonl'))
+    manifest.write(path)
+    loaded = Manifest.read(path)
+    assert sorted(loaded.entries) == sorted(manifest.entries)
+    assert loaded.root == os.path.abspath('x')
+    assert loaded.listdir('') == sorted(os.listdir('x'))
+    entry = loaded.entries['c.flac']
+    assert entry.checksum == audiodiff.checksum('x/c.flac',
+                                                pcm_format='s16le')
+    assert entry.pcm_format == 's16le'
+    assert loaded.entries['d.mp3'].pcm_format == 'f32le'
+    assert entry.tags['artist'] == 'Mahler'
+    assert entry.size == os.path.getsize('x/c.flac')
+    assert loaded.entries['foo.txt'].tags is None
+    assert loaded.entries['foo.txt'].pcm_format is None
+    with pytest.raises(ValueError):
+        Manifest.read('x/foo.txt')
+
+
+def test_manifest_picture(tmpdir, capsys):
+    import mutagen.flac
+    from audiodiff.manifest import normalize_tags
+    root = tmpdir.join('pictures')
+    root.mkdir()
+    name = str(root.join('mahler.flac'))
+    shutil.copy('mahler.flac', name)
+    f = mutagen.flac.FLAC(name)
+    picture = mutagen.flac.Picture()
+    picture.type = 3
+    picture.mime = 'image/png'
+    picture.data = '\x89PNG\r\n\x1a\n\xff\x00'
+    f.add_picture(picture)
+    f.save()
+    assert normalize_tags(audiodiff.tags(name))['pictures'] == {
+        'sha1': hashlib.sha1(picture.data).hexdigest()}
+    manifest = str(tmpdir.join('pictures.jsonl'))
+    assert commandlinetool.main_func(['index', str(root), manifest]) == 0
+    assert capsys.readouterr() == ('', '')
+    assert commandlinetool.main_func([manifest, str(root), '-s']) == 0
+    out = capsys.readouterr()[0]
+    assert 'Tags in {0} and {1} are identical'.format(
+        os.path.join(manifest, 'mahler.flac'), name) in out
+
+
+def test_update_manifest(tmpdir, capsys):
+    from audiodiff.manifest import Manifest
+    root = tmpdir.join('x')
+    shutil.copytree('x', str(root))
+    manifest = str(tmpdir.join('x.jsonl'))
+    args = ['index', '--update', str(root), manifest]
+    count = len(os.listdir('x'))
+    assert commandlinetool.main_func(args) == 0
+    assert capsys.readouterr()[0] == \
+        'Read {0} files, reused 0 files\n'.format(count)
+    assert commandlinetool.main_func(args) == 0
+    assert capsys.readouterr()[0] == \
+        'Read 0 files, reused {0} files\n'.format(count)
+    root.join('foo.txt').write('changed')
+    root.join('new.txt').write('new')
+    root.join('b.txt').remove()
+    assert commandlinetool.main_func(args) == 0
+    assert capsys.readouterr()[0] == \
+        'Read 2 files, reused {0} files\n'.format(count - 2)
+    entries = Manifest.read(manifest).entries
+    assert 'b.txt' not in entries
+    assert 'new.txt' in entries
+    assert commandlinetool.main_func([manifest, str(root), '-s']) == 0
+    capsys.readouterr()
+    # Entries hashed with another algorithm are not reused
+    args[1:1] = ['--hash', 'crc32']
+    assert commandlinetool.main_func(args) == 0
+    assert capsys.readouterr()[0] == \
+        'Read 5 files, reused {0} files\n'.format(count - 5)
+    entry = Manifest.read(manifest).entries['c.flac']
+    assert entry.algorithm == 'crc32'
+    assert entry.digest == audiodiff.checksum(
+        str(root.join('c.flac')), pcm_format='s16le', algorithm='crc32')
+    assert commandlinetool.main_func([manifest, str(root), '-s']) == 0
+    assert commandlinetool.main_func(['dupes', '--hash', 'crc32', 'x']) == 0
+
+
+@parametrize('args', [
+    ['x', 'y'],
+    ['x', 'y', '-j', '4'],
+])
+def test_main_func_decodes_once(args, monkeypatch, capsys):
+    names = []
+    checksum = commandlinetool.checksum
+    def counting_checksum(name, *args):
+        names.append(name)
+        return checksum(name, *args)
+    monkeypatch.setattr(commandlinetool, 'checksum', counting_checksum)
+    assert commandlinetool.main_func(args + ['-s']) == 1
+    assert sorted(names) == ['x/b.m4a', 'x/c.flac', 'x/c.m4a',
+                             'y/b.flac', 'y/b.m4a', 'y/c.flac', 'y/c.m4a']
+
+
+def test_main_func_jobs_decoders(monkeypatch, capsys):
+    lock = threading.Lock()
+    counts = {'running': 0, 'max': 0}
+    checksum = commandlinetool.checksum
+
+    def counting_checksum(name, *args):
+        with lock:
+            counts['running'] += 1
+            counts['max'] = max(counts['max'], counts['running'])
+        try:
+            time.sleep(0.2)
+            return checksum(name, *args)
+        finally:
+            with lock:
+                counts['running'] -= 1
+    monkeypatch.setattr(commandlinetool, 'checksum', counting_checksum)
+    assert commandlinetool.main_func(['x', 'y', '-s', '-j', '2']) == 1
+    assert counts['max'] <= 2
+
+
+def test_decoder_scheduler():
+    from audiodiff.scheduler import DecoderScheduler
+    scheduler = DecoderScheduler(2)
+    started = []
+
+    def request(*names):
+        return scheduler.request(names, lambda: started.append(names))
+    a = request('mahler.flac')
+    b = request('mahler.wav')
+    c = request('mahler.m4a')
+    d = request('/dev/null')
+    assert started == [('mahler.flac',), ('mahler.wav',)]
+    scheduler.release(a)
+    # Files on devices no decoder is reading go first
+    assert started[2:] == [('/dev/null',)]
+    scheduler.release(d)
+    assert started[3:] == [('mahler.m4a',)]
+    e = request('mahler.flac', '/proc/version')
+    scheduler.release(b)
+    assert started[4:] == []
+    scheduler.release(c)
+    assert started[4:] == [('mahler.flac', '/proc/version')]
+    # A request for more files than the limit waits until nothing is running
+    f = request('x/c.flac', 'y/c.flac', 'z/c.flac')
+    g = request('/dev/null')
+    assert started[5:] == []
+    scheduler.release(e)
+    assert started[5:] == [('x/c.flac', 'y/c.flac', 'z/c.flac')]
+    scheduler.release(g)
+    scheduler.release(f)
+    assert started[6:] == []
+    assert scheduler.running == 0
+
+
+def test_max_decoders(monkeypatch):
+    monkeypatch.setenv('AUDIODIFF_MAX_DECODERS', '1')
+    assert audiodiff.max_decoders() == 1
+    scheduler = audiodiff.default_scheduler()
+    assert scheduler.limit == 1
+    lock = threading.Lock()
+    counts = {'running': 0, 'max': 0}
+    open_pcm = audiodiff._open_pcm
+
+    def counting_open_pcm(*args):
+        with lock:
+            counts['running'] += 1
+            counts['max'] = max(counts['max'], counts['running'])
+        reader = open_pcm(*args)
+        close = reader.close
+
+        def counting_close():
+            with lock:
+                counts['running'] -= 1
+            close()
+        reader.close = counting_close
+        return reader
+    monkeypatch.setattr(audiodiff, '_open_pcm', counting_open_pcm)
+    assert audiodiff.audio_equal('mahler.flac', 'mahler.m4a')
+    pairs = [('mahler.flac', 'mahler.m4a'), ('mahler.m4a', 'mahler.mp3')]
+    assert audiodiff.compare_many(pairs, jobs=2) == [True, False]
+    assert counts == {'running': 0, 'max': 1}
+    # Both files are decoded at once, even though the limit is 1
+    assert audiodiff.audio_equal('mahler.flac', 'mahler.m4a', streaming=True)
+    assert counts == {'running': 0, 'max': 2}
+    assert scheduler.running == 0
+
+
+def test_find_duplicates(tmpdir, monkeypatch):
+    from audiodiff import dupes
+    root = tmpdir.mkdir('root')
+    mono = _convert(root, 'mono.wav', '-ac', '1')
+    trimmed = _convert(root, 'trimmed.flac', '-t', '1')
+    shutil.copy('mahler.flac', str(root.join('a.flac')))
+    shutil.copy('mahler.wav', str(root.join('b.wav')))
+    with open('mahler.wav', 'rb') as f:
+        data = bytearray(f.read())
+    data[-1] ^= 1
+    root.join('c.wav').write(str(data), 'wb')
+    calls = []
+
+    def counting(func):
+        def wrapper(name, *args):
+            calls.append((func.__name__, os.path.basename(name)))
+            return func(name, *args)
+        return wrapper
+    monkeypatch.setattr(dupes, 'partial_checksum',
+                        counting(audiodiff.partial_checksum))
+    monkeypatch.setattr(dupes, 'checksum', counting(audiodiff.checksum))
+    groups = dupes.find_duplicates([str(root)], jobs=2)
+    assert groups == [[str(root.join('a.flac')), str(root.join('b.wav'))]]
+    assert sorted(calls) == [
+        ('checksum', 'a.flac'), ('checksum', 'b.wav'),
+        ('partial_checksum', 'a.flac'), ('partial_checksum', 'b.wav'),
+        ('partial_checksum', 'c.wav'),
+    ]
+    # Stream properties of M4A files are unknown
+    groups = dupes.find_duplicates([mono, trimmed, 'mahler.m4a', 'x/c.flac'])
+    assert groups == [['mahler.m4a', 'x/c.flac']]
+
+
+def test_find_duplicates_formats(tmpdir, monkeypatch):
+    from audiodiff import dupes
+    root = tmpdir.mkdir('root')
+    shutil.copy('mahler.flac', str(root.join('a.flac')))
+    shutil.copy('mahler.wav', str(root.join('b.wav')))
+    shutil.copy('mahler.mp3', str(root.join('c.mp3')))
+    shutil.copy('x/d.mp3', str(root.join('d.mp3')))
+    calls = []
+
+    def recording(func):
+        def wrapper(name, *args):
+            calls.append((func.__name__, os.path.basename(name), args[4]))
+            return func(name, *args)
+        return wrapper
+    monkeypatch.setattr(dupes, 'partial_checksum',
+                        recording(audiodiff.partial_checksum))
+    monkeypatch.setattr(dupes, 'checksum', recording(audiodiff.checksum))
+    groups = dupes.find_duplicates([str(root)], cache=False)
+    assert groups == [[str(root.join('a.flac')), str(root.join('b.wav'))],
+                      [str(root.join('c.mp3')), str(root.join('d.mp3'))]]
+    # The 16-bit files are compared as such with each other, and as floating
+    # point samples only with the lossy files
+    assert sorted(calls) == [
+        ('checksum', 'a.flac', 's16le'), ('checksum', 'b.wav', 's16le'),
+        ('checksum', 'c.mp3', 'f32le'), ('checksum', 'd.mp3', 'f32le'),
+        ('partial_checksum', 'a.flac', 'f32le'),
+        ('partial_checksum', 'a.flac', 's16le'),
+        ('partial_checksum', 'b.wav', 'f32le'),
+        ('partial_checksum', 'b.wav', 's16le'),
+        ('partial_checksum', 'c.mp3', 'f32le'),
+        ('partial_checksum', 'd.mp3', 'f32le'),
+    ]
+
+
+def test_main_func_dupes(capsys):
+    assert commandlinetool.main_func(['dupes', 'x', 'mahler.mp3']) == 0
+    assert normalize('NFC', capsys.readouterr()[0]) == normalize('NFC', u"""\
+mahler.mp3
+x/d.mp3
+
+x/ä.flac
+x/b.m4a
+x/c.flac
+x/c.m4a
+
+""")
+
+
+def test_find_duplicates_errors(tmpdir):
+    from audiodiff import dupes
+    root = tmpdir.mkdir('root')
+    shutil.copy('mahler.flac', str(root.join('a.flac')))
+    shutil.copy('mahler.wav', str(root.join('b.wav')))
+    root.join('broken.wav').mksymlinkto(root.join('missing.wav'))
+    missing = str(tmpdir.join('missing'))
+    with pytest.raises(OSError):
+        dupes.find_duplicates([str(root), missing])
+    with pytest.raises(IOError):
+        dupes.find_duplicates([str(root)])
+    errors = []
+    groups = dupes.find_duplicates(
+        [str(root), missing],
+        onerror=lambda name, exc_info: errors.append((name, exc_info[0])))
+    assert groups == [[str(root.join('a.flac')), str(root.join('b.wav'))]]
+    assert sorted(errors) == [(missing, OSError),
+                              (str(root.join('broken.wav')), IOError)]
+
+
+def test_main_func_dupes_errors(capsys):
+    args = ['dupes', 'w', 'mahler.flac', 'mahler.wav']
+    assert commandlinetool.main_func(args) == 2
+    out, err = capsys.readouterr()
+    assert out == 'mahler.flac\nmahler.wav\n\n'
+    assert err == ("audiodiff: failed to read 'w': [Errno 2] No such file or "
+                   "directory: 'w'\n")
+
+
+def test_sampled_checksum():
+    reader = audiodiff._open_pcm('mahler.flac', audiodiff.ffmpeg_path(), None,
+                                 'ffmpeg')
+    try:
+        data = reader.read(10000000)
+    finally:
+        reader.close()
+    second = 44100 * 2 * 3
+    # The stream is 2 seconds long (ignoring the rest), so segments start at
+    # seconds 0, 1 and 1
+    expected = hashlib.sha1(data[:second] + data[second:2 * second] * 2)
+    for name in ['mahler.wav', 'mahler.flac']:
+        for decoder in audiodiff.DECODERS:
+            assert audiodiff.sampled_checksum(name, decoder=decoder) == \
+                expected.hexdigest()
+    assert audiodiff.sampled_checksum('mahler.m4a') is None
+    expected = hashlib.md5(data[:second] + data[second:2 * second] * 2)
+    assert audiodiff.sampled_checksum('mahler.flac', algorithm='md5') == \
+        expected.hexdigest()
+    expected = hashlib.md5(data[:audiodiff.PARTIAL_CHECKSUM_SIZE])
+    assert audiodiff.partial_checksum('mahler.flac', algorithm='md5') == \
+        expected.hexdigest()
+
+
+def test_partial_mismatch(tmpdir):
+    name = str(tmpdir.join('sine.wav'))
+    subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi',
+                           '-i', 'sine=duration=30', '-ac', '2', name])
+    with open(name, 'rb') as f:
+        data = f.read()
+    second = 44100 * 2 * 2
+
+    def modified(basename, seconds):
+        path = str(tmpdir.join(basename))
+        pos = len(data) - 30 * second + int(seconds * second)
+        with open(path, 'wb') as f:
+            f.write(data[:pos] + chr(ord(data[pos]) ^ 1) + data[pos + 1:])
+        return path
+    beginning = modified('beginning.wav', 1)
+    sampled = modified('sampled.wav', 15.5)
+    elsewhere = modified('elsewhere.wav', 5)
+    assert audiodiff.partial_mismatch(name, beginning) == \
+        'first {0} bytes'.format(audiodiff.PARTIAL_CHECKSUM_SIZE)
+    assert audiodiff.partial_mismatch(name, sampled) == 'sampled segments'
+    assert audiodiff.partial_mismatch(name, elsewhere) is None
+    assert audiodiff.partial_mismatch(name, name) is None
+    for other in [beginning, sampled, elsewhere]:
+        assert not audiodiff.audio_equal(name, other, partial=True)
+    assert audiodiff.audio_equal('mahler.flac', 'mahler.m4a', partial=True)
+
+
+def test_main_func_partial(capsys):
+    assert commandlinetool.main_func(['x/d.mp3', 'y/d.flac', '--partial']) == 1
+    assert capsys.readouterr()[0] == (
+        'Audio streams in x/d.mp3 and y/d.flac differ in first {0} bytes\n'
+        .format(audiodiff.PARTIAL_CHECKSUM_SIZE))
+    assert commandlinetool.main_func(['y', 'z', '--partial']) == 0
+
+
+@pytest.mark.skipif('audiodiff.aio.asyncio is None')
+def test_aio():
+    asyncio = audiodiff.aio.asyncio
+    loop = asyncio.new_event_loop()
+    # Attaches the child watcher, which reaps FFmpeg processes, to the loop
+    asyncio.set_event_loop(loop)
+    try:
+        run = loop.run_until_complete
+        for name in ['mahler.wav', 'mahler.flac', 'mahler.m4a']:
+            for decoder in audiodiff.DECODERS:
+                assert run(audiodiff.aio.checksum(
+                    name, decoder=decoder, loop=loop)) == \
+                    audiodiff.checksum(name, decoder=decoder)
+        assert run(audiodiff.aio.audio_equal('mahler.flac', 'mahler.m4a',
+                                             loop=loop))
+        assert not run(audiodiff.aio.equal('mahler.flac',
+                                           'mahler_tagsdiff.m4a', loop=loop))
+        pairs = [
+            ('mahler.flac', 'mahler.m4a'),
+            ('mahler.flac', 'mahler_tagsdiff.m4a'),
+            ('mahler.m4a', 'mahler.mp3'),
+            ('x/foo.txt', 'y/foo.txt'),
+        ]
+        assert run(audiodiff.aio.compare_many(pairs, limit=2, loop=loop)) == \
+            [True, False, False, True]
+        with pytest.raises(audiodiff.ExternalLibraryError) as excinfo:
+            run(audiodiff.aio.checksum('x/foo.txt', loop=loop))
+        assert excinfo.value.stderr
+        with pytest.raises(audiodiff.ExternalLibraryError) as excinfo:
+            run(audiodiff.aio.checksum('mahler.flac', decoder='ffmpeg',
+                                       timeout=0.0001, loop=loop))
+        assert 'timed out' in str(excinfo.value)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@pytest.mark.skipif('audiodiff.aio.asyncio is None')
+def test_aio_reads_tags_once(monkeypatch):
+    asyncio = audiodiff.aio.asyncio
+    counts = {}
+    read_tags = audiodiff.mutagenwrapper.read_tags
+
+    def counting_read_tags(name, **kwargs):
+        counts[name] = counts.get(name, 0) + 1
+        return read_tags(name, **kwargs)
+
+    monkeypatch.setattr(audiodiff.mutagenwrapper, 'read_tags',
+                        counting_read_tags)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        run = loop.run_until_complete
+        assert run(audiodiff.aio.equal('mahler.flac', 'mahler.m4a',
+                                       flac_md5=True, loop=loop))
+        assert counts == {'mahler.flac': 1, 'mahler.m4a': 1}
+        counts.clear()
+        pairs = [('mahler.flac', 'mahler.m4a'),
+                 ('mahler.m4a', 'mahler.flac')]
+        assert run(audiodiff.aio.compare_many(pairs, limit=2, loop=loop)) == \
+            [True, True]
+        assert counts == {'mahler.flac': 2, 'mahler.m4a': 2}
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def _running(pid):
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            return f.read().split()[2] != 'Z'
+    except IOError:
+        return False
+
+
+@pytest.mark.skipif('audiodiff.aio.asyncio is None or '
+                    'not os.path.isdir("/proc")')
+def test_aio_audio_equal_cancels_sibling(tmpdir, monkeypatch):
+    asyncio = audiodiff.aio.asyncio
+    monkeypatch.setenv('AUDIODIFF_MAX_DECODERS', '2')
+    # A decoder that never finishes for slow.mp3 and records its pid
+    slow = str(tmpdir.join('slow.mp3'))
+    shutil.copy('mahler.mp3', slow)
+    pidfile = str(tmpdir.join('pid'))
+    ffmpeg_bin = str(tmpdir.join('ffmpeg'))
+    with open(ffmpeg_bin, 'w') as f:
+        f.write('#!/bin/sh\n'
+                'case "$*" in\n'
+                '*slow.mp3*) echo $$ > {0}; exec sleep 60;;\n'
+                'esac\n'
+                'exec {1} "$@"\n'.format(pidfile, audiodiff.ffmpeg_path()))
+    os.chmod(ffmpeg_bin, 0755)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        start = time.time()
+        with pytest.raises(audiodiff.ExternalLibraryError) as excinfo:
+            loop.run_until_complete(audiodiff.aio.audio_equal(
+                slow, 'x/foo.txt', ffmpeg_bin, cache=False, decoder='ffmpeg',
+                loop=loop))
+        assert 'foo.txt' in str(excinfo.value)
+        assert time.time() - start < 30
+        with open(pidfile) as f:
+            assert not _running(int(f.read()))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@parametrize('failing_first', [True, False])
+def test_parallel_abort(failing_first, tmpdir):
+    # FFmpeg blocks forever opening a FIFO nobody writes to
+    fifo = str(tmpdir.join('fifo.flac'))
+    os.mkfifo(fifo)
+
+    def decode(name):
+        return audiodiff._read_checksum(audiodiff._open_pcm(
+            name, audiodiff.ffmpeg_path(), None, 'ffmpeg'))
+    argslist = [('x/foo.txt',), (fifo,)]
+    if not failing_first:
+        argslist.reverse()
+    with pytest.raises(audiodiff.ExternalLibraryError) as excinfo:
+        audiodiff._parallel(decode, argslist)
+    assert 'foo.txt' in str(excinfo.value)
+
+
+@parametrize('decoder', ['ffmpeg', 'auto'])
+def test_reader_group_closed_reader(decoder, monkeypatch):
+    group = audiodiff._ReaderGroup()
+    monkeypatch.setattr(audiodiff._parallel_local, 'group', group,
+                        raising=False)
+    reader = audiodiff._open_pcm('mahler.wav', audiodiff.ffmpeg_path(), None,
+                                 decoder)
+    assert group._readers == [reader]
+    audiodiff._read_checksum(reader)
+    assert group._readers == []
+    if decoder == 'ffmpeg':
+        # The pid of a reaped FFmpeg process must never be signalled
+        kills = []
+        monkeypatch.setattr(reader.proc, 'kill', lambda: kills.append(1))
+        reader.abort()
+        assert kills == []
+
+
+def _flip_sample_bit(tmpdir, frame, channel):
+    """Copies mahler.wav (16-bit stereo) and flips the least significant bit
+    of a sample in the copy.
+
+    """
+    path = str(tmpdir.join('flipped.wav'))
+    shutil.copy('mahler.wav', path)
+    with open(path, 'r+b') as f:
+        header = audiodiff._parse_wave_header(f)
+        f.seek(header.data_offset + frame * 4 + channel * 2)
+        byte = ord(f.read(1))
+        f.seek(-1, 1)
+        f.write(chr(byte ^ 1))
+    return path
+
+
+@pytest.mark.skipif('audiodiff.numpy is None')
+def test_diff_audio(tmpdir):
+    flipped = _flip_sample_bit(tmpdir, 100000, 1)
+    diff = audiodiff.diff_audio('mahler.wav', flipped)
+    assert not diff.equal
+    assert diff[:8] == (2, 127742, 127742, 100000, 100000, 1, 256,
+                        (256 ** 2 / 255484.0) ** 0.5)
+    assert diff.per_channel == [
+        (None, None, 0, 0, 0.0),
+        (100000, 100000, 1, 256, (256 ** 2 / 127742.0) ** 0.5)]
+    # The number of channels of M4A files is found by decoding them
+    for decoder in audiodiff.DECODERS:
+        diff = audiodiff.diff_audio('mahler.flac', 'mahler.m4a',
+                                    decoder=decoder)
+        assert diff.equal
+        assert diff[:8] == (2, 127742, 127742, None, None, 0, 0, 0.0)
+    trimmed = _convert(tmpdir, 'trimmed.flac', '-t', '1')
+    diff = audiodiff.diff_audio(trimmed, flipped)
+    assert not diff.equal
+    assert diff[:8] == (2, 44100, 127742, None, None, 0, 0, 0.0)
+    mono = _convert(tmpdir, 'mono.wav', '-ac', '1')
+    with pytest.raises(ValueError):
+        audiodiff.diff_audio('mahler.flac', mono)
+
+
+@pytest.mark.skipif('audiodiff.numpy is None')
+def test_main_func_audio_report(tmpdir, capsys):
+    flipped = _flip_sample_bit(tmpdir, 100000, 1)
+    args = ['mahler.wav', flipped, '-a', '--audio-report']
+    assert commandlinetool.main_func(args) == 1
+    assert capsys.readouterr() == ("""\
+Audio streams in mahler.wav and {0} differ
+  1 of 255484 samples differ, from sample 100000 to 100000
+  Peak difference: 256 (-90.3 dBFS), RMS difference: 0.5 (-144.4 dBFS)
+  Channel 1: identical
+  Channel 2: 1 samples differ, from sample 100000 to 100000; \
+peak 256 (-90.3 dBFS), RMS 0.7 (-141.4 dBFS)
+""".format(flipped), '')
+    args = ['mahler.wav', 'mahler.flac', '-a', '--audio-report']
+    assert commandlinetool.main_func(args) == 0
+    assert capsys.readouterr() == ('', '')
+
+
+@pytest.mark.skipif('audiodiff.numpy is None')
+def test_audio_equal_tolerance(tmpdir):
+    flipped = _flip_sample_bit(tmpdir, 100000, 1)
+    assert not audiodiff.audio_equal('mahler.wav', flipped, max_difference=255)
+    assert audiodiff.audio_equal('mahler.wav', flipped, max_difference=256)
+    assert audiodiff.audio_equal('mahler.wav', flipped, min_snr=100)
+    assert not audiodiff.audio_equal('mahler.wav', flipped, min_snr=200)
+    # Lossy decodes differ slightly across platforms
+    assert not audiodiff.audio_equal('mahler.flac', 'mahler.mp3',
+                                     max_difference=10)
+    assert audiodiff.audio_equal('mahler.flac', 'mahler.mp3',
+                                 max_difference=1 << 23)
+    assert audiodiff.audio_equal('mahler.flac', 'mahler.mp3', min_snr=20)
+    assert not audiodiff.audio_equal('mahler.flac', 'mahler.mp3', min_snr=60)
+    trimmed = _convert(tmpdir, 'trimmed.flac', '-t', '1')
+    mono = _convert(tmpdir, 'mono.wav', '-ac', '1')
+    for name in [trimmed, mono]:
+        assert not audiodiff.approx_audio_equal('mahler.flac', name,
+                                                max_difference=1 << 23)
+
+
+@pytest.mark.skipif('audiodiff.numpy is None')
+def test_find_offset(tmpdir, capsys):
+    delayed = _convert(tmpdir, 'delayed.flac', '-af', 'adelay=1000S:all=1')
+    assert audiodiff.find_offset('mahler.flac', delayed) == 1000
+    assert audiodiff.find_offset(delayed, 'mahler.flac') == -1000
+    assert audiodiff.find_offset('mahler.flac', 'mahler.m4a') == 0
+    assert audiodiff.find_offset(delayed, 'mahler.flac', max_offset=500) != \
+        -1000
+    for name1, name2, offset in [('mahler.flac', delayed, 1000),
+                                 (delayed, 'mahler.flac', -1000)]:
+        diff = audiodiff.diff_audio(name1, name2, align=True)
+        assert diff[:8] == (2, audiodiff.stream_info(name1).samples,
+                            audiodiff.stream_info(name2).samples, None, None,
+                            0, 0, 0.0)
+        assert diff.offset == offset
+        assert audiodiff.audio_equal(name1, name2, align=True)
+        assert not audiodiff.audio_equal(name1, name2, prefilter=False,
+                                         max_difference=1 << 22)
+    args = ['mahler.flac', delayed, '-a', '--audio-report', '--align']
+    assert commandlinetool.main_func(args) == 1
+    assert capsys.readouterr() == ("""\
+Audio streams in mahler.flac and {0} differ in number of samples \
+(127742 and 128742)
+  Lengths: 127742 and 128742 samples per channel
+  Aligned at offset 1000 (sample 0 of mahler.flac matches sample 1000 of {0})
+  No sample differs in 127742 samples per channel compared
+""".format(delayed), '')
+    with pytest.raises(SystemExit):
+        commandlinetool.main_func(['mahler.flac', delayed, '--align'])
+    assert '--align requires --audio-report' in capsys.readouterr()[1]
+    # The AAC encoder pads the stream to a whole number of frames
+    aac = _convert(tmpdir, 'aac.m4a', '-c:a', 'aac', '-b:a', '256k')
+    assert not audiodiff.audio_equal('mahler.flac', aac, min_snr=10)
+    assert audiodiff.audio_equal('mahler.flac', aac, min_snr=10, align=True)